@@ -40,17 +40,61 @@ extern const int wordbytesize;
 extern const int wordbitsize;
 extern const int maxelem;
 
-typedef struct {
+typedef struct IntBitSet {
     int size;
     int allocated;
     word_t trailing_bits;
     int tot;
-    word_t *bitset;
+    word_t *bitset; // The words from offset up to allocated
+    int offset; // The words before are 0, and are not allocated
+    unsigned long long version; // Incremented whenever the content changes
+    int *ranks; // Rank directory, built when needed and dropped on changes
+    bool_t borrowed; // The words are not owned, e.g. they are memory mapped
+    Py_ssize_t *shares; // Number of bitsets sharing the words, if shared
+    struct IntBitSet *prev; // The other live bitsets, for the memory stats
+    struct IntBitSet *next;
 } IntBitSet;
 
+/** Memory accounting.
+ * The bitsets and their words are allocated in the tracemalloc domain
+ * INTBITSET_TRACEMALLOC_DOMAIN, and counted in the memory stats: bytes are
+ * those of the bitsets and of the words they own, wasted bytes those of
+ * the words allocated beyond the populated ones and the trailing word,
+ * resizes the growths of bitsets by intBitSetResize(), and reallocs all the
+ * reallocations of words.
+ */
+#define INTBITSET_TRACEMALLOC_DOMAIN 0x69627374
+typedef struct {
+    Py_ssize_t live_sets;
+    Py_ssize_t live_bytes;
+    Py_ssize_t peak_bytes;
+    Py_ssize_t resizes;
+    Py_ssize_t reallocs;
+    Py_ssize_t wasted_bytes;
+} IntBitSetMemoryStats;
+void intBitSetGetMemoryStats(IntBitSetMemoryStats *const stats);
+/** Return the bytes used by bitset and the words it holds, unless borrowed. */
+Py_ssize_t intBitSetGetMemory(const IntBitSet *const bitset);
+
 IntBitSet *intBitSetCreate(register const int size, const bool_t trailing_bits);
-IntBitSet *intBitSetCreateFromBuffer(const void * const buf, const Py_ssize_t bufsize);
-IntBitSet *intBitSetResetFromBuffer(IntBitSet *const bitset, const void *const buf, const Py_ssize_t bufsize);
+/** Create a bitset able to hold the elements from first up to size. */
+IntBitSet *intBitSetCreateWindow(register const int first, register const int size, const bool_t trailing_bits);
+IntBitSet *intBitSetCreateFromBuffer(const void * const buf, const Py_ssize_t bufsize, const int offset);
+/** Borrowed words.
+ * Create a bitset over nwords words, starting at word offset, owned by
+ * someone else, which are only read until intBitSetOwnWords() is called,
+ * copying them.
+ */
+IntBitSet *intBitSetCreateFromWords(word_t *const words, const int nwords, const int offset);
+void intBitSetOwnWords(IntBitSet *const bitset);
+/** Shared words.
+ * Create a bitset sharing the words of bitset (or copying them if they are
+ * borrowed). The words are freed with the last bitset sharing them, and
+ * intBitSetOwnWords() must be called before changing any of them, so that
+ * it gets its own copy.
+ */
+IntBitSet *intBitSetShare(IntBitSet *const bitset);
+IntBitSet *intBitSetResetFromBuffer(IntBitSet *const bitset, const void *const buf, const Py_ssize_t bufsize, const int offset);
 IntBitSet *intBitSetReset(IntBitSet *const bitset);
 void intBitSetDestroy(IntBitSet *const bitset);
 IntBitSet *intBitSetClone(const IntBitSet * const bitset);
@@ -58,6 +102,17 @@ int intBitSetGetSize(IntBitSet * const bitset);
 int intBitSetGetAllocated(const IntBitSet * const bitset);
 int intBitSetGetTot(IntBitSet * const bitset);
 void intBitSetResize(IntBitSet *const bitset, register const unsigned int allocated);
+/** Compact.
+ * Free the leading empty words and the words allocated beyond the
+ * populated ones and the trailing word, unless the words are borrowed or
+ * shared.
+ */
+void intBitSetCompact(IntBitSet *const bitset);
+/** Offset.
+ * Move the first word held by bitset to offset, which must not be beyond
+ * its first non empty word. The words must be owned.
+ */
+void intBitSetSetOffset(IntBitSet *const bitset, register const int offset);
 bool_t intBitSetIsInElem(const IntBitSet * const bitset, register const unsigned int elem);
 void intBitSetAddElem(IntBitSet *const bitset, register const unsigned int elem);
 void intBitSetDelElem(IntBitSet *const bitset, register const unsigned int elem);
@@ -70,11 +125,64 @@ IntBitSet *intBitSetIUnion(IntBitSet *const dst, IntBitSet *const src);
 IntBitSet *intBitSetIXor(IntBitSet *const dst, IntBitSet *const src);
 IntBitSet *intBitSetIIntersection(IntBitSet *const dst, IntBitSet *const src);
 IntBitSet *intBitSetISub(IntBitSet *const x, IntBitSet *const y);
-bool_t intBitSetIsDisjoint(const IntBitSet * const x, const IntBitSet * const y);
-int intBitSetAdaptMax(IntBitSet *const x, IntBitSet *const y);
-int intBitSetAdaptMin(IntBitSet *const x, IntBitSet *const y);
+bool_t intBitSetIsDisjoint(IntBitSet *const x, IntBitSet *const y);
 int intBitSetGetNext(const IntBitSet *const x, register int last);
 int intBitSetGetLast(const IntBitSet *const x);
+int intBitSetGetPrev(const IntBitSet *const x, register int last);
+/** Batch iteration.
+ * Store in out the (at most n) elements following last, and return how
+ * many they are. Elements beyond the populated words of an infinite bitset
+ * are not returned.
+ */
+int intBitSetGetNextMany(const IntBitSet *const x, register int last, unsigned int *const out, register const int n);
+/** Rank and select.
+ * intBitSetRank returns the number of elements smaller than or equal to
+ * elem, intBitSetSelect the element having k smaller elements (or -1).
+ */
+Py_ssize_t intBitSetRank(IntBitSet *const x, register const int elem);
+int intBitSetSelect(IntBitSet *const x, register Py_ssize_t k);
+/** Return a finite bitset with the elements of x in [first, last]. */
+IntBitSet *intBitSetGetRange(const IntBitSet *const x, register const int first, register const int last);
+/** Ranges.
+ * Add, remove, flip or count the elements in [start, stop), a whole word
+ * at a time. start and stop must be between 0 and maxelem + 1.
+ */
+void intBitSetAddRange(IntBitSet *const bitset, const Py_ssize_t start, const Py_ssize_t stop);
+void intBitSetDelRange(IntBitSet *const bitset, const Py_ssize_t start, const Py_ssize_t stop);
+void intBitSetFlipRange(IntBitSet *const bitset, const Py_ssize_t start, const Py_ssize_t stop);
+Py_ssize_t intBitSetCountRange(IntBitSet *const bitset, register Py_ssize_t start, register Py_ssize_t stop);
+/** Bulk update.
+ * Add to bitset, or remove from it if remove, the n integers of indices,
+ * of itemsize bytes, signed or not. Return 0, or, leaving bitset
+ * unchanged, -1 if one of them is negative, -2 if one is bigger than
+ * maxelem, -3 if itemsize is not supported.
+ */
+int intBitSetUpdateFromIndices(IntBitSet *const bitset, const void *const indices, const Py_ssize_t n, const int itemsize, const bool_t is_signed, const bool_t remove);
+/** Filter.
+ * Store in out the n integers of indices, of itemsize bytes, signed or
+ * not, which are in bitset, and return how many they are, or -3 if itemsize
+ * is not supported. They are stored in their order, or, if sorted, in
+ * ascending order without duplicates (they are sorted in out unless indices
+ * already are). out must hold n integers.
+ */
+Py_ssize_t intBitSetFilterIndices(IntBitSet *const bitset, const void *const indices, const Py_ssize_t n, const int itemsize, const bool_t is_signed, const bool_t sorted, unsigned int *const out);
+/** Membership.
+ * Return how many of the n integers of indices, of itemsize bytes, signed
+ * or not, are in bitset, or -3 if itemsize is not supported, and, unless
+ * out is NULL, set out[i] to whether the i-th one is.
+ */
+Py_ssize_t intBitSetContainsIndices(const IntBitSet *const bitset, const void *const indices, const Py_ssize_t n, const int itemsize, const bool_t is_signed, unsigned char *const out);
+/** Run-length encoding.
+ * Encode the nwords words in out, which must hold at least
+ * intBitSetRLEBound(nwords) bytes, and return the encoded size.
+ * Decode up to nwords words in out and return their number, or -1 if in
+ * is corrupted.
+ */
+Py_ssize_t intBitSetRLEBound(const Py_ssize_t nwords);
+Py_ssize_t intBitSetRLEEncode(const word_t *const words, register const Py_ssize_t nwords, unsigned char *const out);
+Py_ssize_t intBitSetRLEDecode(register const unsigned char *in, const Py_ssize_t size, word_t *const out, const Py_ssize_t nwords);
+/** Replace the content of dst with the one of src, destroying src. */
+IntBitSet *intBitSetReplace(IntBitSet *const dst, IntBitSet *const src);
 /** Compare.
  * Compare two intbitset.
  * Returns 0 if the two bitset are equals.
@@ -83,5 +191,134 @@ int intBitSetGetLast(const IntBitSet *const x);
  * Returns 3 if x != y
  */
 unsigned char intBitSetCmp(IntBitSet *const x, IntBitSet *const y);
+/** Hash.
+ * Return a hash of the content of bitset, which is the same for equal
+ * bitsets whatever their allocation, and is never -1.
+ */
+Py_hash_t intBitSetHash(IntBitSet *const bitset);
+/** K-way set operations.
+ * Return the union or the intersection of the n bitsets, in a single
+ * pass over their words. None of them is modified.
+ */
+IntBitSet *intBitSetUnionMany(IntBitSet *const *const bitsets, const int n);
+IntBitSet *intBitSetIntersectionMany(IntBitSet *const *const bitsets, const int n);
+/** Cardinality of set operations.
+ * Return the number of elements of x & y, x | y, x - y and x ^ y,
+ * without building them, or -1 if the result would be infinite.
+ */
+int intBitSetIntersectionCount(IntBitSet *const x, IntBitSet *const y);
+int intBitSetUnionCount(IntBitSet *const x, IntBitSet *const y);
+int intBitSetSubCount(IntBitSet *const x, IntBitSet *const y);
+int intBitSetXorCount(IntBitSet *const x, IntBitSet *const y);
+
+/** Operands of jobs.
+ * The words of a bitset as seen by a job: the words before offset are 0,
+ * the ones from size are trailing_bits.
+ */
+typedef struct {
+    const word_t *words; // Word offset, NULL for a bitset of trailing_bits only
+    Py_ssize_t offset;
+    Py_ssize_t size;
+    word_t trailing_bits;
+} IntBitSetOperand;
+
+/** Jobs.
+ * The binary operations, and the count of their elements, are split in two
+ * steps: intBitSetOpPrepare() (or intBitSetIOpPrepare() for in-place
+ * operations, and intBitSetOpCountPrepare() for counts, which returns 0 if
+ * the result would be infinite, and counts x alone if y is NULL) allocates
+ * the result and sets up job, with the GIL held, then intBitSetJobRun()
+ * computes the words of the result in [lo, hi), and returns the number of
+ * elements among them when counting. intBitSetJobRun() does not call the
+ * Python API, so that it can run without the GIL, and from several threads
+ * at once over disjoint ranges of [0, job->nwords), which are relative to
+ * job->offset, the first word of the result. Operands must not be
+ * changed meanwhile.
+ * intBitSetManyPrepare() likewise prepares the union, or the intersection,
+ * of n bitsets, and its job must be released by intBitSetJobDone() once
+ * run.
+ * intBitSetExprPrepare() (or intBitSetExprCountPrepare() for counts)
+ * prepares the evaluation of an expression on n bitsets, whose program, in
+ * postfix order, is made of the indices of the bitsets to push on a stack,
+ * INTBITSET_EXPR_OP(op) to replace its two top entries x and y by x op y,
+ * and INTBITSET_EXPR_NOT to complement its top entry. The program must
+ * outlive the job, which must also be released by intBitSetJobDone().
+ */
+#define INTBITSET_OP_AND 0
+#define INTBITSET_OP_OR 1
+#define INTBITSET_OP_XOR 2
+#define INTBITSET_OP_ANDNOT 3
+#define INTBITSET_EXPR_OP(op) (-1 - (op))
+#define INTBITSET_EXPR_NOT (-5)
+#define INTBITSET_EXPR_DEPTH 512 // Stack entries a program can need at most
+
+typedef struct {
+    word_t *dst; // NULL when counting
+    IntBitSetOperand x;
+    IntBitSetOperand y;
+    Py_ssize_t offset; // First word of the result, the ones before being 0
+    Py_ssize_t nwords; // Words of the result from offset which are not trailing_bits
+    int op;
+    IntBitSet **bitsets; // Operands of k-way operations and expressions, NULL otherwise
+    int n;
+    const int *program; // Program of expressions, NULL otherwise
+    int length;
+    int depth; // Stack entries needed by the program
+} IntBitSetJob;
+
+IntBitSet *intBitSetOpPrepare(IntBitSet *const x, IntBitSet *const y, const int op, IntBitSetJob *const job);
+IntBitSet *intBitSetIOpPrepare(IntBitSet *const dst, IntBitSet *const src, const int op, IntBitSetJob *const job);
+bool_t intBitSetOpCountPrepare(IntBitSet *const x, IntBitSet *const y, const int op, IntBitSetJob *const job);
+IntBitSet *intBitSetManyPrepare(IntBitSet *const *const bitsets, const int n, const bool_t intersection, IntBitSetJob *const job);
+IntBitSet *intBitSetExprPrepare(IntBitSet *const *const bitsets, const int n, const int *const program, const int length, IntBitSetJob *const job);
+bool_t intBitSetExprCountPrepare(IntBitSet *const *const bitsets, const int n, const int *const program, const int length, IntBitSetJob *const job);
+/** Returns the number of elements, at most k, stored in out, among the
+ * first k elements bigger than last of the result of an expression job,
+ * evaluated from the word holding the one following last on until k are
+ * found.
+ */
+int intBitSetExprFirst(const IntBitSetJob *const job, unsigned int *const out, const int k, const int last);
+Py_ssize_t intBitSetJobRun(const IntBitSetJob *const job, const Py_ssize_t lo, const Py_ssize_t hi);
+void intBitSetJobDone(IntBitSetJob *const job);
+
+/** Profiling.
+ * intBitSetNow() returns a monotonic time in nanoseconds. The latencies
+ * recorded in a profile are counted in a log-linear histogram: the bucket
+ * of a latency is given by its power of 2 and the next
+ * INTBITSET_PROFILE_SUB_BITS bits, so that the buckets are at most 12.5%
+ * wide, and intBitSetProfileBucketStart() returns the smallest latency
+ * counted in a bucket.
+ */
+#define INTBITSET_PROFILE_SUB_BITS 3
+#define INTBITSET_PROFILE_BUCKETS ((64 - INTBITSET_PROFILE_SUB_BITS + 1) << INTBITSET_PROFILE_SUB_BITS)
+typedef struct {
+    unsigned long long calls;
+    unsigned long long words;
+    unsigned long long total_ns;
+    unsigned long long max_ns;
+    unsigned long long histogram[INTBITSET_PROFILE_BUCKETS];
+} IntBitSetProfile;
+unsigned long long intBitSetNow(void);
+unsigned long long intBitSetProfileBucketStart(const int bucket);
+void intBitSetProfileRecord(IntBitSetProfile *const profile, const unsigned long long ns, const unsigned long long words);
+
+/** Word array kernels.
+ * Selected at runtime by intBitSetInitKernels() among the portable, SSE2,
+ * AVX2 and AVX-512 implementations (see intbitset_kernels.c).
+ * dst may be the same array as x.
+ */
+extern void (*intBitSetKernelAnd)(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n);
+extern void (*intBitSetKernelOr)(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n);
+extern void (*intBitSetKernelXor)(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n);
+extern void (*intBitSetKernelAndNot)(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n);
+extern bool_t (*intBitSetKernelIntersects)(const word_t *x, const word_t *y, Py_ssize_t n);
+extern unsigned char (*intBitSetKernelCmp)(const word_t *x, const word_t *y, Py_ssize_t n);
+extern Py_ssize_t (*intBitSetKernelPopCount)(const word_t *x, Py_ssize_t n);
+extern Py_ssize_t (*intBitSetKernelAndCount)(const word_t *x, const word_t *y, Py_ssize_t n);
+extern Py_ssize_t (*intBitSetKernelOrCount)(const word_t *x, const word_t *y, Py_ssize_t n);
+extern Py_ssize_t (*intBitSetKernelXorCount)(const word_t *x, const word_t *y, Py_ssize_t n);
+extern Py_ssize_t (*intBitSetKernelAndNotCount)(const word_t *x, const word_t *y, Py_ssize_t n);
+int intBitSetSupportedKernels(void);
+const char *intBitSetInitKernels(int level);
 
 #endif
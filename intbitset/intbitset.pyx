@@ -43,17 +43,28 @@ and then commit generated intbitset.c.
 
 #cython: infer_types=True
 
+import os
+import struct
 import sys
+import threading
 import zlib
 from array import array
-from cpython.buffer cimport PyBUF_SIMPLE, Py_buffer, PyObject_GetBuffer, PyBuffer_Release
+from cpython.buffer cimport PyBUF_SIMPLE, PyBUF_WRITABLE, PyBUF_FORMAT, PyBUF_ND, PyBUF_STRIDES, PyBUF_C_CONTIGUOUS
+from cpython.buffer cimport Py_buffer, PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release
 from cpython.ref cimport PyObject
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from libc.string cimport memset
+cimport cpython.array
 
 CFG_INTBITSET_ENABLE_SANITY_CHECKS = False
 from intbitset_helper import _
 from intbitset_version import __version__
 
-__all__ = ['intbitset', '__version__']
+__all__ = [
+    'intbitset', 'frozenintbitset', '__version__', 'get_num_threads', 'set_num_threads',
+    'union_all', 'intersection_all', 'memory_stats', 'enable_profiling', 'disable_profiling',
+    'get_profile', 'reset_profile',
+]
 
 cdef extern from *:
     ## See: <http://wiki.cython.org/FAQ/#HowdoIuse.27const.27.3F>
@@ -63,6 +74,7 @@ cdef extern from *:
 cdef extern from "intbitset.h":
     ctypedef int Py_ssize_t
     object PyBytes_FromStringAndSize(char *s, Py_ssize_t len)
+    char *PyBytes_AS_STRING(object string)
     object PyString_FromStringAndSize(char *s, Py_ssize_t len)
 
 cdef extern from "intbitset.h":
@@ -74,17 +86,42 @@ cdef extern from "intbitset.h":
         word_t trailing_bits
         int tot
         word_t *bitset
+        int offset
+        unsigned long long version
+        int *ranks
+        bint borrowed
+        Py_ssize_t *shares
     int wordbytesize
     int wordbitsize
     int maxelem
     IntBitSet *intBitSetCreate(int size, bint trailing_bits)
-    IntBitSet *intBitSetCreateFromBuffer(void *buf, int bufsize)
-    IntBitSet *intBitSetResetFromBuffer(IntBitSet *bitset, void *buf, int bufsize)
+    IntBitSet *intBitSetCreateWindow(int first, int size, bint trailing_bits)
+    IntBitSet *intBitSetCreateFromBuffer(void *buf, int bufsize, int offset)
+    IntBitSet *intBitSetCreateFromWords(word_t *words, int nwords, int offset)
+    void intBitSetOwnWords(IntBitSet *bitset)
+    IntBitSet *intBitSetShare(IntBitSet *bitset)
+    Py_hash_t intBitSetHash(IntBitSet *bitset)
+    Py_ssize_t intBitSetRLEBound(Py_ssize_t nwords)
+    Py_ssize_t intBitSetRLEEncode(word_t *words, Py_ssize_t nwords, unsigned char *out)
+    Py_ssize_t intBitSetRLEDecode(unsigned char *buf, Py_ssize_t size, word_t *out, Py_ssize_t nwords)
+    IntBitSet *intBitSetResetFromBuffer(IntBitSet *bitset, void *buf, int bufsize, int offset)
     IntBitSet *intBitSetReset(IntBitSet *bitset)
     void intBitSetDestroy(IntBitSet *bitset)
+    void intBitSetCompact(IntBitSet *bitset)
+    void intBitSetSetOffset(IntBitSet *bitset, int offset)
     IntBitSet *intBitSetClone(IntBitSet *bitset)
     int intBitSetGetSize(IntBitSet *bitset)
     int intBitSetGetAllocated(IntBitSet *bitset)
+    int INTBITSET_TRACEMALLOC_DOMAIN
+    ctypedef struct IntBitSetMemoryStats:
+        Py_ssize_t live_sets
+        Py_ssize_t live_bytes
+        Py_ssize_t peak_bytes
+        Py_ssize_t resizes
+        Py_ssize_t reallocs
+        Py_ssize_t wasted_bytes
+    void intBitSetGetMemoryStats(IntBitSetMemoryStats *stats)
+    Py_ssize_t intBitSetGetMemory(IntBitSet *bitset)
     int intBitSetGetTot(IntBitSet * bitset)
     bint intBitSetIsInElem(IntBitSet *bitset, unsigned int elem)
     void intBitSetAddElem(IntBitSet *bitset, unsigned int elem)
@@ -101,10 +138,716 @@ cdef extern from "intbitset.h":
     bint intBitSetIsDisjoint(IntBitSet *x, IntBitSet *y)
     int intBitSetGetNext(IntBitSet *x, int last)
     int intBitSetGetLast(IntBitSet *x)
+    int intBitSetGetPrev(IntBitSet *x, int last)
+    int intBitSetGetNextMany(IntBitSet *x, int last, unsigned int *out, int n)
+    IntBitSet *intBitSetReplace(IntBitSet *dst, IntBitSet *src)
+    int intBitSetUpdateFromIndices(IntBitSet *bitset, void *indices, Py_ssize_t n, int itemsize, bint is_signed, bint remove)
+    Py_ssize_t intBitSetFilterIndices(IntBitSet *bitset, void *indices, Py_ssize_t n, int itemsize, bint is_signed, bint sorted, unsigned int *out)
+    Py_ssize_t intBitSetContainsIndices(IntBitSet *bitset, void *indices, Py_ssize_t n, int itemsize, bint is_signed, unsigned char *out)
+    Py_ssize_t intBitSetRank(IntBitSet *x, int elem)
+    int intBitSetSelect(IntBitSet *x, Py_ssize_t k)
+    IntBitSet *intBitSetGetRange(IntBitSet *x, int first, int last)
+    void intBitSetAddRange(IntBitSet *bitset, Py_ssize_t start, Py_ssize_t stop)
+    void intBitSetDelRange(IntBitSet *bitset, Py_ssize_t start, Py_ssize_t stop)
+    void intBitSetFlipRange(IntBitSet *bitset, Py_ssize_t start, Py_ssize_t stop)
+    Py_ssize_t intBitSetCountRange(IntBitSet *bitset, Py_ssize_t start, Py_ssize_t stop)
     unsigned char intBitSetCmp(IntBitSet *x, IntBitSet *y)
+    int intBitSetIntersectionCount(IntBitSet *x, IntBitSet *y)
+    int intBitSetUnionCount(IntBitSet *x, IntBitSet *y)
+    int intBitSetSubCount(IntBitSet *x, IntBitSet *y)
+    int intBitSetXorCount(IntBitSet *x, IntBitSet *y)
+    int intBitSetSupportedKernels()
+    ctypedef struct IntBitSetJob:
+        word_t *dst
+        Py_ssize_t nwords
+        int op
+        IntBitSet **bitsets
+        int n
+        const int *program
+        int depth
+    int INTBITSET_OP_AND
+    int INTBITSET_OP_OR
+    int INTBITSET_OP_XOR
+    int INTBITSET_OP_ANDNOT
+    int INTBITSET_EXPR_NOT
+    int INTBITSET_EXPR_DEPTH
+    IntBitSet *intBitSetOpPrepare(IntBitSet *x, IntBitSet *y, int op, IntBitSetJob *job)
+    IntBitSet *intBitSetIOpPrepare(IntBitSet *dst, IntBitSet *src, int op, IntBitSetJob *job)
+    bint intBitSetOpCountPrepare(IntBitSet *x, IntBitSet *y, int op, IntBitSetJob *job)
+    IntBitSet *intBitSetManyPrepare(IntBitSet **bitsets, int n, bint intersection, IntBitSetJob *job)
+    IntBitSet *intBitSetExprPrepare(IntBitSet **bitsets, int n, int *program, int length, IntBitSetJob *job)
+    bint intBitSetExprCountPrepare(IntBitSet **bitsets, int n, int *program, int length, IntBitSetJob *job)
+    int intBitSetExprFirst(IntBitSetJob *job, unsigned int *out, int k, int last)
+    void intBitSetJobDone(IntBitSetJob *job)
+    Py_ssize_t intBitSetJobRun(IntBitSetJob *job, Py_ssize_t lo, Py_ssize_t hi) nogil
+    const char *intBitSetInitKernels(int level)
+    int INTBITSET_PROFILE_BUCKETS
+    ctypedef struct IntBitSetProfile:
+        unsigned long long calls
+        unsigned long long words
+        unsigned long long total_ns
+        unsigned long long max_ns
+        unsigned long long *histogram
+    unsigned long long intBitSetNow()
+    unsigned long long intBitSetProfileBucketStart(int bucket)
+    void intBitSetProfileRecord(IntBitSetProfile *profile, unsigned long long ns, unsigned long long words)
 
 __maxelem__ = maxelem
 
+cdef cpython.array.array _chunk_template = array("I")
+
+## Number of elements intbitset_expr.first() first looks for.
+cdef int _expr_first_chunk = 1024
+
+## Dumps made by fastdump() with a codec start with a header made of: a
+## magic number (which cannot start a zlib stream, as the legacy dumps do),
+## the version of the format, the codec, the word size, the byte order (0 for
+## little endian, 1 for big endian), the index of the first word (0 in
+## version 1), the number of words and the cardinality (-1 if infinite),
+## padded so that the words are aligned. Version 1 is still written when the
+## first word is 0, so that older versions can read these dumps.
+_DUMP_MAGIC = b'\x89IBS'
+_DUMP_VERSIONS = (1, 2)
+_DUMP_HEADER = struct.Struct('<4sBBBBIqq4x')
+_DUMP_CODECS = ('raw', 'zlib', 'rle')
+cdef cpython.array.array _bytes_template = array('B')
+cdef cpython.array.array _words_template = array('Q')
+
+def _parse_dump_header(dump):
+    """Return the codec, the number of words of a dump, whether its words
+    have to be byte swapped and the index of the first one, or None if it is
+    a legacy dump."""
+    if len(dump) < _DUMP_HEADER.size or dump[:4] != _DUMP_MAGIC:
+        return None
+    magic, version, codec, wordsize, byteorder, offset, nwords, tot = _DUMP_HEADER.unpack_from(dump)
+    if version not in _DUMP_VERSIONS or codec >= len(_DUMP_CODECS) or wordsize != wordbytesize or byteorder > 1:
+        raise ValueError("unsupported dump format")
+    if version == 1:
+        offset = 0
+    if not 0 < nwords <= maxelem // wordbitsize + 2 - offset:
+        raise ValueError("wrong number of words")
+    return codec, nwords, byteorder != (sys.byteorder == 'big'), offset
+
+cdef bytes _rle_encode(word_t *words, Py_ssize_t nwords):
+    cdef cpython.array.array ret = cpython.array.clone(_bytes_template, intBitSetRLEBound(nwords), False)
+    cpython.array.resize(ret, intBitSetRLEEncode(words, nwords, ret.data.as_uchars))
+    return ret.tobytes()
+
+cdef cpython.array.array _rle_decode(bytes encoded, Py_ssize_t nwords):
+    cdef cpython.array.array ret = cpython.array.clone(_words_template, nwords, False)
+    if intBitSetRLEDecode(<unsigned char *><char *>encoded, len(encoded), <word_t *>ret.data.as_ulonglongs, nwords) != nwords:
+        raise ValueError("corrupted run-length encoding")
+    return ret
+
+def _decode_dump(dump):
+    """Return the words held by a dump as a bytes-like object, and the index
+    of the first one."""
+    if type(dump) is array:
+        dump = dump.tobytes()
+    header = _parse_dump_header(dump)
+    if header is None:
+        return zlib.decompress(dump), 0
+    codec, nwords, swap, offset = header
+    payload = dump[_DUMP_HEADER.size:]
+    if _DUMP_CODECS[codec] == 'zlib':
+        words = zlib.decompress(payload)
+    elif _DUMP_CODECS[codec] == 'rle':
+        words = _rle_decode(bytes(payload), nwords)
+    else:
+        words = bytes(payload)
+    if memoryview(words).nbytes != nwords * wordbytesize:
+        raise ValueError("wrong number of words")
+    if swap:
+        tmp = array('Q', words)
+        tmp.byteswap()
+        words = tmp
+    return words, offset
+
+_KERNELS = ('scalar', 'sse2', 'avx2', 'avx512')
+
+def _select_kernels(level=None):
+    """Select the set operation kernels to be used, among 'scalar', 'sse2',
+    'avx2' and 'avx512', or the widest ones supported by the CPU if level is
+    None. Levels not supported by the CPU are capped to the widest one that
+    is. Return the name of the selected level.
+
+    This is done automatically at import time and is meant for testing and
+    benchmarking purposes.
+    """
+    global __simd__
+    if level is None:
+        __simd__ = intBitSetInitKernels(-1).decode('ascii')
+    elif level in _KERNELS:
+        __simd__ = intBitSetInitKernels(_KERNELS.index(level)).decode('ascii')
+    else:
+        raise ValueError("level must be one of %s" % ', '.join(_KERNELS))
+    return __simd__
+
+def _supported_kernels():
+    """Return the kernel levels supported by the running CPU."""
+    return _KERNELS[:intBitSetSupportedKernels() + 1]
+
+__simd__ = _select_kernels()
+
+## Set operations on more than _nogil_words words release the GIL, and
+## those on more than _parallel_words words are split across _num_threads
+## threads: the calling one and the workers of _executor.
+cdef Py_ssize_t _nogil_words = 1 << 12
+cdef Py_ssize_t _parallel_words = 1 << 17
+cdef int _num_threads = 1
+_executor = None
+_executor_lock = threading.Lock()
+
+def set_num_threads(int n):
+    """Set the number of threads, the calling one included, across which
+    the set operations on big intbitsets are split, and return the previous
+    one. The default is 1, i.e. no worker threads. In any case, the GIL is
+    released during the set operations on big intbitsets: other threads
+    modifying their operands meanwhile wait for them to be done, and those
+    reading the target of an in-place one see its previous content until
+    it is done."""
+    global _num_threads, _executor
+    if n < 1:
+        raise ValueError("n must be at least 1")
+    with _executor_lock:
+        previous = _num_threads
+        ## The previous workers exit once done with the jobs of the
+        ## operations still using them.
+        _executor = None
+        _num_threads = n
+    return previous
+
+def get_num_threads():
+    """Return the number of threads set by set_num_threads()."""
+    return _num_threads
+
+TRACEMALLOC_DOMAIN = INTBITSET_TRACEMALLOC_DOMAIN
+
+def memory_stats():
+    """Return a dict of statistics about the memory allocated for the
+    intbitsets (and their set operations) alive in the process:
+    live_sets and live_bytes, counting their words unless borrowed (e.g.
+    memory mapped), peak_bytes, the highest live_bytes so far, resizes, the
+    number of times an intbitset grew, reallocs, the number of reallocations
+    of words, and wasted_bytes, the bytes of the words allocated beyond
+    get_size() and the trailing word, which compact() gives back.
+
+    When tracemalloc is tracing, these allocations are traced in the
+    tracemalloc domain TRACEMALLOC_DOMAIN, to be filtered with
+    tracemalloc.DomainFilter."""
+    cdef IntBitSetMemoryStats stats
+    intBitSetGetMemoryStats(&stats)
+    return {
+        'live_sets': stats.live_sets,
+        'live_bytes': stats.live_bytes,
+        'peak_bytes': stats.peak_bytes,
+        'resizes': stats.resizes,
+        'reallocs': stats.reallocs,
+        'wasted_bytes': stats.wasted_bytes,
+    }
+
+def _set_thresholds(nogil_words, parallel_words):
+    """Set the number of words above which the set operations release the
+    GIL, and above which they are split across threads. Return the previous
+    ones.
+
+    This is meant for testing and benchmarking purposes.
+    """
+    global _nogil_words, _parallel_words
+    previous = (_nogil_words, _parallel_words)
+    _nogil_words = nogil_words
+    _parallel_words = parallel_words
+    return previous
+
+def _forget_executor():
+    ## The workers do not survive a fork, nor the lock if held by another
+    ## thread.
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_executor)
+
+cdef class _Job:
+    """A job shared by the threads computing a set operation."""
+    cdef IntBitSetJob job
+
+    def run(self, Py_ssize_t lo, Py_ssize_t hi):
+        cdef Py_ssize_t ret
+        with nogil:
+            ret = intBitSetJobRun(&self.job, lo, hi)
+        return ret
+
+cdef Py_ssize_t _run_parallel(IntBitSetJob *job) except -1:
+    """Split job in as many ranges of words as there are threads."""
+    global _executor
+    cdef _Job shared = _Job()
+    cdef Py_ssize_t nwords = job.nwords
+    cdef Py_ssize_t step
+    cdef Py_ssize_t ret = 0
+    cdef list futures = []
+    ## The same workers run the whole job, even if set_num_threads() is
+    ## called meanwhile.
+    with _executor_lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _executor = ThreadPoolExecutor(_num_threads - 1, 'intbitset')
+        executor = _executor
+        step = max((nwords + _num_threads - 1) // _num_threads, _nogil_words, 8)
+    ## Ranges start on a cache line, so that threads do not write to the
+    ## same ones.
+    step = (step + 7) & ~7
+    shared.job = job[0]
+    try:
+        for lo in range(step, nwords, step):
+            futures.append(executor.submit(shared.run, lo, min(lo + step, nwords)))
+        ret = shared.run(0, min(step, nwords))
+    finally:
+        ## The operands must outlive the workers using them.
+        for future in futures:
+            ret += future.result()
+    return ret
+
+cdef Py_ssize_t _run(IntBitSetJob *job, intbitset x, intbitset y, list operands=None) except -1:
+    """Run job, an operation on x and y (which may be None), or on the
+    intbitsets of operands, releasing the GIL if it is big. Return the
+    count it computes, if any."""
+    if _profiling:
+        return _run_profiled(job, x, y, operands)
+    return _run_job(job, x, y, operands)
+
+cdef Py_ssize_t _run_job(IntBitSetJob *job, intbitset x, intbitset y, list operands) except -1:
+    cdef Py_ssize_t ret
+    if job.nwords <= _nogil_words:
+        return intBitSetJobRun(job, 0, job.nwords)
+    if operands is None:
+        operands = [x] if y is None else [x, y]
+    ## The operands are not changed by other threads meanwhile: their
+    ## writers wait for the job to be done (see _wait_jobs()).
+    for operand in operands:
+        (<intbitset>operand).readers += 1
+    try:
+        if _num_threads > 1 and job.nwords > _parallel_words:
+            return _run_parallel(job)
+        with nogil:
+            ret = intBitSetJobRun(job, 0, job.nwords)
+        return ret
+    finally:
+        for operand in operands:
+            (<intbitset>operand).readers -= 1
+        with _jobs_done:
+            _jobs_done.notify_all()
+
+## States of an intbitset written out of place: its new content is computed,
+## while other threads can keep on reading its previous words, which are
+## then replaced once they are done.
+cdef enum:
+    _WRITING_NONE
+    _WRITING_COMPUTE
+    _WRITING_REPLACE
+
+## Notified whenever a job running without the GIL is done reading its
+## operands, an intbitset is done being written out of place, or a writer
+## is done waiting.
+_jobs_done = threading.Condition()
+
+cdef int _wait_jobs(intbitset x, bint writers) except -1:
+    """Wait until no job reads the words of x in another thread, and, if
+    writers, until x is not being written out of place (see _iop())."""
+    if x.readers or (writers and x.writing):
+        with _jobs_done:
+            x.waiting += 1
+            try:
+                while x.readers or (writers and x.writing):
+                    _jobs_done.wait()
+            finally:
+                x.waiting -= 1
+                _jobs_done.notify_all()
+    return 0
+
+cdef int _wait_writers(intbitset x) except -1:
+    """Wait until no other thread waits to write x, unless its new content
+    is being computed out of place, its previous words being read
+    meanwhile. To be called before preparing a job reading x, so that its
+    writers are not starved by jobs following each other."""
+    if x is not None and x.waiting and x.writing != _WRITING_COMPUTE:
+        with _jobs_done:
+            while x.waiting and x.writing != _WRITING_COMPUTE:
+                _jobs_done.wait()
+    return 0
+
+cdef int _replace(intbitset dst, IntBitSet *bitset) except -1:
+    """Replace the content of dst, being written out of place, by bitset,
+    once the jobs of other threads reading its previous words are done."""
+    dst.writing = _WRITING_REPLACE
+    try:
+        _wait_jobs(dst, 0)
+    except:
+        intBitSetDestroy(bitset)
+        raise
+    intBitSetReplace(dst.bitset, bitset)
+    return 0
+
+cdef int _done_writing(intbitset dst) except -1:
+    dst.writing = _WRITING_NONE
+    with _jobs_done:
+        _jobs_done.notify_all()
+    return 0
+
+## Entry points whose calls are recorded when profiling, in the order of
+## _PROFILE_ENTRIES. The binary operations and their counts follow the
+## order of the INTBITSET_OP_* codes.
+cdef enum:
+    _PROFILE_INTERSECTION
+    _PROFILE_UNION
+    _PROFILE_SYMMETRIC_DIFFERENCE
+    _PROFILE_DIFFERENCE
+    _PROFILE_INTERSECTION_COUNT
+    _PROFILE_UNION_COUNT
+    _PROFILE_SYMMETRIC_DIFFERENCE_COUNT
+    _PROFILE_DIFFERENCE_COUNT
+    _PROFILE_LEN
+    _PROFILE_INTERSECTION_MANY
+    _PROFILE_UNION_MANY
+    _PROFILE_EXPR
+    _PROFILE_EXPR_COUNT
+    _PROFILE_EXPR_FIRST
+    _PROFILE_FASTDUMP
+    _PROFILE_FASTLOAD
+    _PROFILE_ITERATE
+    _PROFILE_ITER_CHUNKS
+    _PROFILE_COUNT
+
+_PROFILE_ENTRIES = (
+    'intersection', 'union', 'symmetric_difference', 'difference',
+    'intersection_count', 'union_count', 'symmetric_difference_count', 'difference_count',
+    'len', 'intersection_many', 'union_many', 'expr', 'expr_count', 'expr_first',
+    'fastdump', 'fastload', 'iterate', 'iter_chunks',
+)
+
+cdef IntBitSetProfile _profiles[_PROFILE_COUNT]
+cdef bint _profiling = False
+cdef object _profile_callback = None
+cdef unsigned long long _profile_threshold = 0
+
+def enable_profiling(callback=None, double threshold=0.001):
+    """Start recording, for each entry point of the C implementation (the
+    set operations, their counts, the k-way ones, expressions, fastdump(),
+    fastload() and iteration), the number of calls, the number of words
+    they process and a histogram of their latencies, to be read with
+    get_profile(). If callback is given, it is called with the name of the
+    entry point, the latency in seconds and the number of words of each
+    call lasting at least threshold seconds, e.g. to log outliers. The
+    call is recorded before, and an exception raised by callback is
+    propagated by the entry point, whose result is then lost. callback must
+    not modify the intbitsets the call operates on.
+
+    When profiling is disabled, which is the default, the entry points only
+    check a flag."""
+    global _profiling, _profile_callback, _profile_threshold
+    if threshold < 0:
+        raise ValueError("threshold must not be negative")
+    _profile_callback = callback
+    _profile_threshold = <unsigned long long>(threshold * 1e9)
+    _profiling = True
+
+def disable_profiling():
+    """Stop recording the calls, keeping what was recorded."""
+    global _profiling, _profile_callback
+    _profiling = False
+    _profile_callback = None
+
+def reset_profile():
+    """Forget the calls recorded so far."""
+    memset(_profiles, 0, sizeof(_profiles))
+
+def get_profile():
+    """Return a dict, by entry point called since profiling was enabled, of
+    dicts of the number of calls, the number of words processed, the total
+    and maximum latencies in seconds, the 50th, 90th, 99th and 99.9th
+    percentiles of the latencies (within 12.5%), and the histogram of the
+    latencies, as a dict of the number of calls by smallest latency in
+    nanoseconds of each non empty bucket."""
+    cdef IntBitSetProfile *profile
+    cdef int bucket
+    cdef unsigned long long seen
+    ret = {}
+    for entry, name in enumerate(_PROFILE_ENTRIES):
+        profile = &_profiles[entry]
+        if not profile.calls:
+            continue
+        histogram = {}
+        percentiles = {}
+        seen = 0
+        for bucket in range(INTBITSET_PROFILE_BUCKETS):
+            if not profile.histogram[bucket]:
+                continue
+            histogram[intBitSetProfileBucketStart(bucket)] = profile.histogram[bucket]
+            seen += profile.histogram[bucket]
+            for percentile in (50, 90, 99, 99.9):
+                if percentile not in percentiles and seen * 100 >= percentile * profile.calls:
+                    ## The biggest latency the bucket can hold.
+                    percentiles[percentile] = min(intBitSetProfileBucketStart(bucket + 1) - 1, profile.max_ns) * 1e-9
+        ret[name] = {
+            'calls': profile.calls,
+            'words': profile.words,
+            'total': profile.total_ns * 1e-9,
+            'max': profile.max_ns * 1e-9,
+            'percentiles': percentiles,
+            'histogram': histogram,
+        }
+    return ret
+
+cdef int _profile(int entry, unsigned long long start, unsigned long long words) except -1:
+    """Record a call of entry started at start (see intBitSetNow())."""
+    cdef unsigned long long ns = intBitSetNow() - start
+    intBitSetProfileRecord(&_profiles[entry], ns, words)
+    if _profile_callback is not None and ns >= _profile_threshold:
+        _profile_callback(_PROFILE_ENTRIES[entry], ns * 1e-9, words)
+    return 0
+
+cdef Py_ssize_t _run_profiled(IntBitSetJob *job, intbitset x, intbitset y, list operands) except -1:
+    cdef unsigned long long start = intBitSetNow()
+    cdef Py_ssize_t ret = _run_job(job, x, y, operands)
+    cdef int entry
+    if job.program != NULL:
+        entry = _PROFILE_EXPR if job.dst != NULL else _PROFILE_EXPR_COUNT
+    elif job.bitsets != NULL:
+        entry = _PROFILE_INTERSECTION_MANY if job.op == INTBITSET_OP_AND else _PROFILE_UNION_MANY
+    elif job.dst == NULL:
+        entry = _PROFILE_LEN if y is None else _PROFILE_INTERSECTION_COUNT + job.op
+    else:
+        entry = _PROFILE_INTERSECTION + job.op
+    _profile(entry, start, job.nwords * (job.n if job.bitsets != NULL else 1 if y is None else 2))
+    return ret
+
+cdef object _richcmp(self, rhs, int op):
+    """Compare self and rhs, two intbitsets, as sets."""
+    if not isinstance(self, intbitset) or not isinstance(rhs, intbitset):
+        return False
+    cdef short unsigned int tmp
+    tmp = intBitSetCmp((<intbitset>self).bitset, (<intbitset>rhs).bitset)
+    if op == 0: # <
+        return tmp == 1
+    if op == 1: # <=
+        return tmp <= 1
+    if op == 2: # ==
+        return tmp == 0
+    if op == 3: # !=
+        return tmp > 0
+    if op == 4: # >
+        return tmp == 2
+    if op == 5: # >=
+        return tmp in (0, 2)
+
+cdef int _check_range(Py_ssize_t start, Py_ssize_t stop) except -1:
+    """Check that the integers of range(start, stop) can be elements."""
+    if start < 0 or stop < 0:
+        raise ValueError("Negative numbers, not allowed")
+    if start > <Py_ssize_t>maxelem + 1 or stop > <Py_ssize_t>maxelem + 1:
+        raise OverflowError("Element must be <= %s" % maxelem)
+    return 0
+
+cdef intbitset _new_like(intbitset x):
+    """Return an empty intbitset, not allocated yet, or a frozenintbitset
+    if x is one, to hold a result computed from x."""
+    if isinstance(x, frozenintbitset):
+        return frozenintbitset(no_allocate=1)
+    return intbitset(no_allocate=1)
+
+cdef intbitset _op(intbitset x, intbitset y, int op):
+    """Return the result of the binary operation op on x and y."""
+    cdef IntBitSetJob job
+    cdef intbitset ret = _new_like(x)
+    _wait_writers(x)
+    _wait_writers(y)
+    ret.bitset = intBitSetOpPrepare(x.bitset, y.bitset, op, &job)
+    _run(&job, x, y)
+    return ret
+
+cdef int _iop(intbitset dst, intbitset src, int op) except -1:
+    """Update dst with the result of the binary operation op on dst and
+    src. If it is too big to be computed with the GIL held, it is computed
+    out of place, so that other threads keep on reading the previous
+    content of dst meanwhile, and can only write it once replaced."""
+    cdef IntBitSetJob job
+    cdef IntBitSet *ret
+    if src is not dst:
+        _wait_writers(src)
+    _wait_jobs(dst, 1)
+    ## Other threads might have exported dst meanwhile.
+    if dst.exports:
+        raise BufferError("Existing exports of data: intbitset cannot be modified")
+    ## An upper bound of the words the in-place job would go through.
+    if max(intBitSetGetSize(dst.bitset), intBitSetGetSize(src.bitset)) - min(dst.bitset.offset, src.bitset.offset) > _nogil_words:
+        ret = intBitSetOpPrepare(dst.bitset, src.bitset, op, &job)
+        dst.writing = _WRITING_COMPUTE
+        try:
+            try:
+                _run(&job, dst, src)
+            except:
+                intBitSetDestroy(ret)
+                raise
+            _replace(dst, ret)
+        finally:
+            _done_writing(dst)
+        return 0
+    dst._own_words()
+    intBitSetIOpPrepare(dst.bitset, src.bitset, op, &job)
+    _run(&job, dst, src)
+    ## An intersection can leave most of the words unused: free them.
+    if op == INTBITSET_OP_AND and intBitSetGetSize(dst.bitset) < intBitSetGetAllocated(dst.bitset) // 2:
+        intBitSetCompact(dst.bitset)
+    return 0
+
+cdef IntBitSet *_combine(list operands, bint intersection) except NULL:
+    """Return the union, or the intersection, of the intbitsets of
+    operands, computed by a single k-way pass."""
+    cdef IntBitSet **bitsets
+    cdef IntBitSet *ret
+    cdef IntBitSetJob job
+    cdef Py_ssize_t i
+    for operand in operands:
+        _wait_writers(operand)
+    bitsets = <IntBitSet **>PyMem_Malloc(len(operands) * sizeof(IntBitSet *))
+    if bitsets == NULL:
+        raise MemoryError()
+    for i in range(len(operands)):
+        bitsets[i] = (<intbitset>operands[i]).bitset
+    ret = intBitSetManyPrepare(bitsets, len(operands), intersection, &job)
+    PyMem_Free(bitsets)
+    try:
+        _run(&job, None, None, operands)
+    except:
+        intBitSetDestroy(ret)
+        raise
+    finally:
+        intBitSetJobDone(&job)
+    return ret
+
+cdef list _operands(intbitset first, tuple args):
+    """Return the list of first and all the args, as intbitsets."""
+    cdef list operands = [first]
+    for arg in args:
+        operands.append(arg if isinstance(arg, intbitset) else intbitset(arg))
+    return operands
+
+cdef IntBitSet *_combine_many(intbitset first, tuple args, bint intersection) except NULL:
+    """Return the union, or the intersection, of first and all the args."""
+    return _combine(_operands(first, args), intersection)
+
+cdef int _icombine_many(intbitset dst, tuple args, bint intersection) except -1:
+    """Update dst with the union, or the intersection, of dst and all the
+    args, computed out of place as by _iop()."""
+    cdef list operands = _operands(dst, args)
+    _wait_jobs(dst, 1)
+    dst.writing = _WRITING_COMPUTE
+    try:
+        _replace(dst, _combine(operands, intersection))
+    finally:
+        _done_writing(dst)
+    return 0
+
+## Number of intbitsets combined at once by union_all() and
+## intersection_all().
+cdef int _batch_size = 256
+
+cdef intbitset _combine_all(iterable, bint intersection):
+    """Return the union, or the intersection, of the intbitsets of iterable,
+    by batches of _batch_size."""
+    cdef intbitset ret = None
+    cdef list batch = []
+    for item in iterable:
+        batch.append(item if isinstance(item, intbitset) else intbitset(item))
+        if len(batch) < _batch_size:
+            continue
+        ret = intbitset(no_allocate=1)
+        ret.bitset = _combine(batch, intersection)
+        ## Nothing more can be intersected with an empty set.
+        if intersection and not ret:
+            return ret
+        batch = [ret]
+    if not batch:
+        if intersection:
+            raise ValueError("intersection_all() of no intbitsets")
+        return intbitset()
+    if batch[0] is not ret or len(batch) > 1:
+        ret = intbitset(no_allocate=1)
+        ret.bitset = _combine(batch, intersection)
+    return ret
+
+def union_all(iterable):
+    """Return the union of the intbitsets, or iterables of integers, of
+    iterable, which can be a generator. They are combined by batches, in
+    a single pass over the words of each batch, into a result allocated
+    once per batch, and split across threads if big (see
+    set_num_threads())."""
+    return _combine_all(iterable, 0)
+
+def intersection_all(iterable):
+    """Return the intersection of the intbitsets, or iterables of integers,
+    of iterable, which can be a generator, and cannot be empty. They are
+    combined as by union_all(), and iterable is not consumed any further
+    once the intersection is empty."""
+    return _combine_all(iterable, 1)
+
+cdef Py_ssize_t _op_count(intbitset x, intbitset y, int op) except -2:
+    """Return the number of elements of the result of the binary operation
+    op on x and y, or of x alone if y is None, or -1 if it is infinite."""
+    cdef IntBitSetJob job
+    _wait_writers(x)
+    _wait_writers(y)
+    if not intBitSetOpCountPrepare(x.bitset, y.bitset if y is not None else NULL, op, &job):
+        return -1
+    return _run(&job, x, y)
+
+cdef int _get_indices_buffer(object indices, Py_buffer *view, bint *is_signed) except -1:
+    """Get in view the buffer of indices and return 1 if it is a contiguous
+    buffer of integers in native byte order, such as an array('I') or a
+    NumPy integer array, setting is_signed. Otherwise return 0, with no
+    buffer to release."""
+    if not PyObject_CheckBuffer(indices):
+        return 0
+    try:
+        PyObject_GetBuffer(indices, view, PyBUF_FORMAT | PyBUF_C_CONTIGUOUS)
+    except BufferError:
+        return 0
+    try:
+        fmt = view.format.decode('ascii') if view.format != NULL else 'B'
+        if fmt[:1] in '@=' or (fmt[:1] == '<' and sys.byteorder == 'little') or (fmt[:1] in '>!' and sys.byteorder == 'big'):
+            fmt = fmt[1:]
+    except:
+        PyBuffer_Release(view)
+        raise
+    if len(fmt) != 1 or fmt not in 'bBhHiIlLqQ':
+        PyBuffer_Release(view)
+        return 0
+    is_signed[0] = fmt.islower()
+    return 1
+
+cdef int _update_from_buffer(IntBitSet *bitset, object indices, bint remove) except -1:
+    """Add to bitset, or remove from it if remove, the integers of indices
+    and return 1 if it is a contiguous buffer of integers in native byte
+    order, such as an array('I') or a NumPy integer array. Otherwise return
+    0."""
+    cdef Py_buffer view
+    cdef bint is_signed
+    cdef int ret
+    if not _get_indices_buffer(indices, &view, &is_signed):
+        return 0
+    try:
+        ret = intBitSetUpdateFromIndices(bitset, view.buf, view.len // view.itemsize, view.itemsize, is_signed, remove)
+    finally:
+        PyBuffer_Release(&view)
+    if ret == -1:
+        raise ValueError("Negative numbers, not allowed")
+    elif ret == -2:
+        raise OverflowError("Elements must be <= %s" % maxelem)
+    elif ret < 0:
+        return 0
+    return 1
+
 cdef class intbitset:
     """
     Defines an intbitset data object to hold unordered sets of
@@ -130,7 +873,8 @@ cdef class intbitset:
     * ``int/long`` for creating allocating empty intbitset that will hold at
       least rhs elements, before being resized
 
-    * ``intbitset`` for cloning
+    * ``intbitset`` for cloning, in constant time: the clone shares the
+      words of rhs until either of them is modified
 
     * ``bytes`` for retrieving an intbitset that was dumped into a byte string
 
@@ -156,6 +900,12 @@ cdef class intbitset:
     """
     cdef IntBitSet *bitset
     cdef bint sanity_checks
+    cdef int exports
+    cdef int readers
+    cdef int waiting
+    cdef int writing
+    cdef Py_ssize_t shape
+    cdef Py_buffer borrowed_view
 
     def __cinit__(
         self not None, 
@@ -168,8 +918,8 @@ cdef class intbitset:
         cdef Py_ssize_t size = 0
         cdef const_void_ptr buf = NULL
         cdef int elem
+        cdef int first = 0
         cdef int last
-        cdef int remelem
         cdef bint tuple_of_tuples
         cdef Py_buffer view
 
@@ -184,13 +934,12 @@ cdef class intbitset:
                 if rhs < 0:
                     raise ValueError("rhs can't be negative")
                 self.bitset = intBitSetCreate(rhs, trailing_bits)
-            elif type(rhs) is intbitset:
-                self.bitset = intBitSetClone((<intbitset>rhs).bitset)
-            elif type(rhs) in (bytes, array):
+            elif isinstance(rhs, intbitset):
+                ## The words are copied when either is first modified.
+                self.bitset = intBitSetShare((<intbitset>rhs).bitset)
+            elif type(rhs) is bytes or (type(rhs) is array and rhs.typecode in 'bB'):
                 try:
-                    if type(rhs) is array:
-                        rhs = rhs.tobytes()
-                    tmp = zlib.decompress(rhs)
+                    tmp, offset = _decode_dump(rhs)
 
                     if PyObject_GetBuffer(tmp, &view, PyBUF_SIMPLE) != 0:
                         raise ValueError("Unable to get buffer")
@@ -203,13 +952,23 @@ cdef class intbitset:
                             ## Wrong size!
                             raise Exception()
 
-                        self.bitset = intBitSetCreateFromBuffer(buf, size)
+                        self.bitset = intBitSetCreateFromBuffer(buf, size, offset)
                     finally:
                         PyBuffer_Release(&view)
                         
                 except Exception as e:
                     raise ValueError("rhs is corrupted: %s" % str(e))
             elif hasattr(rhs, '__iter__'):
+                if not trailing_bits and PyObject_CheckBuffer(rhs):
+                    ## Arrays of integers are read at once.
+                    self.bitset = intBitSetCreate(max(preallocate, 0), 0)
+                    try:
+                        if _update_from_buffer(self.bitset, rhs, 0):
+                            return
+                    except (ValueError, OverflowError) as e:
+                        raise ValueError("retrieving integers from rhs is impossible: %s" % str(e))
+                    intBitSetDestroy(self.bitset)
+                    self.bitset = NULL
                 tuple_of_tuples = (
                     rhs
                     and hasattr(rhs, '__getitem__')
@@ -220,6 +979,18 @@ cdef class intbitset:
                         if rhs and (not hasattr(rhs, '__getitem__') or type(rhs[0]) is int):
                             try:
                                 preallocate = max(rhs)
+                                ## Only the words from the first element on
+                                ## are allocated, the smallest one if rhs is
+                                ## sorted, or else from the biggest one, the
+                                ## words being extended down to the smaller
+                                ## elements as they are added (the trailing
+                                ## bits before the first element are
+                                ## removed anyway).
+                                if rhs is not iter(rhs):
+                                    if hasattr(rhs, '__getitem__'):
+                                        first = max(rhs[0], 0)
+                                    elif not trailing_bits:
+                                        first = preallocate
                             except ValueError:
                                 preallocate = 0
                         else:
@@ -227,7 +998,7 @@ cdef class intbitset:
                     if self.sanity_checks:
                         if not (0 <= preallocate < maxelem):
                             raise OverflowError("Can't store integers bigger than %s" % maxelem)
-                    self.bitset = intBitSetCreate(preallocate, trailing_bits)
+                    self.bitset = intBitSetCreateWindow(first, preallocate, trailing_bits)
                     if trailing_bits:
                         last = 0
                         if self.sanity_checks:
@@ -238,8 +1009,7 @@ cdef class intbitset:
                                         raise ValueError("Negative numbers, not allowed")
                                     elif elem > maxelem:
                                         raise OverflowError("Elements must be <= %s" % maxelem)
-                                    for remelem from last <= remelem < elem:
-                                        intBitSetDelElem(self.bitset, remelem)
+                                    intBitSetDelRange(self.bitset, last, elem)
                                     last = elem + 1
                             else:
                                 for elem in rhs:
@@ -247,20 +1017,17 @@ cdef class intbitset:
                                         raise ValueError("Negative numbers, not allowed")
                                     elif elem > maxelem:
                                         raise OverflowError("Elements must be <= %s" % maxelem)
-                                    for remelem from last <= remelem < elem:
-                                        intBitSetDelElem(self.bitset, remelem)
+                                    intBitSetDelRange(self.bitset, last, elem)
                                     last = elem + 1
                         else:
                             if tuple_of_tuples:
                                 for tmp_tuple in rhs:
                                     elem = tmp_tuple[0]
-                                    for remelem from last <= remelem < elem:
-                                        intBitSetDelElem(self.bitset, remelem)
+                                    intBitSetDelRange(self.bitset, last, elem)
                                     last = elem + 1
                             else:
                                 for elem in rhs:
-                                    for remelem from last <= remelem < elem:
-                                        intBitSetDelElem(self.bitset, remelem)
+                                    intBitSetDelRange(self.bitset, last, elem)
                                     last = elem + 1
 
                     else:
@@ -294,11 +1061,70 @@ cdef class intbitset:
                 raise TypeError("rhs is of unknown type %s" % type(rhs))
         except:
             intBitSetDestroy(self.bitset)
+            self.bitset = NULL
             raise
 
     def __dealloc__(self not None):
         #print >> sys.stderr, "intbitset.__dealloc__ is called"
+        cdef bint borrowed = self.bitset != NULL and self.bitset.borrowed
         intBitSetDestroy(self.bitset)
+        if borrowed:
+            PyBuffer_Release(&self.borrowed_view)
+
+    cdef int _prepare_write(self) except -1:
+        """To be called before any change of the content."""
+        _wait_jobs(self, 1)
+        if self.exports:
+            raise BufferError("Existing exports of data: intbitset cannot be modified")
+        self._own_words()
+        return 0
+
+    cdef void _own_words(self):
+        """Copy the words, if they are borrowed or shared."""
+        if self.bitset.borrowed:
+            ## Copy on write.
+            intBitSetOwnWords(self.bitset)
+            PyBuffer_Release(&self.borrowed_view)
+        elif self.bitset.shares:
+            intBitSetOwnWords(self.bitset)
+
+    # Buffer interface
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        """Export, read-only, the words holding the populated part of the
+        intbitset followed by a word of trailing bits, as unsigned 64 bits
+        integers in native byte order (i.e. bit i of word k is element
+        64 * k + i). The intbitset cannot be modified while exported."""
+        if flags & PyBUF_WRITABLE:
+            raise BufferError("intbitset buffers are read-only")
+        ## The words might be moved below, or replaced by an in-place
+        ## operation of another thread.
+        _wait_jobs(self, 1)
+        if self.bitset.offset:
+            ## The leading empty words, which are not allocated, are
+            ## exported too, which moves the words.
+            if self.exports:
+                raise BufferError("Existing exports of data: intbitset cannot be exported")
+            self._own_words()
+            intBitSetSetOffset(self.bitset, 0)
+        self.shape = intBitSetGetSize(self.bitset) + 1
+        buffer.buf = self.bitset.bitset
+        buffer.obj = self
+        buffer.len = self.shape * wordbytesize
+        buffer.readonly = 1
+        buffer.itemsize = wordbytesize
+        if flags & PyBUF_FORMAT:
+            buffer.format = b'Q'
+        else:
+            buffer.format = NULL
+        buffer.ndim = 1
+        buffer.shape = &self.shape if flags & PyBUF_ND else NULL
+        buffer.strides = &buffer.itemsize if flags & PyBUF_STRIDES == PyBUF_STRIDES else NULL
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+        self.exports += 1
+
+    def __releasebuffer__(self, Py_buffer *buffer):
+        self.exports -= 1
 
     def __contains__(self not None, int elem):
         if self.sanity_checks:
@@ -312,41 +1138,37 @@ cdef class intbitset:
         raise TypeError("cannot compare intbitset using cmp()")
 
     def __richcmp__(self not None, rhs, int op):
-        if not isinstance(self, intbitset) or not isinstance(rhs, intbitset):
-            return False
-        cdef short unsigned int tmp
-        tmp = intBitSetCmp((<intbitset>self).bitset, (<intbitset>rhs).bitset)
-        if op == 0: # <
-            return tmp == 1
-        if op == 1: # <=
-            return tmp <= 1
-        if op == 2: # ==
-            return tmp == 0
-        if op == 3: # !=
-            return tmp > 0
-        if op == 4: # >
-            return tmp == 2
-        if op == 5: # >=
-            return tmp in (0, 2)
+        return _richcmp(self, rhs, op)
 
     def __len__(self not None):
+        cdef unsigned long long version
+        cdef Py_ssize_t tot
+        if self.bitset.tot < 0 and not self.bitset.trailing_bits:
+            version = self.bitset.version
+            tot = _op_count(self, None, INTBITSET_OP_AND)
+            ## Unless another thread changed the content meanwhile.
+            if self.bitset.version == version:
+                self.bitset.tot = tot
+            return tot
         return intBitSetGetTot(self.bitset)
 
     def __hash__(self not None):
-        return hash(
-            PyBytes_FromStringAndSize(
-                <char *>self.bitset.bitset, 
-                wordbytesize * (intBitSetGetTot(self.bitset) / wordbitsize + 1)
-            )
-        )
+        return intBitSetHash(self.bitset)
 
     def __nonzero__(self not None):
         return not intBitSetEmpty(self.bitset)
 
+    def __sizeof__(self not None):
+        ## The words shared with clones are counted by each of them.
+        if self.bitset == NULL:
+            return object.__sizeof__(self)
+        return object.__sizeof__(self) + intBitSetGetMemory(self.bitset)
+
     def __deepcopy__(self not None, memo):
         return intbitset(self)
 
     def __delitem__(self not None, int elem):
+        self._prepare_write()
         if self.sanity_checks:
             if elem < 0:
                 raise ValueError("Negative numbers, not allowed")
@@ -356,6 +1178,7 @@ cdef class intbitset:
 
     def __iadd__(self not None, rhs):
         cdef int elem
+        self._prepare_write()
         if isinstance(rhs, (int, long)):
             if self.sanity_checks:
                 if rhs < 0:
@@ -364,8 +1187,8 @@ cdef class intbitset:
                     raise OverflowError("rhs must be <= %s" % maxelem)
             intBitSetAddElem(self.bitset, rhs)
         elif isinstance(rhs, intbitset):
-            intBitSetIUnion(self.bitset, (<intbitset> rhs).bitset)
-        else:
+            _iop(self, rhs, INTBITSET_OP_OR)
+        elif not _update_from_buffer(self.bitset, rhs, 0):
             if self.sanity_checks:
                 for elem in rhs:
                     if elem < 0:
@@ -385,6 +1208,7 @@ cdef class intbitset:
     def __isub__(self not None, rhs not None):
         """Remove all elements of another set from this set."""
         cdef int elem
+        self._prepare_write()
         if isinstance(rhs, (int, long)):
             if self.sanity_checks:
                 if rhs < 0:
@@ -393,8 +1217,8 @@ cdef class intbitset:
                     raise OverflowError("rhs must be <= %s" % maxelem)
             intBitSetDelElem(self.bitset, rhs)
         elif isinstance(rhs, intbitset):
-            intBitSetISub(self.bitset, (<intbitset> rhs).bitset)
-        else:
+            _iop(self, rhs, INTBITSET_OP_ANDNOT)
+        elif not _update_from_buffer(self.bitset, rhs, 1):
             if self.sanity_checks:
                 for elem in rhs:
                     if elem < 0:
@@ -407,70 +1231,74 @@ cdef class intbitset:
                     intBitSetDelElem(self.bitset, elem)
         return self
 
-    def __sub__(self not None, intbitset rhs not None):
+    def __sub__(self not None, rhs):
         """Return the difference of two intbitsets as a new set.
         (i.e. all elements that are in this intbitset but not the other.)
         """
-        cdef intbitset ret = intbitset(no_allocate=1)
-        (<intbitset>ret).bitset = intBitSetSub((<intbitset> self).bitset, rhs.bitset)
-        return ret
+        if not isinstance(rhs, intbitset):
+            ## e.g. an intbitset_expr, which builds the expression.
+            return NotImplemented
+        return _op(self, rhs, INTBITSET_OP_ANDNOT)
 
-    def __and__(self not None, intbitset rhs not None):
+    def __and__(self not None, rhs):
         """Return the intersection of two intbitsets as a new set.
         (i.e. all elements that are in both intbitsets.)
         """
-        cdef intbitset ret = intbitset(no_allocate=1)
-        (<intbitset>ret).bitset = intBitSetIntersection((<intbitset> self).bitset, rhs.bitset)
-        return ret
+        if not isinstance(rhs, intbitset):
+            return NotImplemented
+        return _op(self, rhs, INTBITSET_OP_AND)
 
     def __iand__(self not None, intbitset rhs not None):
         """Update a intbitset with the intersection of itself and another."""
-        intBitSetIIntersection(self.bitset, rhs.bitset)
+        self._prepare_write()
+        _iop(self, rhs, INTBITSET_OP_AND)
         return self
 
-    def __or__(self not None, intbitset rhs not None):
+    def __or__(self not None, rhs):
         """Return the union of two intbitsets as a new set.
         (i.e. all elements that are in either intbitsets.)
         """
-        cdef intbitset ret = intbitset(no_allocate=1)
-        (<intbitset>ret).bitset = intBitSetUnion((<intbitset> self).bitset, rhs.bitset)
-        return ret
+        if not isinstance(rhs, intbitset):
+            return NotImplemented
+        return _op(self, rhs, INTBITSET_OP_OR)
 
     def __ior__(self not None, intbitset rhs not None):
         """Update a intbitset with the union of itself and another."""
-        intBitSetIUnion(self.bitset, rhs.bitset)
+        self._prepare_write()
+        _iop(self, rhs, INTBITSET_OP_OR)
         return self
 
-    def __xor__(self not None, intbitset rhs not None):
+    def __xor__(self not None, rhs):
         """Return the symmetric difference of two sets as a new set.
         (i.e. all elements that are in exactly one of the sets.)
         """
-        cdef intbitset ret = intbitset(no_allocate=1)
-        (<intbitset>ret).bitset = intBitSetXor((<intbitset> self).bitset, rhs.bitset)
-        return ret
+        if not isinstance(rhs, intbitset):
+            return NotImplemented
+        return _op(self, rhs, INTBITSET_OP_XOR)
 
     def __ixor__(self not None, intbitset rhs not None):
         """Update an intbitset with the symmetric difference of itself and another.
         """
-        intBitSetIXor(self.bitset, rhs.bitset)
+        self._prepare_write()
+        _iop(self, rhs, INTBITSET_OP_XOR)
         return self
 
     def __repr__(self not None):
         finite_list = self.extract_finite_list()
         if self.bitset.trailing_bits:
-            return "intbitset(%s, trailing_bits=True)" % repr(finite_list)
+            return "%s(%s, trailing_bits=True)" % (type(self).__name__, repr(finite_list))
         else:
-            return "intbitset(%s)" % repr(finite_list)
+            return "%s(%s)" % (type(self).__name__, repr(finite_list))
 
     def __str__(self not None):
         cdef int tot
         tot = intBitSetGetTot(self.bitset)
         if tot < 0:
-            return "intbitset([...], trailing_bits=True)"
+            return "%s([...], trailing_bits=True)" % type(self).__name__
         elif tot > 10:
             begin_list = self[0:5]
             end_list = self[tot - 5:tot]
-            ret = "intbitset(["
+            ret = "%s([" % type(self).__name__
             for n in begin_list:
                 ret += '%i, ' % n
             ret += "..., "
@@ -484,7 +1312,6 @@ cdef class intbitset:
 
     def __getitem__(self not None, object key):
         cdef Py_ssize_t i
-        cdef int elem = -1
         cdef int start
         cdef int end
         cdef int step
@@ -494,18 +1321,20 @@ cdef class intbitset:
                 raise IndexError("negative indexes are not allowed on infinite intbitset")
             retset = intbitset()
             start, end, step = key.indices(intBitSetGetTot(self.bitset))
-            if step < 0:
-                raise ValueError("negative steps are not yet supported")
-            for i in range(start):
-                elem = intBitSetGetNext(self.bitset, elem)
-                if elem < 0:
+            if step == 1:
+                if start >= end:
                     return retset
-            for i in range(end - start):
-                elem = intBitSetGetNext(self.bitset, elem)
-                if elem < 0:
-                    return retset
-                if i % step == 0:
-                    retset.add(elem)
+                ## The slice is made of all the elements between its first
+                ## and its last one.
+                intBitSetDestroy(retset.bitset)
+                retset.bitset = intBitSetGetRange(
+                    self.bitset,
+                    intBitSetSelect(self.bitset, start),
+                    intBitSetSelect(self.bitset, end - 1),
+                )
+            else:
+                for i in range(start, end, step):
+                    intBitSetAddElem(retset.bitset, intBitSetSelect(self.bitset, i))
             return retset
         else:
             end = key
@@ -517,9 +1346,7 @@ cdef class intbitset:
                     raise IndexError("intbitset index out of range")
             if end >= intBitSetGetTot(self.bitset):
                 raise IndexError("intbitset index out of range")
-            for i in range(end + 1):
-                elem = intBitSetGetNext(self.bitset, elem)
-            return elem
+            return intBitSetSelect(self.bitset, end)
 
     # pickle interface
     def __reduce__(self not None):
@@ -533,10 +1360,49 @@ cdef class intbitset:
             raise OverflowError("It's impossible to iterate over an infinite set.")
         return intbitset_iterator(self)
 
+    def __reversed__(self not None):
+        if self.bitset.trailing_bits:
+            raise OverflowError("It's impossible to iterate over an infinite set.")
+        return intbitset_iterator(self, True)
+
+    def iter_chunks(self not None, int n):
+        """Iterate over the elements of the intbitset in ascending order, by
+        array('I') chunks of n elements (the last one may be shorter)."""
+        cdef int last = -1
+        cdef int count
+        cdef unsigned long long version
+        cdef unsigned long long start
+        cdef cpython.array.array chunk
+        if n <= 0:
+            raise ValueError("n must be positive")
+        if self.bitset.trailing_bits:
+            raise OverflowError("It's impossible to iterate over an infinite set.")
+        version = self.bitset.version
+        while True:
+            if self.bitset.version != version:
+                raise RuntimeError("intbitset changed during iteration")
+            intBitSetGetSize(self.bitset)
+            chunk = cpython.array.clone(_chunk_template, n, False)
+            if _profiling:
+                start = intBitSetNow()
+                count = intBitSetGetNextMany(self.bitset, last, chunk.data.as_uints, n)
+                _profile(_PROFILE_ITER_CHUNKS, start, (chunk.data.as_uints[count - 1] // wordbitsize - max(last, 0) // wordbitsize) if count else 0)
+            else:
+                count = intBitSetGetNextMany(self.bitset, last, chunk.data.as_uints, n)
+            if count == 0:
+                return
+            if count < n:
+                cpython.array.resize(chunk, count)
+            last = chunk.data.as_uints[count - 1]
+            yield chunk
+            if count < n:
+                return
+
     # Customized interface
     cpdef add(intbitset self, int elem):
         """Add an element to a set.
         This has no effect if the element is already present."""
+        self._prepare_write()
         if self.sanity_checks:
             if elem < 0:
                 raise ValueError("Negative numbers, not allowed")
@@ -545,12 +1411,14 @@ cdef class intbitset:
         intBitSetAddElem(self.bitset, elem)
 
     cpdef clear(intbitset self):
+        self._prepare_write()
         intBitSetReset(self.bitset)
 
 
     cpdef discard(intbitset self, int elem):
         """Remove an element from a intbitset if it is a member.
         If the element is not a member, do nothing."""
+        self._prepare_write()
         if self.sanity_checks:
             if elem < 0:
                 raise ValueError("Negative numbers, not allowed")
@@ -558,6 +1426,32 @@ cdef class intbitset:
                 raise OverflowError("Element must be <= %s" % maxelem)
         intBitSetDelElem(self.bitset, elem)
 
+    cpdef add_range(intbitset self, Py_ssize_t start, Py_ssize_t stop):
+        """Add the integers of range(start, stop) to the intbitset, a whole
+        word at a time."""
+        self._prepare_write()
+        _check_range(start, stop)
+        intBitSetAddRange(self.bitset, start, stop)
+
+    cpdef discard_range(intbitset self, Py_ssize_t start, Py_ssize_t stop):
+        """Remove the integers of range(start, stop) from the intbitset, a
+        whole word at a time."""
+        self._prepare_write()
+        _check_range(start, stop)
+        intBitSetDelRange(self.bitset, start, stop)
+
+    cpdef flip_range(intbitset self, Py_ssize_t start, Py_ssize_t stop):
+        """Add the integers of range(start, stop) which are not in the
+        intbitset, and remove the ones which are, a whole word at a time."""
+        self._prepare_write()
+        _check_range(start, stop)
+        intBitSetFlipRange(self.bitset, start, stop)
+
+    cpdef count_range(intbitset self, Py_ssize_t start, Py_ssize_t stop):
+        """Return the number of elements in range(start, stop)."""
+        _check_range(start, stop)
+        return intBitSetCountRange(self.bitset, start, stop)
+
     symmetric_difference = __xor__
     symmetric_difference_update = __ixor__
 
@@ -569,30 +1463,86 @@ cdef class intbitset:
         """Report whether this set contains another set."""
         return self.__ge__(rhs)
 
+    def expr(self not None):
+        """Return a lazy expression made of this intbitset, to be combined
+        with other intbitsets and expressions by |, &, ^, - and ~ without
+        computing anything until it is evaluated (see intbitset_expr), e.g.
+        (a.expr() | b | c) & d.expr() - e."""
+        return _expr_node(_EXPR_LEAF, None, None, self)
+
     # Dumping & Loading
-    cpdef fastdump(intbitset self):
+    cpdef fastdump(intbitset self, codec=None, int level=-1):
         """Return a compressed string representation suitable to be saved
-        somewhere."""
+        somewhere.
+
+        By default, this is the legacy representation. Otherwise it starts
+        with a header describing it, and codec is one of:
+
+        * ``'raw'``: not compressed, and usable in place by
+          intbitset.mmap() and intbitset.from_buffer().
+
+        * ``'zlib'``: compressed by zlib at the given level, from 0 to 9
+          (-1 being the zlib default).
+
+        * ``'rle'``: runs of empty and full words are encoded by their
+          length, which is much faster than zlib and compact for sparse
+          and dense sets.
+        """
+        cdef unsigned long long start
+        if _profiling:
+            start = intBitSetNow()
+            ret = self._fastdump(codec, level)
+            _profile(_PROFILE_FASTDUMP, start, intBitSetGetSize(self.bitset) + 1 - self.bitset.offset)
+            return ret
+        return self._fastdump(codec, level)
+
+    cdef object _fastdump(intbitset self, codec, int level):
         cdef Py_ssize_t size
-        size = intBitSetGetSize((<intbitset> self).bitset)
-        tmp = PyBytes_FromStringAndSize(<char *>self.bitset.bitset, ( size + 1) * wordbytesize)
-        return zlib.compress(tmp)
+        cdef int offset = self.bitset.offset
+        ## Only the words from the offset on are dumped, but for the legacy
+        ## representation.
+        size = intBitSetGetSize((<intbitset> self).bitset) - offset
+        if codec == 'rle':
+            tmp = _rle_encode(self.bitset.bitset, size + 1)
+        else:
+            tmp = PyBytes_FromStringAndSize(<char *>self.bitset.bitset, ( size + 1) * wordbytesize)
+        if codec is None:
+            return zlib.compress(bytes(offset * wordbytesize) + tmp)
+        if codec not in _DUMP_CODECS:
+            raise ValueError("codec must be one of %s" % ', '.join(_DUMP_CODECS))
+        if codec == 'zlib':
+            if not -1 <= level <= 9:
+                raise ValueError("level must be between -1 and 9")
+            tmp = zlib.compress(tmp, level)
+        header = _DUMP_HEADER.pack(
+            _DUMP_MAGIC, _DUMP_VERSIONS[offset > 0], _DUMP_CODECS.index(codec), wordbytesize,
+            sys.byteorder == 'big', offset, size + 1, intBitSetGetTot(self.bitset),
+        )
+        return header + tmp
 
     cpdef fastload(intbitset self, strdump):
         """Load a compressed string representation produced by a previous call
         to the fastdump method into the current intbitset. The previous content
         will be replaced."""
+        cdef unsigned long long start
+        if _profiling:
+            start = intBitSetNow()
+            self._fastload(strdump)
+            _profile(_PROFILE_FASTLOAD, start, intBitSetGetAllocated(self.bitset) - self.bitset.offset)
+        else:
+            self._fastload(strdump)
+
+    cdef int _fastload(intbitset self, strdump) except -1:
         cdef Py_ssize_t size
         cdef const_void_ptr buf
         cdef Py_buffer view
 
+        self._prepare_write()
         buf = NULL
         size = 0
         try:
-            if type(strdump) is array:
-                strdump = strdump.tostring()
             # tmp needed to not be garbage collected
-            tmp = zlib.decompress(strdump)
+            tmp, offset = _decode_dump(strdump)
 
             if PyObject_GetBuffer(tmp, &view, PyBUF_SIMPLE) != 0:
                 raise ValueError("Unable to get buffer")
@@ -605,12 +1555,13 @@ cdef class intbitset:
                     ## Wrong size!
                     raise Exception()
 
-                intBitSetResetFromBuffer((<intbitset> self).bitset, buf, size)
+                intBitSetResetFromBuffer((<intbitset> self).bitset, buf, size, offset)
             finally:
                 PyBuffer_Release(&view)
 
         except:
             raise ValueError("strdump is corrupted")
+        return 0
 
     cpdef copy(intbitset self):
         """Return a shallow copy of a set."""
@@ -623,6 +1574,7 @@ cdef class intbitset:
             implementation by guaranteeing returning always the largest element.
         """
         cdef int ret
+        self._prepare_write()
         ret = intBitSetGetLast(self.bitset)
         if ret < 0:
             raise KeyError("pop from an empty or infinite intbitset")
@@ -633,6 +1585,7 @@ cdef class intbitset:
         """Remove an element from a set; it must be a member.
         If the element is not a member, raise a KeyError.
         """
+        self._prepare_write()
         if self.sanity_checks:
             if elem < 0:
                 raise ValueError("Negative numbers, not allowed")
@@ -660,62 +1613,186 @@ cdef class intbitset:
 
     def update(self not None, *args):
         """Update the intbitset, adding elements from all others."""
-        cdef intbitset iarg
-        for arg in args:
-            iarg = arg if hasattr(arg, "bitset") else intbitset(arg)
-            intBitSetIUnion(self.bitset, iarg.bitset)
+        self._prepare_write()
+        if len(args) == 1 and isinstance(args[0], intbitset):
+            _iop(self, args[0], INTBITSET_OP_OR)
+        elif len(args) == 1 and _update_from_buffer(self.bitset, args[0], 0):
+            pass
+        elif args:
+            _icombine_many(self, args, 0)
 
     union_update = update
 
     def intersection_update(self not None, *args):
         """Update the intbitset, keeping only elements found in it and all others."""
-        cdef intbitset iarg
-        for arg in args:
-            iarg = arg if hasattr(arg, "bitset") else intbitset(arg)
-            intBitSetIIntersection(self.bitset, iarg.bitset)
+        self._prepare_write()
+        if len(args) == 1 and isinstance(args[0], intbitset):
+            _iop(self, args[0], INTBITSET_OP_AND)
+        elif args:
+            _icombine_many(self, args, 1)
 
     def difference_update(self not None, *args):
         """Update the intbitset, removing elements found in others."""
         cdef intbitset iarg
+        self._prepare_write()
         for arg in args:
-            iarg = arg if hasattr(arg, "bitset") else intbitset(arg)
-            intBitSetISub(self.bitset, iarg.bitset)
+            ## Other threads might have read or shared the words while the
+            ## previous args were handled.
+            self._prepare_write()
+            if isinstance(arg, intbitset):
+                _iop(self, arg, INTBITSET_OP_ANDNOT)
+            elif not _update_from_buffer(self.bitset, arg, 1):
+                iarg = intbitset(arg)
+                _iop(self, iarg, INTBITSET_OP_ANDNOT)
 
     def union(self not None, *args):
         """Return a new intbitset with elements from the intbitset and all others."""
-        cdef intbitset ret = intbitset(self)
-        cdef intbitset iarg
-        for arg in args:
-            iarg = arg if hasattr(arg, "bitset") else intbitset(arg)
-            intBitSetIUnion(ret.bitset, iarg.bitset)
+        cdef intbitset ret = _new_like(self)
+        ret.bitset = _combine_many(self, args, 0)
         return ret
 
     def intersection(self not None, *args):
         """Return a new intbitset with elements common to the intbitset and all others."""
-        cdef intbitset ret = intbitset(self)
-        cdef intbitset iarg
-        for arg in args:
-            iarg = arg if hasattr(arg, "bitset") else intbitset(arg)
-            intBitSetIIntersection(ret.bitset, iarg.bitset)
+        cdef intbitset ret = _new_like(self)
+        ret.bitset = _combine_many(self, args, 1)
         return ret
 
     def difference(self not None, *args):
         """Return a new intbitset with elements from the intbitset that are not in the others."""
-        cdef intbitset ret = intbitset(self)
+        cdef intbitset ret = None
         cdef intbitset iarg
         for arg in args:
-            iarg = arg if hasattr(arg, "bitset") else intbitset(arg)
-            intBitSetISub(ret.bitset, iarg.bitset)
+            iarg = arg if isinstance(arg, intbitset) else intbitset(arg)
+            if ret is None:
+                ret = _op(self, iarg, INTBITSET_OP_ANDNOT)
+            else:
+                _iop(ret, iarg, INTBITSET_OP_ANDNOT)
+        if ret is None:
+            return self.copy()
         return ret
 
     def isdisjoint(self not None, intbitset rhs not None):
         """Return True if two intbitsets have a null intersection."""
         return intBitSetIsDisjoint(self.bitset, rhs.bitset)
 
+    def intersection_count(self not None, intbitset rhs not None):
+        """Return len(self & rhs), without building the intersection."""
+        cdef Py_ssize_t ret = _op_count(self, rhs, INTBITSET_OP_AND)
+        if ret < 0:
+            raise OverflowError("It's impossible to count the elements of an infinite set")
+        return ret
+
+    def union_count(self not None, intbitset rhs not None):
+        """Return len(self | rhs), without building the union."""
+        cdef Py_ssize_t ret = _op_count(self, rhs, INTBITSET_OP_OR)
+        if ret < 0:
+            raise OverflowError("It's impossible to count the elements of an infinite set")
+        return ret
+
+    def difference_count(self not None, intbitset rhs not None):
+        """Return len(self - rhs), without building the difference."""
+        cdef Py_ssize_t ret = _op_count(self, rhs, INTBITSET_OP_ANDNOT)
+        if ret < 0:
+            raise OverflowError("It's impossible to count the elements of an infinite set")
+        return ret
+
+    def symmetric_difference_count(self not None, intbitset rhs not None):
+        """Return len(self ^ rhs), without building the symmetric difference."""
+        cdef Py_ssize_t ret = _op_count(self, rhs, INTBITSET_OP_XOR)
+        if ret < 0:
+            raise OverflowError("It's impossible to count the elements of an infinite set")
+        return ret
+
+    def jaccard(self not None, intbitset rhs not None):
+        """Return the Jaccard similarity of two intbitsets, i.e.
+        len(self & rhs) / len(self | rhs), without building either set.
+        Two empty intbitsets are identical, so their similarity is 1.0."""
+        cdef Py_ssize_t intersection = _op_count(self, rhs, INTBITSET_OP_AND)
+        cdef Py_ssize_t union
+        if intersection < 0:
+            raise OverflowError("It's impossible to count the elements of an infinite set")
+        if self.bitset.trailing_bits or rhs.bitset.trailing_bits:
+            return 0.0
+        ## The cardinalities are cached, so this is cheaper than a second pass.
+        union = len(self) + len(rhs) - intersection
+        if union == 0:
+            return 1.0
+        return <double>intersection / union
+
+    def rank(self not None, int elem):
+        """Return the number of elements of the intbitset smaller than or
+        equal to elem, so that s[s.rank(elem) - 1] == elem for any element of
+        s."""
+        if self.sanity_checks:
+            if elem < 0:
+                raise ValueError("Negative numbers, not allowed")
+            elif elem > maxelem:
+                raise OverflowError("Element must be <= %s" % maxelem)
+        return intBitSetRank(self.bitset, elem)
+
+    def select(self not None, Py_ssize_t k):
+        """Return the element of the intbitset having k smaller elements, i.e.
+        s[k], also for infinite intbitsets. Raise IndexError if there is no
+        such element."""
+        cdef int elem = intBitSetSelect(self.bitset, k)
+        if elem < 0:
+            raise IndexError("intbitset index out of range")
+        return elem
+
+    def min(self not None):
+        """Return the smallest element of the intbitset. Raise ValueError if
+        it is empty."""
+        cdef int elem
+        intBitSetGetSize(self.bitset)
+        elem = intBitSetGetNext(self.bitset, -1)
+        if elem < 0:
+            raise ValueError("min() of an empty intbitset")
+        return elem
+
+    def max(self not None):
+        """Return the biggest element of the intbitset. Raise ValueError if
+        it is empty, and OverflowError if it is infinite."""
+        cdef int elem
+        if self.bitset.trailing_bits:
+            raise OverflowError("It's impossible to find the biggest element of an infinite set")
+        intBitSetGetSize(self.bitset)
+        elem = intBitSetGetLast(self.bitset)
+        if elem < 0:
+            raise ValueError("max() of an empty intbitset")
+        return elem
+
+    def next_above(self not None, int elem):
+        """Return the smallest element of the intbitset bigger than elem, or
+        None if there is none. Together with prev_below(), this lets one page
+        through the elements from any of them on, a whole word at a time."""
+        if self.sanity_checks:
+            if elem < 0:
+                raise ValueError("Negative numbers, not allowed")
+            elif elem > maxelem:
+                raise OverflowError("Element must be <= %s" % maxelem)
+        if elem == maxelem:
+            return None
+        intBitSetGetSize(self.bitset)
+        elem = intBitSetGetNext(self.bitset, elem)
+        return elem if elem >= 0 else None
+
+    def prev_below(self not None, int elem):
+        """Return the biggest element of the intbitset smaller than elem, or
+        None if there is none."""
+        if self.sanity_checks:
+            if elem < 0:
+                raise ValueError("Negative numbers, not allowed")
+            elif elem > maxelem:
+                raise OverflowError("Element must be <= %s" % maxelem)
+        intBitSetGetSize(self.bitset)
+        elem = intBitSetGetPrev(self.bitset, elem)
+        return elem if elem >= 0 else None
+
     cpdef update_with_signs(intbitset self, rhs):
         """Given a dictionary rhs whose keys are integers, remove all the integers
         whose value are less than 0 and add every integer whose value is 0 or more"""
         cdef int value
+        self._prepare_write()
         try:
             if self.sanity_checks:
                 for value, sign in rhs.iteritems():
@@ -742,6 +1819,23 @@ cdef class intbitset:
     cpdef get_allocated(intbitset self):
         return intBitSetGetAllocated(self.bitset)
 
+    cpdef get_version(intbitset self):
+        """Return the modification counter of the intbitset, which starts at 0
+        and is incremented by every method and in-place operator changing its
+        content, so that (id(x), x.get_version()) identifies the content of x
+        as long as x is alive (see intbitset_cache)."""
+        return self.bitset.version
+
+    def compact(self not None):
+        """Free the memory allocated beyond the populated words, so that
+        get_allocated() == get_size() + 1, e.g. after removing the biggest
+        elements or preallocating too much. Words shared with clones are
+        left as they are."""
+        _wait_jobs(self, 1)
+        if self.exports:
+            raise BufferError("Existing exports of data: intbitset cannot be modified")
+        intBitSetCompact(self.bitset)
+
     cpdef is_infinite(intbitset self):
         """Return True if the intbitset is infinite. (i.e. trailing_bits=True
         was used in the constructor.)"""
@@ -781,33 +1875,548 @@ cdef class intbitset:
             raise OverflowError("It's impossible to retrieve a list of an infinite set")
         return self.extract_finite_list()
 
+    def to_array(self not None):
+        """Return the elements of the intbitset, in ascending order, as an
+        array('I')."""
+        cdef int tot = intBitSetGetTot(self.bitset)
+        cdef cpython.array.array ret
+        if tot < 0:
+            raise OverflowError("It's impossible to retrieve a list of an infinite set")
+        ret = cpython.array.clone(_chunk_template, tot, False)
+        intBitSetGetNextMany(self.bitset, -1, ret.data.as_uints, tot)
+        return ret
+
+    def to_numpy(self not None):
+        """Return the elements of the intbitset, in ascending order, as a
+        NumPy uint32 array."""
+        import numpy
+        return numpy.frombuffer(self.to_array(), dtype=numpy.uint32)
+
+    def filter(self not None, values, bint keep_order=True):
+        """Return, as an array('I'), the values which are elements of the
+        intbitset. values is a contiguous buffer of integers, such as an
+        array('I') or a NumPy integer array, or else an iterable of integers.
+        If keep_order, the values are returned in their order, duplicates
+        included, otherwise in ascending order without duplicates.
+
+        No intbitset is built from the values, which are probed one by one
+        or, if they are sorted and far more numerous than the elements in
+        their span, galloped over from one element to the next."""
+        cdef Py_buffer view
+        cdef bint is_signed
+        cdef Py_ssize_t n
+        cdef cpython.array.array ret
+        if not _get_indices_buffer(values, &view, &is_signed):
+            values = array('q', values)
+            _get_indices_buffer(values, &view, &is_signed)
+        try:
+            n = view.len // view.itemsize
+            ret = cpython.array.clone(_chunk_template, n, False)
+            n = intBitSetFilterIndices(self.bitset, view.buf, n, view.itemsize, is_signed, not keep_order, ret.data.as_uints)
+        finally:
+            PyBuffer_Release(&view)
+        if n < 0:
+            raise TypeError("Unsupported integer size: %s" % view.itemsize)
+        cpython.array.resize(ret, n)
+        return ret
+
+    def contains_many(self not None, values):
+        """Return, as bytes, whether each of the values is an element of the
+        intbitset (1) or not (0), e.g. for numpy.frombuffer(mask,
+        dtype=bool). values is a contiguous buffer of integers, such as an
+        array('I') or a NumPy integer array, or else an iterable of integers.
+        Negative values and values bigger than maxelem are not elements."""
+        cdef Py_buffer view
+        cdef bint is_signed
+        cdef Py_ssize_t n
+        if not _get_indices_buffer(values, &view, &is_signed):
+            values = array('q', values)
+            _get_indices_buffer(values, &view, &is_signed)
+        try:
+            n = view.len // view.itemsize
+            ret = PyBytes_FromStringAndSize(NULL, n)
+            n = intBitSetContainsIndices(self.bitset, view.buf, n, view.itemsize, is_signed, <unsigned char *> PyBytes_AS_STRING(ret))
+        finally:
+            PyBuffer_Release(&view)
+        if n < 0:
+            raise TypeError("Unsupported integer size: %s" % view.itemsize)
+        return ret
+
+    def count_contained(self not None, values):
+        """Return how many of the values are elements of the intbitset (see
+        contains_many())."""
+        cdef Py_buffer view
+        cdef bint is_signed
+        cdef Py_ssize_t n
+        if not _get_indices_buffer(values, &view, &is_signed):
+            values = array('q', values)
+            _get_indices_buffer(values, &view, &is_signed)
+        try:
+            n = intBitSetContainsIndices(self.bitset, view.buf, view.len // view.itemsize, view.itemsize, is_signed, NULL)
+        finally:
+            PyBuffer_Release(&view)
+        if n < 0:
+            raise TypeError("Unsupported integer size: %s" % view.itemsize)
+        return n
+
+    def intersect_sorted(self not None, values):
+        """Return, as an array('I'), the values which are elements of the
+        intbitset, in ascending order without duplicates. values is expected
+        to be sorted, e.g. a list of ids out of another index, and is
+        otherwise sorted first (see filter())."""
+        return self.filter(values, keep_order=False)
+
+    @classmethod
+    def from_buffer(cls, buf, bint readonly=True):
+        """Return an intbitset loaded from buf, any bytes-like object holding
+        a dump. If readonly and buf holds a dump made with codec='raw' on a
+        machine with the same byte order, the intbitset reads the words in
+        buf instead of copying them, until it is first modified: buf must not
+        change in the meantime."""
+        cdef intbitset ret
+        cdef Py_ssize_t nwords
+        cdef int offset
+        cdef Py_ssize_t header_size = _DUMP_HEADER.size
+        header = _parse_dump_header(buf) if readonly else None
+        if header is not None and header[0] == _DUMP_CODECS.index('raw') and not header[2]:
+            nwords = header[1]
+            offset = header[3]
+            ret = cls(no_allocate=1)
+            PyObject_GetBuffer(buf, &ret.borrowed_view, PyBUF_SIMPLE)
+            if (ret.borrowed_view.len == header_size + nwords * wordbytesize
+                    and (<size_t>ret.borrowed_view.buf + header_size) % wordbytesize == 0):
+                ret.bitset = intBitSetCreateFromWords(
+                    <word_t *>(<char *>ret.borrowed_view.buf + header_size), nwords, offset)
+                return ret
+            ## Not usable in place: copy it.
+            PyBuffer_Release(&ret.borrowed_view)
+        return cls(bytes(buf))
+
+    @classmethod
+    def mmap(cls, path):
+        """Return an intbitset reading in place the dump made with
+        codec='raw' stored in the file at path, which is mapped in memory:
+        its pages are shared with the other processes mapping it, and only
+        copied when the intbitset is first modified. The file must not
+        change in the meantime."""
+        import mmap
+        with open(path, 'rb') as dump:
+            mapping = mmap.mmap(dump.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(mapping)
+
+    @classmethod
+    def from_range(cls, start, stop):
+        """Return an intbitset holding the integers of range(start, stop)."""
+        cdef intbitset ret = cls()
+        _check_range(start, stop)
+        intBitSetAddRange(ret.bitset, start, stop)
+        return ret
+
+    @classmethod
+    def from_indices(cls, indices):
+        """Return an intbitset holding the integers of indices, any
+        contiguous buffer of integers such as an array('I') or a NumPy uint32
+        or int64 array."""
+        cdef intbitset ret = cls()
+        if not _update_from_buffer(ret.bitset, indices, 0):
+            raise TypeError("a contiguous buffer of integers is needed")
+        return ret
+
     cdef object __weakref__
 
+cdef class frozenintbitset(intbitset):
+    """
+    Defines an immutable, and hashable, intbitset, which is to intbitset
+    what frozenset is to set.
+
+    The constructor accepts the same parameters as the intbitset one. As
+    any clone, a frozenintbitset built from an intbitset shares its words,
+    which the intbitset copies when it is first modified.
+
+    Set operations return a frozenintbitset when their first operand is
+    one, and in-place operators return a new frozenintbitset. The hash
+    covers the whole content and is computed once, as are the cardinality
+    and the size.
+    """
+    cdef Py_hash_t hash
+
+    def __cinit__(self, *args, **kwargs):
+        self.hash = -1
+
+    cdef int _prepare_write(self) except -1:
+        raise TypeError("frozenintbitset objects cannot be modified")
+
+    def __richcmp__(self not None, rhs, int op):
+        return _richcmp(self, rhs, op)
+
+    def __hash__(self not None):
+        if self.hash == -1:
+            self.hash = intBitSetHash(self.bitset)
+        return self.hash
+
+    def __reduce__(self not None):
+        return frozenintbitset, (self.fastdump(),)
+
+    def __copy__(self not None):
+        return self
+
+    def __deepcopy__(self not None, memo):
+        return self
+
+    cpdef copy(frozenintbitset self):
+        """Return the frozenintbitset itself, as it cannot change."""
+        return self
+
+    def __iadd__(self not None, rhs):
+        cdef intbitset ret = intbitset(self)
+        ret += rhs
+        return frozenintbitset(ret)
+
+    def __isub__(self not None, rhs not None):
+        cdef intbitset ret = intbitset(self)
+        ret -= rhs
+        return frozenintbitset(ret)
+
+    def __iand__(self not None, intbitset rhs not None):
+        return self & rhs
+
+    def __ior__(self not None, intbitset rhs not None):
+        return self | rhs
+
+    def __ixor__(self not None, intbitset rhs not None):
+        return self ^ rhs
+
+## Codes of the nodes of an intbitset_expr which are not binary operations.
+cdef enum:
+    _EXPR_LEAF = -1
+    _EXPR_NOT = -2
+    _EXPR_EMPTY = -3
+    _EXPR_FULL = -4
+
+_EXPR_SYMBOLS = {INTBITSET_OP_AND: '&', INTBITSET_OP_OR: '|', INTBITSET_OP_XOR: '^', INTBITSET_OP_ANDNOT: '-'}
+
+cdef class intbitset_expr:
+    """A lazy boolean expression on intbitsets, built by intbitset.expr() and
+    the operators |, &, ^, - and ~ (the complement, which is infinite for a
+    finite operand). Nothing is computed until evaluate(), count() or
+    first() is called: the expression is then simplified, and evaluated
+    word by word in a single pass over its operands, as they are at that
+    time, without allocating any intermediate result. As for the other set
+    operations, big evaluations release the GIL and are split across
+    threads (see set_num_threads())."""
+    cdef int op
+    cdef intbitset_expr left
+    cdef intbitset_expr right
+    cdef intbitset leaf
+
+    def __and__(self, other):
+        return _expr_binary(self, other, INTBITSET_OP_AND)
+
+    def __rand__(self, other):
+        return _expr_binary(other, self, INTBITSET_OP_AND)
+
+    def __or__(self, other):
+        return _expr_binary(self, other, INTBITSET_OP_OR)
+
+    def __ror__(self, other):
+        return _expr_binary(other, self, INTBITSET_OP_OR)
+
+    def __xor__(self, other):
+        return _expr_binary(self, other, INTBITSET_OP_XOR)
+
+    def __rxor__(self, other):
+        return _expr_binary(other, self, INTBITSET_OP_XOR)
+
+    def __sub__(self, other):
+        return _expr_binary(self, other, INTBITSET_OP_ANDNOT)
+
+    def __rsub__(self, other):
+        return _expr_binary(other, self, INTBITSET_OP_ANDNOT)
+
+    def __invert__(self):
+        return _expr_node(_EXPR_NOT, self, None, None)
+
+    def __repr__(self):
+        return "intbitset_expr(%s)" % _expr_str(self)
+
+    def evaluate(self):
+        """Return the intbitset the expression evaluates to."""
+        cdef intbitset_expr node = _expr_simplify(self)
+        cdef IntBitSetJob job
+        cdef intbitset ret
+        if node.op == _EXPR_EMPTY:
+            return intbitset()
+        if node.op == _EXPR_FULL:
+            return intbitset(trailing_bits=True)
+        if node.op == _EXPR_LEAF:
+            return intbitset(node.leaf)
+        leaves, program = _expr_compile(node)
+        ret = intbitset(no_allocate=1)
+        _expr_prepare(leaves, program, &job, &ret.bitset)
+        try:
+            _run(&job, None, None, leaves)
+        finally:
+            intBitSetJobDone(&job)
+        return ret
+
+    def count(self):
+        """Return the number of elements of the intbitset the expression
+        evaluates to, without building it."""
+        cdef intbitset_expr node = _expr_simplify(self)
+        cdef IntBitSetJob job
+        if node.op == _EXPR_EMPTY:
+            return 0
+        if node.op != _EXPR_FULL:
+            leaves, program = _expr_compile(node)
+            if _expr_prepare(leaves, program, &job, NULL):
+                try:
+                    return _run(&job, None, None, leaves)
+                finally:
+                    intBitSetJobDone(&job)
+            intBitSetJobDone(&job)
+        raise OverflowError("It's impossible to count the elements of an infinite set")
+
+    def first(self, int k):
+        """Return a list of the k smallest elements (or fewer, if there are
+        not as many) of the intbitset the expression evaluates to, which is
+        only evaluated up to the word holding the last of them."""
+        cdef intbitset_expr node
+        cdef IntBitSetJob job
+        cdef cpython.array.array ret
+        cdef int count = 0
+        cdef int found
+        cdef unsigned long long start = 0
+        if k < 0:
+            raise ValueError("k must not be negative")
+        node = _expr_simplify(self)
+        if node.op == _EXPR_EMPTY:
+            return []
+        if node.op == _EXPR_FULL:
+            return list(range(min(k, <Py_ssize_t>maxelem + 1)))
+        leaves, program = _expr_compile(node)
+        _expr_prepare(leaves, program, &job, NULL)
+        try:
+            ## The elements are looked for by chunks, doubling as long as
+            ## they are found, rather than k at once, so that a big k does
+            ## not allocate more than the result.
+            ret = cpython.array.clone(_chunk_template, min(k, _expr_first_chunk), False)
+            if _profiling:
+                start = intBitSetNow()
+            while True:
+                found = intBitSetExprFirst(&job, ret.data.as_uints + count, len(ret) - count, ret.data.as_uints[count - 1] if count > 0 else -1)
+                count += found
+                if count < len(ret) or count == k:
+                    break
+                cpython.array.resize(ret, min(k, 2 * <Py_ssize_t> count))
+            if _profiling:
+                _profile(_PROFILE_EXPR_FIRST, start, (ret.data.as_uints[count - 1] // wordbitsize + 1) * len(leaves) if count > 0 else 0)
+        finally:
+            intBitSetJobDone(&job)
+        cpython.array.resize(ret, count)
+        return ret.tolist()
+
+cdef intbitset_expr _expr_node(int op, intbitset_expr left, intbitset_expr right, intbitset leaf):
+    cdef intbitset_expr ret = intbitset_expr.__new__(intbitset_expr)
+    ret.op = op
+    ret.left = left
+    ret.right = right
+    ret.leaf = leaf
+    return ret
+
+cdef object _expr_binary(x, y, int op):
+    """Return the expression x op y, x and y being expressions or
+    intbitsets."""
+    if isinstance(x, intbitset):
+        x = _expr_node(_EXPR_LEAF, None, None, x)
+    if isinstance(y, intbitset):
+        y = _expr_node(_EXPR_LEAF, None, None, y)
+    if not isinstance(x, intbitset_expr) or not isinstance(y, intbitset_expr):
+        return NotImplemented
+    return _expr_node(op, x, y, None)
+
+cdef str _expr_str(intbitset_expr node):
+    if node.op == _EXPR_LEAF:
+        return str(node.leaf)
+    if node.op == _EXPR_NOT:
+        return "~%s" % _expr_str(node.left)
+    if node.op == _EXPR_EMPTY:
+        return "intbitset()"
+    if node.op == _EXPR_FULL:
+        return "intbitset(trailing_bits=True)"
+    return "(%s %s %s)" % (_expr_str(node.left), _EXPR_SYMBOLS[node.op], _expr_str(node.right))
+
+cdef intbitset_expr _expr_simplify(intbitset_expr node):
+    """Return node without the empty and full operands, which are folded,
+    and with its complements pushed down to its leaves (De Morgan), where
+    they are folded into differences where possible."""
+    cdef IntBitSet *bitset
+    cdef Py_ssize_t end
+    if node.op == _EXPR_LEAF:
+        bitset = node.leaf.bitset
+        if not bitset.trailing_bits:
+            if intBitSetEmpty(bitset):
+                return _expr_node(_EXPR_EMPTY, None, None, None)
+        else:
+            end = <Py_ssize_t>intBitSetGetSize(bitset) * wordbitsize
+            if intBitSetCountRange(bitset, 0, end) == end:
+                return _expr_node(_EXPR_FULL, None, None, None)
+        return node
+    if node.op == _EXPR_NOT:
+        return _expr_not(_expr_simplify(node.left))
+    return _expr_combine(node.op, _expr_simplify(node.left), _expr_simplify(node.right))
+
+cdef intbitset_expr _expr_not(intbitset_expr x):
+    """Return the simplified complement of x, which is simplified."""
+    if x.op == _EXPR_EMPTY:
+        return _expr_node(_EXPR_FULL, None, None, None)
+    if x.op == _EXPR_FULL:
+        return _expr_node(_EXPR_EMPTY, None, None, None)
+    if x.op == _EXPR_NOT:
+        return x.left
+    if x.op == INTBITSET_OP_AND:
+        return _expr_combine(INTBITSET_OP_OR, _expr_not(x.left), _expr_not(x.right))
+    if x.op == INTBITSET_OP_OR:
+        return _expr_combine(INTBITSET_OP_AND, _expr_not(x.left), _expr_not(x.right))
+    if x.op == INTBITSET_OP_ANDNOT:
+        return _expr_combine(INTBITSET_OP_OR, _expr_not(x.left), x.right)
+    if x.op == INTBITSET_OP_XOR:
+        return _expr_combine(INTBITSET_OP_XOR, _expr_not(x.left), x.right)
+    return _expr_node(_EXPR_NOT, x, None, None)
+
+cdef bint _expr_same(intbitset_expr x, intbitset_expr y):
+    return x is y or (x.op == _EXPR_LEAF and y.op == _EXPR_LEAF and x.leaf is y.leaf)
+
+cdef intbitset_expr _expr_combine(int op, intbitset_expr x, intbitset_expr y):
+    """Return the simplified x op y, x and y being simplified."""
+    if op == INTBITSET_OP_AND:
+        if x.op == _EXPR_EMPTY or y.op == _EXPR_FULL or _expr_same(x, y):
+            return x
+        if y.op == _EXPR_EMPTY or x.op == _EXPR_FULL:
+            return y
+        if y.op == _EXPR_NOT:
+            return _expr_combine(INTBITSET_OP_ANDNOT, x, y.left)
+        if x.op == _EXPR_NOT:
+            return _expr_combine(INTBITSET_OP_ANDNOT, y, x.left)
+    elif op == INTBITSET_OP_OR:
+        if x.op == _EXPR_FULL or y.op == _EXPR_EMPTY or _expr_same(x, y):
+            return x
+        if y.op == _EXPR_FULL or x.op == _EXPR_EMPTY:
+            return y
+    elif op == INTBITSET_OP_XOR:
+        if _expr_same(x, y):
+            return _expr_node(_EXPR_EMPTY, None, None, None)
+        if y.op == _EXPR_EMPTY:
+            return x
+        if x.op == _EXPR_EMPTY:
+            return y
+        if y.op == _EXPR_FULL:
+            return _expr_not(x)
+        if x.op == _EXPR_FULL:
+            return _expr_not(y)
+        if x.op == _EXPR_NOT and y.op == _EXPR_NOT:
+            return _expr_combine(INTBITSET_OP_XOR, x.left, y.left)
+    else:
+        if x.op == _EXPR_EMPTY or y.op == _EXPR_FULL or _expr_same(x, y):
+            return _expr_node(_EXPR_EMPTY, None, None, None)
+        if y.op == _EXPR_EMPTY:
+            return x
+        if x.op == _EXPR_FULL:
+            return _expr_not(y)
+        if y.op == _EXPR_NOT:
+            return _expr_combine(INTBITSET_OP_AND, x, y.left)
+    return _expr_node(op, x, y, None)
+
+cdef tuple _expr_code(intbitset_expr node, list leaves, dict indices):
+    """Return the program evaluating node, a simplified expression without
+    empty or full operands, and the number of stack entries it needs. The
+    operand needing the most entries of a commutative operation comes
+    first, and a leaf last, to be combined right away with the other one."""
+    if node.op == _EXPR_LEAF:
+        if id(node.leaf) not in indices:
+            indices[id(node.leaf)] = len(leaves)
+            leaves.append(node.leaf)
+        return [indices[id(node.leaf)]], 1
+    if node.op == _EXPR_NOT:
+        program, depth = _expr_code(node.left, leaves, indices)
+        return program + [INTBITSET_EXPR_NOT], depth
+    left, left_depth = _expr_code(node.left, leaves, indices)
+    right, right_depth = _expr_code(node.right, leaves, indices)
+    if node.op != INTBITSET_OP_ANDNOT and node.right.op != _EXPR_LEAF and (node.left.op == _EXPR_LEAF or right_depth > left_depth):
+        left, left_depth, right, right_depth = right, right_depth, left, left_depth
+    if len(right) == 1:
+        return left + right + [-1 - node.op], left_depth
+    return left + right + [-1 - node.op], max(left_depth, right_depth + 1)
+
+cdef tuple _expr_compile(intbitset_expr node):
+    """Return the intbitsets node reads and its program, as an array('i')."""
+    cdef list leaves = []
+    program, depth = _expr_code(node, leaves, {})
+    if depth > INTBITSET_EXPR_DEPTH:
+        raise ValueError("intbitset_expr too deeply nested")
+    return leaves, array('i', program)
+
+cdef int _expr_prepare(list leaves, cpython.array.array program, IntBitSetJob *job, IntBitSet **ret) except -1:
+    """Set up job to evaluate program on leaves into ret[0] if ret is not
+    NULL, or else to count its elements. Return False if the result is
+    infinite."""
+    cdef IntBitSet **bitsets
+    cdef Py_ssize_t i
+    cdef bint finite = True
+    for leaf in leaves:
+        _wait_writers(leaf)
+    bitsets = <IntBitSet **>PyMem_Malloc(len(leaves) * sizeof(IntBitSet *))
+    if bitsets == NULL:
+        raise MemoryError()
+    for i in range(len(leaves)):
+        bitsets[i] = (<intbitset>leaves[i]).bitset
+    if ret != NULL:
+        ret[0] = intBitSetExprPrepare(bitsets, len(leaves), program.data.as_ints, len(program), job)
+    else:
+        finite = intBitSetExprCountPrepare(bitsets, len(leaves), program.data.as_ints, len(program), job)
+    PyMem_Free(bitsets)
+    return finite
+
 cdef class intbitset_iterator:
     cdef int last
-    cdef IntBitSet *bitset
+    cdef intbitset owner
+    cdef unsigned long long version
     cdef bint sanity_checks
+    cdef bint reverse
 
-    def __cinit__(intbitset_iterator self, intbitset bitset not None):
+    def __cinit__(intbitset_iterator self, intbitset bitset not None, bint reverse=False):
         #print >> sys.stderr, "intbitset_iterator.__cinit__ is called"
         self.last = -1
-        ## A copy should be performed, in case the original bitset disappears
-        ## as in "for x in intbitset([1,2,3])"!
-        self.bitset = intBitSetClone(bitset.bitset)
+        ## In reverse, from the biggest element down to the smallest one.
+        self.reverse = reverse
+        ## A reference is kept, in case the original bitset disappears
+        ## as in "for x in intbitset([1,2,3])"! Changes to it are detected
+        ## through its version.
+        self.owner = bitset
+        self.version = bitset.bitset.version
         self.sanity_checks = CFG_INTBITSET_ENABLE_SANITY_CHECKS
 
-    def __dealloc__(intbitset_iterator self):
-        #print >> sys.stderr, "intbitset_iterator.__dealloc__ is called"
-        intBitSetDestroy(self.bitset)
-
     def __next__(intbitset_iterator self):
+        cdef IntBitSet *bitset = self.owner.bitset
+        cdef unsigned long long start
+        cdef int last
         if self.last == -2:
             raise StopIteration()
-        self.last = intBitSetGetNext(self.bitset, self.last)
-        if self.sanity_checks and (self.bitset.allocated < self.bitset.size):
+        if bitset.version != self.version:
+            self.last = -2
+            raise RuntimeError("intbitset changed during iteration")
+        if bitset.size < 0:
+            intBitSetGetSize(bitset)
+        if _profiling:
+            start = intBitSetNow()
+            last = self.last
+            self.last = _iterator_step(bitset, self.last, self.reverse)
+            _profile(_PROFILE_ITERATE, start, abs(self.last // wordbitsize - max(last, 0) // wordbitsize) if self.last >= 0 else 0)
+        else:
+            self.last = _iterator_step(bitset, self.last, self.reverse)
+        if self.sanity_checks and (bitset.allocated < bitset.size):
             raise MemoryError(
                 "intbitset corrupted: allocated: %s, size: %s"
-                % (self.bitset.allocated, self.bitset.size)
+                % (bitset.allocated, bitset.size)
             )
         if self.last < 0:
             self.last = -2
@@ -818,3 +2427,11 @@ cdef class intbitset_iterator:
         return self
 
     cdef object __weakref__
+
+cdef inline int _iterator_step(IntBitSet *bitset, int last, bint reverse):
+    """Return the element following last, or preceding it in reverse."""
+    if not reverse:
+        return intBitSetGetNext(bitset, last)
+    if last == -1:
+        return intBitSetGetLast(bitset)
+    return intBitSetGetPrev(bitset, last)
@@ -0,0 +1,313 @@
+# This file is part of intbitset
+# Copyright (C) CERN and others
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+#
+# intbitset is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# intbitset is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with intbitset; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston MA 2110, USA.
+
+"""
+Benchmarks of intbitset set operations.
+
+Run them with::
+
+    $ python -m intbitset_bench --threads 1 2 4 8
+
+to see how the set operations on big intbitsets scale with the number of
+threads set by intbitset.set_num_threads(), or with::
+
+    $ python -m intbitset_bench --suite --json results.json
+
+to time construction, set algebra, iteration, indexing and marshalling
+across sizes, densities and trailing_bits, with the built-in set as the
+baseline, and save the results as JSON to compare builds. Sizes up to 1e8
+bits are timed with e.g.::
+
+    $ python -m intbitset_bench --suite --sizes 1000 100000 10000000 100000000 --densities 0.0001 0.01
+"""
+
+import argparse
+import json
+import os
+import pickle
+import platform
+import random
+import sys
+import timeit
+from array import array
+
+import intbitset as intbitset_module
+from intbitset import intbitset
+
+OPERATIONS = {
+    "and": lambda x, y: x & y,
+    "or": lambda x, y: x | y,
+    "xor": lambda x, y: x ^ y,
+    "sub": lambda x, y: x - y,
+    "iand": lambda x, y: intbitset(x).__iand__(y),
+    "intersection_count": lambda x, y: x.intersection_count(y),
+    "union_count": lambda x, y: x.union_count(y),
+    "len": lambda x, y: len(intbitset(x)),
+    "union_all": lambda x, y: intbitset_module.union_all([x, y] * 8),
+    "intersection_all": lambda x, y: intbitset_module.intersection_all([x, y] * 8),
+}
+
+
+def make_sets(size):
+    """Return two intbitsets of elements up to size, one every 3 and one
+    every 5."""
+    return intbitset(range(0, size, 3)), intbitset(range(0, size, 5))
+
+
+def time_operation(operation, x, y, repeat=5):
+    """Return the best time, in seconds, of operation(x, y)."""
+    return min(timeit.repeat(lambda: operation(x, y), number=1, repeat=repeat))
+
+
+def bench_threads(threads, size, operations=None, repeat=5):
+    """Time operations (all of OPERATIONS by default) on intbitsets of
+    elements up to size with each number of threads. Return a dict of
+    {operation: {threads: seconds}}."""
+    x, y = make_sets(size)
+    results = {}
+    previous = intbitset_module.get_num_threads()
+    try:
+        for name in operations or OPERATIONS:
+            results[name] = {}
+            for n in threads:
+                intbitset_module.set_num_threads(n)
+                results[name][n] = time_operation(OPERATIONS[name], x, y, repeat)
+    finally:
+        intbitset_module.set_num_threads(previous)
+    return results
+
+
+def _inplace(name):
+    """Return the in-place operator name of an intbitset and of a set,
+    applied to a copy of its first operand, as in x = copy(x); x op= y."""
+    return lambda x, y: getattr(x.copy(), name)(y)
+
+
+## {case: (intbitset operation, set operation or None, finite_only)}, where
+## the operations take the dict of the values built by make_fixture() for
+## the two sides.
+SUITE = {
+    "init_list": (
+        lambda f: intbitset(f["list"], trailing_bits=f["trailing_bits"]),
+        lambda f: set(f["list"]), False,
+    ),
+    "init_tuple": (
+        lambda f: intbitset(f["tuple"], trailing_bits=f["trailing_bits"]),
+        lambda f: set(f["tuple"]), False,
+    ),
+    "init_array": (
+        lambda f: intbitset(f["array"], trailing_bits=f["trailing_bits"]),
+        lambda f: set(f["array"]), False,
+    ),
+    "and": (lambda f: f["x"] & f["y"], lambda f: f["x"] & f["y"], False),
+    "or": (lambda f: f["x"] | f["y"], lambda f: f["x"] | f["y"], False),
+    "xor": (lambda f: f["x"] ^ f["y"], lambda f: f["x"] ^ f["y"], False),
+    "sub": (lambda f: f["x"] - f["y"], lambda f: f["x"] - f["y"], False),
+    "iand": (lambda f: _inplace("__iand__")(f["x"], f["y"]), lambda f: _inplace("__iand__")(f["x"], f["y"]), False),
+    "ior": (lambda f: _inplace("__ior__")(f["x"], f["y"]), lambda f: _inplace("__ior__")(f["x"], f["y"]), False),
+    "ixor": (lambda f: _inplace("__ixor__")(f["x"], f["y"]), lambda f: _inplace("__ixor__")(f["x"], f["y"]), False),
+    "isub": (lambda f: _inplace("__isub__")(f["x"], f["y"]), lambda f: _inplace("__isub__")(f["x"], f["y"]), False),
+    "len": (lambda f: len(f["x"]), lambda f: len(f["x"]), True),
+    "contains": (
+        lambda f: [elem in f["x"] for elem in f["probes"]],
+        lambda f: [elem in f["x"] for elem in f["probes"]], False,
+    ),
+    "getitem": (lambda f: [f["x"][i] for i in f["indices"]], None, True),
+    "slice": (lambda f: f["x"][f["len"] // 4:f["len"] // 2], None, True),
+    "slice_step": (lambda f: f["x"][::7], None, True),
+    "iterate": (lambda f: [elem for elem in f["x"]], lambda f: [elem for elem in f["x"]], True),
+    "fastdump": (lambda f: f["x"].fastdump(), lambda f: pickle.dumps(f["x"]), False),
+    "fastload": (lambda f: intbitset(f["dump"]), lambda f: pickle.loads(f["dump"]), False),
+    "pickle_dumps": (lambda f: pickle.dumps(f["x"]), lambda f: pickle.dumps(f["x"]), False),
+    "pickle_loads": (lambda f: pickle.loads(f["pickle"]), lambda f: pickle.loads(f["pickle"]), False),
+}
+
+
+def make_fixture(size, density, trailing_bits, seed=0, set_limit=None):
+    """Return the dicts of the values the cases of SUITE work on, for
+    intbitset and for set: two sets of size * density random elements below
+    size, their elements as a sorted list, tuple and array, 1000 probes and
+    indexes, and their dumps. The one for set is None if the sets are
+    infinite, or have more than set_limit elements."""
+    rng = random.Random(seed)
+    count = max(1, int(size * density))
+    elements = sorted(rng.sample(range(size), count))
+    other = rng.sample(range(size), count)
+    x = intbitset(elements, trailing_bits=trailing_bits)
+    y = intbitset(other, trailing_bits=trailing_bits)
+    common = {
+        "list": elements,
+        "tuple": tuple(elements),
+        "array": array("I", elements),
+        "trailing_bits": trailing_bits,
+        "probes": [rng.randrange(size) for _ in range(1000)],
+        "indices": [rng.randrange(count) for _ in range(1000)],
+        "len": count,
+    }
+    fixture = dict(common, x=x, y=y, dump=x.fastdump(), pickle=pickle.dumps(x))
+    if trailing_bits or (set_limit is not None and count > set_limit):
+        return fixture, None
+    x, y = set(elements), set(other)
+    return fixture, dict(common, x=x, y=y, dump=pickle.dumps(x), pickle=pickle.dumps(x))
+
+
+def time_call(function, repeat=5, min_time=0.02):
+    """Return the best time, in seconds, of a call of function(), averaged
+    over enough calls to last at least min_time."""
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def bench_suite(sizes, densities, trailing_bits=(False, True), cases=None, repeat=5, set_limit=10 ** 6):
+    """Time the cases of SUITE (all of them by default), for intbitset and
+    for set when the sets have at most set_limit elements and are finite.
+    Return a list of dicts of the case, size, density, trailing_bits and
+    the seconds taken by intbitset and by set (None when not timed)."""
+    results = []
+    for size in sizes:
+        for density in densities:
+            for tb in trailing_bits:
+                fixture, baseline = make_fixture(size, density, tb, set_limit=set_limit)
+                for name in cases or SUITE:
+                    operation, set_operation, finite_only = SUITE[name]
+                    if tb and finite_only:
+                        continue
+                    results.append({
+                        "case": name,
+                        "size": size,
+                        "density": density,
+                        "trailing_bits": tb,
+                        "intbitset": time_call(lambda: operation(fixture), repeat),
+                        "set": (
+                            time_call(lambda: set_operation(baseline), repeat)
+                            if baseline is not None and set_operation is not None else None
+                        ),
+                    })
+    return results
+
+
+def environment():
+    """Return a dict describing the build and the machine the benchmarks
+    run on, to be saved along the results."""
+    return {
+        "intbitset": intbitset_module.__version__,
+        "simd": intbitset_module.__simd__,
+        "threads": intbitset_module.get_num_threads(),
+        "python": sys.version,
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def write_json(path, mode, results):
+    """Write the results, with the environment, as JSON to path, or to the
+    standard output if path is "-"."""
+    document = {"benchmark": mode, "environment": environment(), "results": results}
+    if path == "-":
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(path, "w") as output:
+            json.dump(document, output, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="intbitset_bench", description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "--suite", action="store_true",
+        help="time the cases of the suite instead of the scaling with threads",
+    )
+    parser.add_argument(
+        "--threads", type=int, nargs="+", default=[1, os.cpu_count() or 1],
+        help="numbers of threads to compare (default: 1 and the number of CPUs)",
+    )
+    parser.add_argument(
+        "--size", type=int, default=1 << 30,
+        help="bigger element of the intbitsets (default: 2 ** 30)",
+    )
+    parser.add_argument(
+        "--operation", choices=sorted(OPERATIONS), action="append",
+        help="operation to time (default: all of them)",
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10 ** 3, 10 ** 5, 10 ** 7],
+        help=(
+            "with --suite, numbers of bits of the intbitsets (default: 1e3 1e5 1e7; "
+            "1e8 has to be asked for, as its fixtures at density 0.5 hold 5e7 integers "
+            "in a list, a tuple and an array, i.e. several GB)"
+        ),
+    )
+    parser.add_argument(
+        "--densities", type=float, nargs="+", default=[0.0001, 0.01, 0.5],
+        help="with --suite, fractions of the bits that are set (default: 0.0001 0.01 0.5)",
+    )
+    parser.add_argument(
+        "--trailing-bits", type=int, nargs="+", choices=[0, 1], default=[0, 1],
+        help="with --suite, trailing_bits to time (default: 0 1)",
+    )
+    parser.add_argument(
+        "--case", choices=sorted(SUITE), action="append",
+        help="with --suite, case to time (default: all of them)",
+    )
+    parser.add_argument(
+        "--set-limit", type=int, default=10 ** 6,
+        help="with --suite, biggest number of elements timed with set too (default: 1e6)",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each operation (default: 5)")
+    parser.add_argument("--json", metavar="PATH", help='write the results as JSON to PATH, or "-" for stdout')
+    args = parser.parse_args(argv)
+    if args.suite:
+        results = bench_suite(
+            args.sizes, args.densities, [bool(tb) for tb in args.trailing_bits],
+            args.case, args.repeat, args.set_limit,
+        )
+        if args.json:
+            write_json(args.json, "suite", results)
+            return
+        print("%-14s%12s%10s%6s%14s%14s%10s" % ("case", "size", "density", "tb", "intbitset", "set", "speedup"))
+        for result in results:
+            baseline = result["set"]
+            print("%-14s%12d%10g%6d%12.3fus%14s%10s" % (
+                result["case"], result["size"], result["density"], result["trailing_bits"],
+                result["intbitset"] * 1e6,
+                "%.3fus" % (baseline * 1e6) if baseline is not None else "-",
+                "%.2fx" % (baseline / result["intbitset"]) if baseline is not None else "-",
+            ))
+        return
+    results = bench_threads(args.threads, args.size, args.operation, args.repeat)
+    if args.json:
+        write_json(args.json, "threads", [
+            {"operation": name, "threads": n, "seconds": seconds}
+            for name, timings in results.items() for n, seconds in timings.items()
+        ])
+        return
+    print("%-20s" % "threads" + "".join("%12d" % n for n in args.threads))
+    for name, timings in results.items():
+        base = timings[args.threads[0]]
+        print("%-20s" % name + "".join("%10.2fms" % (timings[n] * 1000) for n in args.threads))
+        print("%-20s" % "  speedup" + "".join("%11.2fx" % (base / timings[n]) for n in args.threads))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# This file is part of intbitset
+# Copyright (C) CERN and others
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+#
+# intbitset is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# intbitset is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with intbitset; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston MA 2110, USA.
+
+"""
+LRU cache of the results of intbitset operations.
+
+A ResultCache memoizes the results of set operations keyed on the
+operation and on the identity and version (see intbitset.get_version()) of
+their operands, so that a result is reused until one of its operands is
+modified or freed::
+
+    >>> cache = ResultCache(max_bytes=64 << 20)
+    >>> hits = cache.intersection(public, matching)
+    >>> hits = cache.compute(query, public, matching, recent)
+
+The least recently used results are evicted beyond max_bytes. Results are
+returned as frozenintbitset, which share their words with the cached ones,
+so that they cannot be corrupted by the callers.
+"""
+
+import collections
+import functools
+import operator
+import sys
+import threading
+import weakref
+
+import intbitset as intbitset_module
+from intbitset import frozenintbitset, intbitset
+
+OPERATIONS = {
+    "and": lambda *operands: intbitset_module.intersection_all(operands),
+    "or": lambda *operands: intbitset_module.union_all(operands),
+    "xor": lambda *operands: functools.reduce(operator.xor, operands),
+    "sub": lambda first, *others: first.difference(*others),
+}
+
+## The operations whose result does not depend on the order of the operands.
+COMMUTATIVE = frozenset(["and", "or", "xor"])
+
+
+def result_size(result):
+    """Return the number of bytes used by the intbitset result, counted
+    against the budget of a ResultCache."""
+    return sys.getsizeof(result)
+
+
+class ResultCache(object):
+    """Cache of the results of intbitset operations, holding up to max_bytes
+    (as counted by result_size()) and evicting the least recently used ones
+    beyond. Safe to use from several threads."""
+
+    def __init__(self, max_bytes=64 << 20):
+        if max_bytes < 0:
+            raise ValueError("max_bytes must be >= 0")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        ## {key: (result, nbytes)}, from the least to the most recently used.
+        self._entries = collections.OrderedDict()
+        ## {id(operand): [weakref to operand, set of keys, version]}, the
+        ## keys being those of the results of that version of the operand.
+        self._operands = {}
+        ## Ids of the operands freed since the last call, whose entries are
+        ## dropped by the next one, as weakref callbacks may run while the
+        ## entries are being updated.
+        self._freed = []
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def compute(self, op, *operands):
+        """Return op(*operands) as a frozenintbitset, computing it only if it
+        is not cached. op is either the name of an operation of OPERATIONS,
+        applied to any number of operands, or a function of the intbitset
+        operands returning an intbitset, which is used as is in the key, e.g.
+        a function evaluating an intbitset expression."""
+        if not operands:
+            raise TypeError("compute() needs at least one operand")
+        function = OPERATIONS[op] if isinstance(op, str) else op
+        for operand in operands:
+            if not isinstance(operand, intbitset):
+                raise TypeError("operands must be intbitset, not %s" % type(operand).__name__)
+        versions = [(id(operand), operand.get_version()) for operand in operands]
+        key = (op, tuple(sorted(versions) if op in COMMUTATIVE else versions))
+        with self._lock:
+            self._drop_freed()
+            self._drop_stale(versions)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        result = frozenintbitset(function(*operands))
+        nbytes = result_size(result)
+        if any(operand.get_version() != version for operand, (_, version) in zip(operands, versions)):
+            ## An operand was modified meanwhile, by another thread.
+            return result
+        with self._lock:
+            self._drop_freed()
+            if key not in self._entries and nbytes <= self.max_bytes:
+                self._insert(key, result, nbytes, operands)
+        return result
+
+    def intersection(self, *operands):
+        """Return the cached intersection of the operands."""
+        return self.compute("and", *operands)
+
+    def union(self, *operands):
+        """Return the cached union of the operands."""
+        return self.compute("or", *operands)
+
+    def symmetric_difference(self, *operands):
+        """Return the cached symmetric difference of the operands."""
+        return self.compute("xor", *operands)
+
+    def difference(self, *operands):
+        """Return the cached difference of the first operand and the others."""
+        return self.compute("sub", *operands)
+
+    def clear(self):
+        """Drop all the cached results, keeping the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._operands.clear()
+            del self._freed[:]
+            self.size = 0
+
+    def stats(self):
+        """Return a dict of the statistics of the cache."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _insert(self, key, result, nbytes, operands):
+        self._drop_stale(key[1])
+        for ident, version in key[1]:
+            if ident in self._operands and self._operands[ident][2] > version:
+                ## Computed from an operand modified since by another thread.
+                return
+        self._entries[key] = (result, nbytes)
+        self.size += nbytes
+        versions = dict(key[1])
+        for operand in operands:
+            ident = id(operand)
+            if ident not in self._operands:
+                self._operands[ident] = [weakref.ref(operand, self._freed_callback(ident)), set(), versions[ident]]
+            self._operands[ident][1].add(key)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        result, nbytes = self._entries.pop(key)
+        self.size -= nbytes
+        for ident, _ in key[1]:
+            operand = self._operands.get(ident)
+            if operand is not None:
+                operand[1].discard(key)
+                if not operand[1]:
+                    del self._operands[ident]
+
+    def _drop_stale(self, versions):
+        """Drop the results of the previous versions of the operands, given
+        by versions as (id, version) pairs, which cannot be looked up
+        anymore, as versions only grow."""
+        for ident, version in versions:
+            operand = self._operands.get(ident)
+            if operand is not None and operand[2] < version:
+                for key in list(operand[1]):
+                    self._remove(key)
+
+    def _freed_callback(self, ident):
+        freed = self._freed
+
+        def callback(ref):
+            freed.append((ident, ref))
+        return callback
+
+    def _drop_freed(self):
+        while self._freed:
+            ident, ref = self._freed.pop()
+            operand = self._operands.get(ident)
+            if operand is not None and operand[0] is ref:
+                for key in list(operand[1]):
+                    self._remove(key)
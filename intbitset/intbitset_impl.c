@@ -21,9 +21,16 @@
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
+#include <stdint.h>
 
 #include "intbitset.h"
 
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <time.h>
+#endif
+
 // Fake declarations: do not call them!
 #if PY_VERSION_HEX >= 0x03000000
 PyObject* PyString_FromStringAndSize(const char *v, Py_ssize_t len) {
@@ -36,54 +43,232 @@ const int wordbitsize = sizeof(word_t) * 8;
 
 const int maxelem = INT_MAX;
 
+#ifdef __GNUC__
+#define intbitset_ctz(word) __builtin_ctzll(word)
+#define intbitset_clz(word) __builtin_clzll(word)
+#elif defined(_MSC_VER) && defined(_M_X64)
+#include <intrin.h>
+static int intbitset_ctz(register word_t word) {
+    unsigned long ret;
+    _BitScanForward64(&ret, word);
+    return (int) ret;
+}
+static int intbitset_clz(register word_t word) {
+    unsigned long ret;
+    _BitScanReverse64(&ret, word);
+    return 63 - (int) ret;
+}
+#else
+static int intbitset_ctz(register word_t word) {
+    // word must not be 0.
+    register int ret = 0;
+    for (; !(word & 0xffffffffULL); word >>= 32) ret += 32;
+    for (; !(word & 1); word >>= 1) ++ret;
+    return ret;
+}
+static int intbitset_clz(register word_t word) {
+    // word must not be 0.
+    register int ret = 0;
+    for (; !(word & 0xffffffff00000000ULL); word <<= 32) ret += 32;
+    for (; !(word & 0x8000000000000000ULL); word <<= 1) ++ret;
+    return ret;
+}
+#endif
+
+// The memory stats, but for the wasted bytes, and the most recently created
+// of the live bitsets, which are linked together.
+static IntBitSetMemoryStats intbitset_memory = {0, 0, 0, 0, 0, 0};
+static IntBitSet *intbitset_live = NULL;
+
+static void intBitSetTrack(void *const ptr, const size_t size) {
+    // Move the trace of ptr, if tracemalloc is tracing, from the default
+    // domain, where PyMem_Malloc() put it, to the intbitset one.
+    if (PyTraceMalloc_Untrack(0, (uintptr_t) ptr) != -2)
+        PyTraceMalloc_Track(INTBITSET_TRACEMALLOC_DOMAIN, (uintptr_t) ptr, size);
+}
+
+static void intBitSetCount(register const Py_ssize_t size) {
+    intbitset_memory.live_bytes += size;
+    if (intbitset_memory.live_bytes > intbitset_memory.peak_bytes)
+        intbitset_memory.peak_bytes = intbitset_memory.live_bytes;
+}
+
+static void *intBitSetMalloc(register const size_t size) {
+    register void *ret = PyMem_Malloc(size);
+    intBitSetCount((Py_ssize_t) size);
+    intBitSetTrack(ret, size);
+    return ret;
+}
+
+static void *intBitSetRealloc(void *const ptr, register const size_t old, register const size_t size) {
+    register void *ret;
+    PyTraceMalloc_Untrack(INTBITSET_TRACEMALLOC_DOMAIN, (uintptr_t) ptr);
+    ret = PyMem_Realloc(ptr, size);
+    ++intbitset_memory.reallocs;
+    intBitSetCount((Py_ssize_t) size - (Py_ssize_t) old);
+    intBitSetTrack(ret, size);
+    return ret;
+}
+
+static void intBitSetFree(void *const ptr, register const size_t size) {
+    PyTraceMalloc_Untrack(INTBITSET_TRACEMALLOC_DOMAIN, (uintptr_t) ptr);
+    PyMem_Free(ptr);
+    intbitset_memory.live_bytes -= (Py_ssize_t) size;
+}
+
+static void intBitSetReallocWords(IntBitSet *const bitset, register const int nwords) {
+    // Reallocate the words of bitset, which must own them, to hold nwords
+    // words from its offset.
+    bitset->bitset = intBitSetRealloc(bitset->bitset, (size_t) (bitset->allocated - bitset->offset) * wordbytesize, (size_t) nwords * wordbytesize);
+}
+
+static IntBitSet *intBitSetNew(void) {
+    // Return a new bitset, to be filled, linked with the live ones.
+    register IntBitSet *ret = intBitSetMalloc(sizeof (IntBitSet));
+    ret->prev = NULL;
+    ret->next = intbitset_live;
+    if (intbitset_live)
+        intbitset_live->prev = ret;
+    intbitset_live = ret;
+    ++intbitset_memory.live_sets;
+    return ret;
+}
+
+static void intBitSetDelete(IntBitSet *const bitset) {
+    // Unlink bitset from the live ones and free it, but not its words.
+    if (bitset->prev)
+        bitset->prev->next = bitset->next;
+    else
+        intbitset_live = bitset->next;
+    if (bitset->next)
+        bitset->next->prev = bitset->prev;
+    --intbitset_memory.live_sets;
+    intBitSetFree(bitset, sizeof (IntBitSet));
+}
+
+static void intBitSetAssign(IntBitSet *const dst, const IntBitSet *const src) {
+    // *dst = *src, but for the links of dst with the live bitsets.
+    register IntBitSet *prev = dst->prev;
+    register IntBitSet *next = dst->next;
+    *dst = *src;
+    dst->prev = prev;
+    dst->next = next;
+}
+
+Py_ssize_t intBitSetGetMemory(const IntBitSet *const bitset) {
+    return (Py_ssize_t) sizeof (IntBitSet) + (bitset->borrowed ? 0 : (Py_ssize_t) (bitset->allocated - bitset->offset) * wordbytesize);
+}
+
+void intBitSetGetMemoryStats(IntBitSetMemoryStats *const stats) {
+    register const IntBitSet *bitset;
+    register const word_t *end;
+    register int size;
+    *stats = intbitset_memory;
+    stats->wasted_bytes = 0;
+    for (bitset = intbitset_live; bitset; bitset = bitset->next) {
+        if (bitset->borrowed)
+            continue;
+        size = bitset->size;
+        if (size < 0) {
+            // As intBitSetGetSize(), without caching it.
+            end = bitset->bitset + bitset->allocated - bitset->offset - 2;
+            for (; bitset->bitset < end && *end == bitset->trailing_bits; --end);
+            size = bitset->offset + (int) (end - bitset->bitset) + 1;
+        }
+        stats->wasted_bytes += (Py_ssize_t) (bitset->allocated - size - 1) * wordbytesize;
+    }
+}
+
+static void intBitSetChanged(IntBitSet *const bitset) {
+    // To be called whenever the content of bitset is modified: drop the
+    // cached values and let the iterators know.
+    bitset->size = -1;
+    bitset->tot = -1;
+    ++bitset->version;
+    if (bitset->ranks) {
+        PyMem_Free(bitset->ranks);
+        bitset->ranks = NULL;
+    }
+}
+
+#define INTBITSET_HASH_PRIME1 0x9e3779b185ebca87ULL
+#define INTBITSET_HASH_PRIME2 0xc2b2ae3d27d4eb4fULL
+
+static void intBitSetFreeWords(IntBitSet *const bitset) {
+    // Free the words of bitset, unless they are borrowed or still shared
+    // with another bitset.
+    if (bitset->shares) {
+        if (--*bitset->shares)
+            return;
+        PyMem_Free(bitset->shares);
+        bitset->shares = NULL;
+    }
+    if (!bitset->borrowed)
+        intBitSetFree(bitset->bitset, (size_t) (bitset->allocated - bitset->offset) * wordbytesize);
+}
+
 IntBitSet *intBitSetCreate(register const int size, const bool_t trailing_bits) {
+    return intBitSetCreateWindow(0, size, trailing_bits);
+}
+
+IntBitSet *intBitSetCreateWindow(register const int first, register const int size, const bool_t trailing_bits) {
     register word_t *base;
     register word_t *end;
-    IntBitSet *ret = PyMem_Malloc(sizeof(IntBitSet));
+    IntBitSet *ret = intBitSetNew();
     // fprintf(stderr, "intBitSetCreate called\n");
     // At least one word -> the one who represent the trailing_bits
     ret->allocated = (size / wordbitsize + 1);
-    ret->size = 0; // trailing_bits
+    ret->offset = (first < size) ? first / wordbitsize : size / wordbitsize;
+    ret->size = ret->offset; // trailing_bits
     ret->trailing_bits = trailing_bits ? (word_t) ~0 : 0;
     if (trailing_bits) {
-        base = ret->bitset = PyMem_Malloc(ret->allocated * wordbytesize);
-        end = base + ret->allocated;
+        base = ret->bitset = intBitSetMalloc((ret->allocated - ret->offset) * wordbytesize);
+        end = base + ret->allocated - ret->offset;
         for (; base < end; ++base)
             *base = (word_t) ~0;
         ret->tot = -1;
     } else {
-        base = ret->bitset = PyMem_Malloc(ret->allocated * wordbytesize);
-        end = base + ret->allocated;
+        base = ret->bitset = intBitSetMalloc((ret->allocated - ret->offset) * wordbytesize);
+        end = base + ret->allocated - ret->offset;
         for (; base < end; ++base)
             *base = (word_t) 0;
         ret->tot = 0;
     }
+    ret->version = 0;
+    ret->ranks = NULL;
+    ret->borrowed = 0;
+    ret->shares = NULL;
     return ret;
 }
 
-IntBitSet *intBitSetResetFromBuffer(IntBitSet *const bitset, const void *const buf, const Py_ssize_t bufsize) {
+IntBitSet *intBitSetResetFromBuffer(IntBitSet *const bitset, const void *const buf, const Py_ssize_t bufsize, const int offset) {
     // fprintf(stderr, "intBitSetResetFromBuffer called\n");
     register Py_ssize_t newallocate = bufsize/wordbytesize;
-    if (newallocate > bitset->allocated) {
-        PyMem_Free(bitset->bitset);
-        bitset->bitset = PyMem_Malloc(bufsize);
+    if (newallocate > bitset->allocated - bitset->offset || bitset->shares || bitset->borrowed) {
+        intBitSetFreeWords(bitset);
+        bitset->bitset = intBitSetMalloc(bufsize);
+        bitset->shares = NULL;
+        bitset->borrowed = 0;
+    } else if (newallocate < bitset->allocated - bitset->offset) {
+        intBitSetReallocWords(bitset, (int) newallocate);
     }
-    bitset->allocated = newallocate;
-    bitset->tot = -1;
+    bitset->offset = offset;
+    bitset->allocated = offset + newallocate;
+    intBitSetChanged(bitset);
     bitset->size = bitset->allocated - 1;
     memcpy(bitset->bitset, buf, bufsize);
-    bitset->trailing_bits = *(bitset->bitset + bitset->allocated - 1) ? (word_t) ~0 : 0;
+    bitset->trailing_bits = *(bitset->bitset + newallocate - 1) ? (word_t) ~0 : 0;
     return bitset;
 }
 
 IntBitSet *intBitSetReset(IntBitSet *const bitset) {
     // fprintf(stderr, "intBitSetReset called\n");
-    // NOTE: soft reset the memory. Instead of freeing it, which is slow
-    // simply declare in the intbitset that the allocated memory is one only
-    // word, and zero that word, so that as soon as more memory is needed
-    // a realloc will be triggered.
+    // The memory is given back, so that a set which was once big does not
+    // keep it forever.
+    intBitSetReallocWords(bitset, 1);
     bitset->allocated = 1;
-    bitset->size = -1;
+    bitset->offset = 0;
+    intBitSetChanged(bitset);
     *bitset->bitset = 0;
     bitset->trailing_bits = 0;
     bitset->tot = 0;
@@ -91,37 +276,98 @@ IntBitSet *intBitSetReset(IntBitSet *const bitset) {
 }
 
 
-IntBitSet *intBitSetCreateFromBuffer(const void *const buf, const Py_ssize_t bufsize) {
+IntBitSet *intBitSetCreateFromBuffer(const void *const buf, const Py_ssize_t bufsize, const int offset) {
     // fprintf(stderr, "intBitSetCreateFromBuffer called\n");
-    IntBitSet *ret = PyMem_Malloc(sizeof(IntBitSet));
-    ret->allocated = bufsize/wordbytesize;
-    ret->bitset = PyMem_Malloc(bufsize);
-    ret->size = ret->allocated - 1;;
+    IntBitSet *ret = intBitSetNew();
+    ret->offset = offset;
+    ret->allocated = offset + bufsize/wordbytesize;
+    ret->bitset = intBitSetMalloc(bufsize);
+    ret->size = ret->allocated - 1;
     ret->tot = -1;
+    ret->version = 0;
+    ret->ranks = NULL;
+    ret->borrowed = 0;
+    ret->shares = NULL;
     memcpy(ret->bitset, buf, bufsize);
-    ret->trailing_bits = *(ret->bitset + ret->allocated - 1) ? (word_t) ~0 : 0;
+    ret->trailing_bits = *(ret->bitset + bufsize/wordbytesize - 1) ? (word_t) ~0 : 0;
+    return ret;
+}
+
+IntBitSet *intBitSetCreateFromWords(word_t *const words, const int nwords, const int offset) {
+    // The words are not copied: they must outlive the bitset, or at least
+    // its first change, which is preceded by intBitSetOwnWords().
+    IntBitSet *ret = intBitSetNew();
+    ret->offset = offset;
+    ret->allocated = offset + nwords;
+    ret->bitset = words;
+    ret->size = ret->allocated - 1;
+    ret->tot = -1;
+    ret->version = 0;
+    ret->ranks = NULL;
+    ret->borrowed = 1;
+    ret->shares = NULL;
+    ret->trailing_bits = *(ret->bitset + nwords - 1) ? (word_t) ~0 : 0;
     return ret;
 }
 
+void intBitSetOwnWords(IntBitSet *const bitset) {
+    register word_t *words;
+    if (bitset->shares && *bitset->shares == 1) {
+        // The others sharing the words are gone.
+        PyMem_Free(bitset->shares);
+        bitset->shares = NULL;
+    } else if (bitset->borrowed || bitset->shares) {
+        words = intBitSetMalloc((bitset->allocated - bitset->offset) * wordbytesize);
+        memcpy(words, bitset->bitset, (bitset->allocated - bitset->offset) * wordbytesize);
+        if (bitset->shares)
+            --*bitset->shares;
+        bitset->bitset = words;
+        bitset->borrowed = 0;
+        bitset->shares = NULL;
+    }
+}
+
+IntBitSet *intBitSetShare(IntBitSet *const bitset) {
+    register IntBitSet *ret;
+    if (bitset->borrowed)
+        return intBitSetClone(bitset);
+    if (!bitset->shares) {
+        bitset->shares = PyMem_Malloc(sizeof (Py_ssize_t));
+        *bitset->shares = 1;
+    }
+    ++*bitset->shares;
+    ret = intBitSetNew();
+    intBitSetAssign(ret, bitset);
+    ret->version = 0;
+    ret->ranks = NULL;
+    return ret;
+}
 
 void intBitSetDestroy(IntBitSet *const bitset) {
     // fprintf(stderr, "intBitSetDestroy called\n");
     if (bitset) {
         if (bitset->bitset)
-            PyMem_Free(bitset->bitset);
-        PyMem_Free(bitset);
+            intBitSetFreeWords(bitset);
+        if (bitset->ranks)
+            PyMem_Free(bitset->ranks);
+        intBitSetDelete(bitset);
     }
 }
 
 IntBitSet *intBitSetClone(const IntBitSet * const bitset) {
     // fprintf(stderr, "intBitSetClone called\n");
-    IntBitSet *ret = PyMem_Malloc(sizeof(IntBitSet));
+    IntBitSet *ret = intBitSetNew();
     ret->size = bitset->size;
     ret->tot = bitset->tot;
+    ret->version = 0;
+    ret->ranks = NULL;
+    ret->borrowed = 0;
+    ret->shares = NULL;
     ret->trailing_bits = bitset->trailing_bits;
     ret->allocated = bitset->allocated;
-    ret->bitset = PyMem_Malloc(bitset->allocated * wordbytesize);
-    memcpy(ret->bitset, bitset->bitset, bitset->allocated * wordbytesize);
+    ret->offset = bitset->offset;
+    ret->bitset = intBitSetMalloc((bitset->allocated - bitset->offset) * wordbytesize);
+    memcpy(ret->bitset, bitset->bitset, (bitset->allocated - bitset->offset) * wordbytesize);
     return ret;
 }
 
@@ -131,38 +377,18 @@ int intBitSetGetSize(IntBitSet * const bitset) {
     if (bitset->size >= 0)
         return bitset->size;
     base = bitset->bitset;
-    end = bitset->bitset + bitset->allocated - 2;
+    end = bitset->bitset + bitset->allocated - bitset->offset - 2;
     for (; base < end && *end == bitset->trailing_bits; --end);
-    bitset->size = ((int) (end - base) + 1);
+    bitset->size = bitset->offset + ((int) (end - base) + 1);
     return bitset->size;
 }
 
 int intBitSetGetTot(IntBitSet *const bitset) {
-    register word_t* base;
-#ifndef __GNUC__
-    register int i;
-#endif
-    register int tot;
-    register word_t *end;
     if (bitset->trailing_bits)
         return -1;
-    if (bitset->tot < 0) {
-        end = bitset->bitset + bitset->allocated;
-        tot = 0;
-        for (base = bitset->bitset; base < end; ++base)
-            if (*base)
-#ifdef __GNUC__
-                // See:
-                // <http://stackoverflow.com/questions/109023/best-algorithm-to-count-the-number-of-set-bits-in-a-32-bit-integer>
-                tot += __builtin_popcountll(*base);
-#else
-                for (i=0; i<wordbitsize; ++i)
-                    if ((*base & ((word_t) 1 << i)) != 0) {
-                        ++tot;
-                    }
-#endif
-        bitset->tot = tot;
-    }
+    if (bitset->tot < 0)
+        // Only the populated words can hold a set bit.
+        bitset->tot = (int) intBitSetKernelPopCount(bitset->bitset, intBitSetGetSize(bitset) - bitset->offset);
     return bitset->tot;
 }
 
@@ -176,9 +402,10 @@ void intBitSetResize(IntBitSet *const bitset, register const unsigned int alloca
     register word_t *end;
     register word_t trailing_bits;
     if (allocated > bitset->allocated) {
-        bitset->bitset = PyMem_Realloc(bitset->bitset, allocated * wordbytesize);
-        base = bitset->bitset + bitset->allocated;
-        end = bitset->bitset + allocated;
+        intBitSetReallocWords(bitset, allocated - bitset->offset);
+        ++intbitset_memory.resizes;
+        base = bitset->bitset + bitset->allocated - bitset->offset;
+        end = bitset->bitset + allocated - bitset->offset;
         trailing_bits = bitset->trailing_bits;
         for (; base<end; ++base)
             *(base) = trailing_bits;
@@ -186,33 +413,107 @@ void intBitSetResize(IntBitSet *const bitset, register const unsigned int alloca
     }
 }
 
+void intBitSetSetOffset(IntBitSet *const bitset, register const int offset) {
+    register int shift = bitset->offset - offset;
+    register int nwords = bitset->allocated - bitset->offset;
+    if (shift > 0) {
+        // Room is made for the leading words, which are 0.
+        intBitSetReallocWords(bitset, nwords + shift);
+        memmove(bitset->bitset + shift, bitset->bitset, nwords * wordbytesize);
+        memset(bitset->bitset, 0, shift * wordbytesize);
+    } else if (shift < 0) {
+        memmove(bitset->bitset, bitset->bitset - shift, (nwords + shift) * wordbytesize);
+        intBitSetReallocWords(bitset, nwords + shift);
+    }
+    bitset->offset = offset;
+    if (bitset->size >= 0 && bitset->size < offset)
+        bitset->size = offset;
+    // The rank directory is relative to the offset.
+    if (bitset->ranks) {
+        PyMem_Free(bitset->ranks);
+        bitset->ranks = NULL;
+    }
+}
+
+void intBitSetCompact(IntBitSet *const bitset) {
+    register int size = intBitSetGetSize(bitset);
+    register int first = bitset->offset;
+    if (bitset->borrowed || bitset->shares)
+        return;
+    for (; first < size && !bitset->bitset[first - bitset->offset]; ++first);
+    if (first > bitset->offset)
+        intBitSetSetOffset(bitset, first);
+    if (size + 1 < bitset->allocated) {
+        intBitSetReallocWords(bitset, size + 1 - bitset->offset);
+        bitset->allocated = size + 1;
+    }
+}
+
+static void intBitSetFillTail(IntBitSet *const bitset, register const int from, register const word_t trailing_bits) {
+    // Set the words from `from` up to the allocation to the new trailing_bits
+    // of the bitset, i.e. the part a size-bounded kernel did not walk.
+    register word_t *base = bitset->bitset + ((from > bitset->offset) ? from - bitset->offset : 0);
+    register word_t *end = bitset->bitset + bitset->allocated - bitset->offset;
+    for (; base < end; ++base)
+        *base = trailing_bits;
+}
+
 bool_t intBitSetIsInElem(const IntBitSet * const bitset, register const unsigned int elem) {
+    if ((int) (elem / wordbitsize) < bitset->offset)
+        return 0;
     return ((elem < bitset->allocated * wordbitsize) ?
-            (bitset->bitset[elem / wordbitsize] & ((word_t) 1 << ((word_t)elem % (word_t)wordbitsize))) != 0 : bitset->trailing_bits != 0);
+            (bitset->bitset[elem / wordbitsize - bitset->offset] & ((word_t) 1 << ((word_t)elem % (word_t)wordbitsize))) != 0 : bitset->trailing_bits != 0);
+}
+
+static void intBitSetMakeRoom(IntBitSet *const bitset, register const int lo, register const int hi) {
+    // Make the words held by bitset span the words lo to hi, followed by
+    // the trailing word: a bitset still empty is just moved there,
+    // otherwise it grows by a tenth of its span.
+    register int span;
+    if (!bitset->trailing_bits && intBitSetEmpty(bitset)) {
+        intBitSetReallocWords(bitset, hi - lo + 2);
+        memset(bitset->bitset, 0, (hi - lo + 2) * wordbytesize);
+        bitset->offset = lo;
+        bitset->allocated = hi + 2;
+        intBitSetChanged(bitset);
+        return;
+    }
+    if (lo < bitset->offset) {
+        span = bitset->allocated - lo;
+        intBitSetSetOffset(bitset, (lo > span / 10) ? lo - span / 10 : 0);
+    }
+    if (hi + 1 >= bitset->allocated) {
+        span = hi - bitset->offset;
+        intBitSetResize(bitset, hi + span / 10 + 2);
+    }
 }
 
 void intBitSetAddElem(IntBitSet *const bitset, register const unsigned int elem) {
-    if (elem >= (bitset->allocated - 1) * wordbitsize) {
-        if (bitset->trailing_bits)
+    if (elem >= (unsigned int) (bitset->allocated - 1) * wordbitsize || (int) (elem / wordbitsize) < bitset->offset) {
+        if (bitset->trailing_bits && (int) (elem / wordbitsize) >= bitset->offset)
             return;
         else
-            intBitSetResize(bitset, (elem + elem/10)/wordbitsize+2);
+            intBitSetMakeRoom(bitset, elem / wordbitsize, elem / wordbitsize);
     }
-    bitset->bitset[elem / wordbitsize] |= ((word_t) 1 << (elem % wordbitsize));
-    bitset->tot = -1;
-    bitset->size = -1;
+    if (bitset->bitset[elem / wordbitsize - bitset->offset] & ((word_t) 1 << (elem % wordbitsize)))
+        return;
+    bitset->bitset[elem / wordbitsize - bitset->offset] |= ((word_t) 1 << (elem % wordbitsize));
+    intBitSetChanged(bitset);
 }
 
 void intBitSetDelElem(IntBitSet *const bitset, register const unsigned int elem) {
-    if (elem >= (bitset->allocated - 1) * wordbitsize) {
+    if ((int) (elem / wordbitsize) < bitset->offset)
+        return;
+    if (elem >= (unsigned int) (bitset->allocated - 1) * wordbitsize) {
         if (!bitset->trailing_bits)
             return;
         else
-            intBitSetResize(bitset, (elem + elem/10)/wordbitsize+2);
+            intBitSetResize(bitset, (elem / wordbitsize) + (elem / wordbitsize - bitset->offset) / 10 + 2);
     }
-    bitset->bitset[elem / wordbitsize] &= (word_t) ~((word_t) 1 << (elem % wordbitsize));
-    bitset->tot = -1;
-    bitset->size = -1;
+    if (!(bitset->bitset[elem / wordbitsize - bitset->offset] & ((word_t) 1 << (elem % wordbitsize))))
+        return;
+    bitset->bitset[elem / wordbitsize - bitset->offset] &= (word_t) ~((word_t) 1 << (elem % wordbitsize));
+    intBitSetChanged(bitset);
 }
 
 bool_t intBitSetEmpty(const IntBitSet *const bitset) {
@@ -220,248 +521,1457 @@ bool_t intBitSetEmpty(const IntBitSet *const bitset) {
     register word_t *base;
     if (bitset->trailing_bits) return 0;
     if (bitset->tot == 0) return 1;
-    end = bitset->bitset + bitset->allocated;
+    end = bitset->bitset + bitset->allocated - bitset->offset;
     for (base = bitset->bitset; base < end; ++base)
         if (*base) return 0;
     return 1;
 }
 
-int intBitSetAdaptMax(IntBitSet *const x, IntBitSet *const y) {
-    // Good idea but broken, it is kept for better time...
-    // register int sizex = intBitSetGetSize(x);
-    // register int sizey = intBitSetGetSize(y);
-    // register int sizemax = ((sizex > sizey) ? sizex : sizey) + 1;
-    // if (sizemax > x->allocated)
-    //     intBitSetResize(x, sizemax);
-    // if (sizemax > y->allocated)
-    //     intBitSetResize(y, sizemax);
-    // return sizemax;*/
-    register int allocated = (x->allocated > y->allocated) ? x->allocated : y->allocated;
-    if (allocated > x->allocated)
-        intBitSetResize(x, allocated);
-    if (allocated > y->allocated)
-        intBitSetResize(y, allocated);
-    return allocated;
-}
-
-int intBitSetAdaptMin(IntBitSet *const x, IntBitSet *const y) {
-    register int sizex;
-    register int sizey;
-    if (x->trailing_bits || y->trailing_bits)
-        return intBitSetAdaptMax(x, y);
-    sizex = intBitSetGetSize(x);
-    sizey = intBitSetGetSize(y);
-    return ((sizex < sizey) ? sizex : sizey) + 1;
+// Truth tables of the bitwise operations: bit (2 * a + b) is op(a, b).
+#define INTBITSET_TABLE_AND 8
+#define INTBITSET_TABLE_OR 14
+#define INTBITSET_TABLE_XOR 6
+#define INTBITSET_TABLE_ANDNOT 4
+#define INTBITSET_TABLE(table, a, b) (((table) >> (2 * ((a) != 0) + ((b) != 0))) & 1)
+
+static void intBitSetOpRest(word_t *const dst, const word_t *const src, register const Py_ssize_t n, register const int bit_zero, register const int bit_one) {
+    // dst[i] = op(src[i]) for an operation whose result is bit_zero for a
+    // bit of src at 0 and bit_one for a bit at 1.
+    register Py_ssize_t i;
+    if (bit_zero && bit_one) {
+        for (i = 0; i < n; ++i)
+            dst[i] = (word_t) ~0;
+    } else if (bit_one) {
+        if (dst != src)
+            memcpy(dst, src, n * wordbytesize);
+    } else if (bit_zero) {
+        for (i = 0; i < n; ++i)
+            dst[i] = ~src[i];
+    } else if (n > 0) {
+        memset(dst, 0, n * wordbytesize);
+    }
 }
 
-IntBitSet *intBitSetUnion(IntBitSet *const x, IntBitSet *const y) {
-    register word_t *xbase;
-    register word_t *xend;
-    register word_t *ybase;
-    register word_t *retbase;
-    register IntBitSet * ret = PyMem_Malloc(sizeof (IntBitSet));
-    ret->allocated = intBitSetAdaptMax(x, y);
-    xbase = x->bitset;
-    xend = x->bitset+ret->allocated;
-    ybase = y->bitset;
-    retbase = ret->bitset = PyMem_Malloc(wordbytesize * ret->allocated);
+static void intBitSetOperandInit(IntBitSetOperand *const operand, const IntBitSet *const bitset) {
+    // The size of bitset must be known, or operand stands for all the
+    // integers, i.e. the neutral operand of an intersection, if bitset is
+    // NULL.
+    if (bitset) {
+        operand->words = bitset->bitset;
+        operand->offset = bitset->offset;
+        operand->size = bitset->size;
+        operand->trailing_bits = bitset->trailing_bits;
+    } else {
+        operand->words = NULL;
+        operand->offset = operand->size = 0;
+        operand->trailing_bits = (word_t) ~0;
+    }
+}
+
+static Py_ssize_t intBitSetSegment(const IntBitSetOperand *const operand, register const Py_ssize_t i, const word_t **const words, word_t *const value) {
+    // Return the end of the segment of operand starting at word i, along
+    // which its words are the ones at *words, or are all *value if *words
+    // is NULL: 0 before its offset, trailing_bits from its size.
+    *words = NULL;
+    *value = 0;
+    if (i < operand->offset) {
+        *value = 0;
+        return operand->offset;
+    }
+    if (i < operand->size) {
+        *words = operand->words + (i - operand->offset);
+        return operand->size;
+    }
+    *value = operand->trailing_bits;
+    return PY_SSIZE_T_MAX;
+}
+
+static Py_ssize_t intBitSetSegments(const IntBitSetOperand *const x, const IntBitSetOperand *const y, register const Py_ssize_t i, register const Py_ssize_t end, const word_t **const xwords, word_t *const xvalue, const word_t **const ywords, word_t *const yvalue) {
+    // Return the end, up to end, of the segment starting at word i along
+    // which neither x nor y changes of kind.
+    register Py_ssize_t next = intBitSetSegment(x, i, xwords, xvalue);
+    register Py_ssize_t ynext = intBitSetSegment(y, i, ywords, yvalue);
+    if (ynext < next)
+        next = ynext;
+    return (end < next) ? end : next;
+}
+
+// Number of words processed at once by the k-way kernels, so that the
+// block of the result being computed stays in the L1 cache.
+#define INTBITSET_BLOCK 512
+
+static void intBitSetManyRun(const IntBitSetJob *const job, const Py_ssize_t first, const Py_ssize_t last);
+static Py_ssize_t intBitSetExprRun(const IntBitSetJob *const job, const Py_ssize_t first, const Py_ssize_t last);
+
+static const int intbitset_tables[] = {
+    INTBITSET_TABLE_AND, INTBITSET_TABLE_OR, INTBITSET_TABLE_XOR, INTBITSET_TABLE_ANDNOT
+};
+
+static void intBitSetJobInit(IntBitSetJob *const job, IntBitSet *const x, IntBitSet *const y, const int op) {
+    // Set up job to combine the populated words of x and y, or of x only
+    // if y is NULL, from the first word of the result which might not be
+    // 0, given that the words of both before their offset are.
+    intBitSetGetSize(x);
+    if (y)
+        intBitSetGetSize(y);
+    intBitSetOperandInit(&job->x, x);
+    intBitSetOperandInit(&job->y, y);
+    job->dst = NULL;
+    job->op = op;
+    job->bitsets = NULL;
+    job->program = NULL;
+    if (op == INTBITSET_OP_ANDNOT)
+        job->offset = job->x.offset;
+    else if (op == INTBITSET_OP_AND)
+        job->offset = (job->x.offset > job->y.offset) ? job->x.offset : job->y.offset;
+    else
+        job->offset = (job->x.offset < job->y.offset) ? job->x.offset : job->y.offset;
+    job->nwords = ((job->x.size > job->y.size) ? job->x.size : job->y.size) - job->offset;
+}
+
+IntBitSet *intBitSetOpPrepare(IntBitSet *const x, IntBitSet *const y, const int op, IntBitSetJob *const job) {
+    register IntBitSet *ret = intBitSetNew();
+    register int table = intbitset_tables[op];
+    register word_t trailing_bits = INTBITSET_TABLE(table, x->trailing_bits, y->trailing_bits) ? (word_t) ~0 : 0;
+    register Py_ssize_t common;
+    register int bit_zero;
+    register int bit_one;
+    intBitSetJobInit(job, x, y, op);
+    // The rest of the result, beyond the populated words the two operands
+    // have in common, might be made of trailing_bits only.
+    if (x->size > y->size) {
+        common = y->size;
+        bit_zero = INTBITSET_TABLE(table, 0, y->trailing_bits);
+        bit_one = INTBITSET_TABLE(table, 1, y->trailing_bits);
+    } else {
+        common = x->size;
+        bit_zero = INTBITSET_TABLE(table, x->trailing_bits, 0);
+        bit_one = INTBITSET_TABLE(table, x->trailing_bits, 1);
+    }
+    if (bit_zero == bit_one && bit_zero == (trailing_bits != 0)) {
+        if (common < job->offset)
+            job->offset = common;
+        job->nwords = common - job->offset;
+    }
+    ret->offset = (int) job->offset;
+    ret->allocated = (int) (job->offset + job->nwords + 1);
+    ret->bitset = intBitSetMalloc(wordbytesize * (job->nwords + 1));
     ret->size = -1;
     ret->tot = -1;
-    for (; xbase < xend; ++xbase, ++ybase, ++retbase)
-        *(retbase) = *(xbase) | *(ybase);
-    ret->trailing_bits = x->trailing_bits | y->trailing_bits;
+    ret->version = 0;
+    ret->ranks = NULL;
+    ret->borrowed = 0;
+    ret->shares = NULL;
+    ret->bitset[job->nwords] = trailing_bits;
+    ret->trailing_bits = trailing_bits;
+    job->dst = ret->bitset;
     return ret;
 }
 
-IntBitSet *intBitSetXor(IntBitSet *const x, IntBitSet *const y) {
-    register word_t *xbase;
-    register word_t *xend;
-    register word_t *ybase;
-    register word_t *retbase;
-    register IntBitSet * ret = PyMem_Malloc(sizeof (IntBitSet));
-    ret->allocated = intBitSetAdaptMax(x, y);
-    xbase = x->bitset;
-    xend = x->bitset+ret->allocated;
-    ybase = y->bitset;
-    retbase = ret->bitset = PyMem_Malloc(wordbytesize * ret->allocated);
-    ret->size = -1;
-    ret->tot = -1;
-    for (; xbase < xend; ++xbase, ++ybase, ++retbase)
-        *(retbase) = *(xbase) ^ *(ybase);
-    ret->trailing_bits = x->trailing_bits ^ y->trailing_bits;
+IntBitSet *intBitSetIOpPrepare(IntBitSet *const dst, IntBitSet *const src, const int op, IntBitSetJob *const job) {
+    register int sizesrc = intBitSetGetSize(src);
+    register int table = intbitset_tables[op];
+    register word_t trailing_bits = INTBITSET_TABLE(table, dst->trailing_bits, src->trailing_bits) ? (word_t) ~0 : 0;
+    // Only dst is resized, to hold the populated words of src, and, if
+    // they can be part of the result, the ones before its own.
+    if ((op == INTBITSET_OP_OR || op == INTBITSET_OP_XOR) && src->offset < dst->offset)
+        intBitSetSetOffset(dst, src->offset);
+    if (sizesrc >= dst->allocated)
+        intBitSetResize(dst, sizesrc + 1);
+    intBitSetJobInit(job, dst, src, op);
+    // The words of dst before the first one of the result are cleared too.
+    job->nwords += job->offset - dst->offset;
+    job->offset = dst->offset;
+    job->dst = dst->bitset;
+    if (trailing_bits != dst->trailing_bits)
+        intBitSetFillTail(dst, (int) (job->offset + job->nwords), trailing_bits);
+    intBitSetChanged(dst);
+    dst->trailing_bits = trailing_bits;
+    return dst;
+}
+
+bool_t intBitSetOpCountPrepare(IntBitSet *const x, IntBitSet *const y, const int op, IntBitSetJob *const job) {
+    if (y ? INTBITSET_TABLE(intbitset_tables[op], x->trailing_bits, y->trailing_bits) : x->trailing_bits != 0)
+        return 0;
+    intBitSetJobInit(job, x, y, op);
+    return 1;
+}
+
+Py_ssize_t intBitSetJobRun(const IntBitSetJob *const job, const Py_ssize_t lo, const Py_ssize_t hi) {
+    // Neither operand is resized: the words of the result are computed by
+    // segments along which each operand is either made of its populated
+    // words or constant, i.e. 0 before its offset and trailing_bits
+    // beyond its size. The kernels combine the words of both; words
+    // combined with a constant are either kept as they are, complemented,
+    // cleared or set, depending on the operation. When counting, the
+    // result is finite, so that its words beyond both operands are empty.
+    register const int table = intbitset_tables[job->op];
+    register const Py_ssize_t end = job->offset + hi;
+    register Py_ssize_t i;
+    register Py_ssize_t next;
+    register Py_ssize_t n;
+    register Py_ssize_t tot = 0;
+    register Py_ssize_t count;
+    register word_t *dst = NULL;
+    register int bit_zero;
+    register int bit_one;
+    const word_t *x;
+    const word_t *y;
+    word_t xvalue;
+    word_t yvalue;
+    if (job->program)
+        return intBitSetExprRun(job, lo, hi);
+    if (job->bitsets) {
+        intBitSetManyRun(job, lo, hi);
+        return 0;
+    }
+    for (i = job->offset + lo; i < end; i = next) {
+        next = intBitSetSegments(&job->x, &job->y, i, end, &x, &xvalue, &y, &yvalue);
+        n = next - i;
+        if (job->dst)
+            dst = job->dst + (i - job->offset);
+        if (x && y) {
+            if (dst) switch (job->op) {
+                case INTBITSET_OP_AND: intBitSetKernelAnd(dst, x, y, n); break;
+                case INTBITSET_OP_OR: intBitSetKernelOr(dst, x, y, n); break;
+                case INTBITSET_OP_XOR: intBitSetKernelXor(dst, x, y, n); break;
+                default: intBitSetKernelAndNot(dst, x, y, n);
+            } else switch (job->op) {
+                case INTBITSET_OP_AND: tot += intBitSetKernelAndCount(x, y, n); break;
+                case INTBITSET_OP_OR: tot += intBitSetKernelOrCount(x, y, n); break;
+                case INTBITSET_OP_XOR: tot += intBitSetKernelXorCount(x, y, n); break;
+                default: tot += intBitSetKernelAndNotCount(x, y, n);
+            }
+            continue;
+        }
+        if (x) {
+            bit_zero = INTBITSET_TABLE(table, 0, yvalue);
+            bit_one = INTBITSET_TABLE(table, 1, yvalue);
+        } else if (y) {
+            bit_zero = INTBITSET_TABLE(table, xvalue, 0);
+            bit_one = INTBITSET_TABLE(table, xvalue, 1);
+            x = y;
+        } else {
+            // Both are constant.
+            bit_zero = bit_one = INTBITSET_TABLE(table, xvalue, yvalue);
+            x = dst;
+        }
+        if (dst) {
+            intBitSetOpRest(dst, x, n, bit_zero, bit_one);
+        } else if (bit_zero != bit_one) {
+            count = intBitSetKernelPopCount(x, n);
+            tot += bit_one ? count : n * wordbitsize - count;
+        } else if (bit_one) {
+            tot += n * wordbitsize;
+        }
+    }
+    return tot;
+}
+
+static IntBitSet *intBitSetOp(IntBitSet *const x, IntBitSet *const y, const int op) {
+    IntBitSetJob job;
+    register IntBitSet *ret = intBitSetOpPrepare(x, y, op, &job);
+    intBitSetJobRun(&job, 0, job.nwords);
     return ret;
 }
 
+static IntBitSet *intBitSetIOp(IntBitSet *const dst, IntBitSet *const src, const int op) {
+    IntBitSetJob job;
+    intBitSetIOpPrepare(dst, src, op, &job);
+    intBitSetJobRun(&job, 0, job.nwords);
+    return dst;
+}
+
+IntBitSet *intBitSetUnion(IntBitSet *const x, IntBitSet *const y) {
+    return intBitSetOp(x, y, INTBITSET_OP_OR);
+}
+
+IntBitSet *intBitSetXor(IntBitSet *const x, IntBitSet *const y) {
+    return intBitSetOp(x, y, INTBITSET_OP_XOR);
+}
+
 IntBitSet *intBitSetIntersection(IntBitSet *const x, IntBitSet *const y) {
-    register word_t *xbase;
-    register word_t *xend;
-    register word_t *ybase;
-    register word_t *retbase;
-    register IntBitSet * ret = PyMem_Malloc(sizeof (IntBitSet));
-    ret->allocated = intBitSetAdaptMin(x, y);
-    xbase = x->bitset;
-    xend = x->bitset+ret->allocated;
-    ybase = y->bitset;
-    retbase = ret->bitset = PyMem_Malloc(wordbytesize * ret->allocated);
-    ret->size = -1;
-    ret->tot = -1;
-    for (; xbase < xend; ++xbase, ++ybase, ++retbase)
-        *(retbase) = *(xbase) & *(ybase);
-    ret->trailing_bits = x->trailing_bits & y->trailing_bits;
-    return ret;
+    return intBitSetOp(x, y, INTBITSET_OP_AND);
 }
 
 IntBitSet *intBitSetSub(IntBitSet *const x, IntBitSet *const y) {
-    register word_t *xbase;
-    register word_t *ybase;
-    register word_t *retbase;
-    register word_t *retend;
-    register IntBitSet * ret = PyMem_Malloc(sizeof (IntBitSet));
-    register int tmpsize = intBitSetAdaptMin(x, y);
-    register word_t trailing_bits;
-    ret->allocated = x->allocated > tmpsize ? x->allocated : tmpsize;
-    xbase = x->bitset;
-    ybase = y->bitset;
-    retbase = ret->bitset = PyMem_Malloc(wordbytesize * ret->allocated);
-    retend = ret->bitset+tmpsize;
-    ret->size = -1;
-    ret->tot = -1;
-    for (; retbase < retend; ++xbase, ++ybase, ++retbase)
-        *(retbase) = *(xbase) & ~*(ybase);
-    retend = ret->bitset+ret->allocated;
-    trailing_bits = y->trailing_bits;
-    for (; retbase < retend; ++xbase, ++retbase)
-        *retbase = *xbase & ~trailing_bits;
-    ret->trailing_bits = x->trailing_bits & ~y->trailing_bits;
-    return ret;
+    return intBitSetOp(x, y, INTBITSET_OP_ANDNOT);
 }
 
 IntBitSet *intBitSetIUnion(IntBitSet *const dst, IntBitSet *const src) {
-    register word_t *dstbase;
-    register word_t *srcbase;
-    register word_t *srcend;
-    register int allocated = intBitSetAdaptMax(dst, src);
-    dstbase = dst->bitset;
-    srcbase = src->bitset;
-    srcend = src->bitset + allocated;
-    for (; srcbase < srcend; ++dstbase, ++srcbase)
-        *dstbase |= *srcbase;
-    dst->size = -1;
-    dst->tot = -1;
-    dst->trailing_bits |= src->trailing_bits;
-    return dst;
+    return intBitSetIOp(dst, src, INTBITSET_OP_OR);
 }
 
 IntBitSet *intBitSetIXor(IntBitSet *const dst, IntBitSet *const src) {
-    register word_t *dstbase;
-    register word_t *srcbase;
-    register word_t *srcend;
-    register int allocated = intBitSetAdaptMax(dst, src);
-    dstbase = dst->bitset;
-    srcbase = src->bitset;
-    srcend = src->bitset + allocated;
-    for (; srcbase < srcend; ++dstbase, ++srcbase)
-        *dstbase ^= *srcbase;
-    dst->size = -1;
-    dst->tot = -1;
-    dst->trailing_bits ^= src->trailing_bits;
-    return dst;
+    return intBitSetIOp(dst, src, INTBITSET_OP_XOR);
 }
 
 IntBitSet *intBitSetIIntersection(IntBitSet *const dst, IntBitSet *const src) {
-    register word_t *dstbase;
-    register word_t *srcbase;
-    register word_t *dstend;
-    dst->allocated = intBitSetAdaptMin(dst, src);
-    dstbase = dst->bitset;
-    srcbase = src->bitset;
-    dstend = dst->bitset + dst->allocated;
-    for (; dstbase < dstend; ++dstbase, ++srcbase)
-        *dstbase &= *srcbase;
-    dst->size = -1;
-    dst->tot = -1;
-    dst->trailing_bits &= src->trailing_bits;
-    return dst;
+    return intBitSetIOp(dst, src, INTBITSET_OP_AND);
 }
 
 IntBitSet *intBitSetISub(IntBitSet *const dst, IntBitSet *const src) {
-    register word_t *dstbase;
-    register word_t *srcbase;
-    register word_t *dstend;
-    register int allocated = intBitSetAdaptMin(dst, src);
-    register word_t trailing_bits;
-    dstbase = dst->bitset;
-    srcbase = src->bitset;
-    dstend = dst->bitset + allocated;
-    for (; dstbase < dstend; ++dstbase, ++srcbase)
-        *dstbase &= ~*srcbase;
-    dstend = dst->bitset + dst->allocated;
-    trailing_bits = src->trailing_bits;
-    for (; dstbase < dstend; ++dstbase)
-        *dstbase &= ~trailing_bits;
-    dst->size = -1;
-    dst->tot = -1;
-    dst->trailing_bits &= ~src->trailing_bits;
-    return dst;
+    return intBitSetIOp(dst, src, INTBITSET_OP_ANDNOT);
 }
 
-bool_t intBitSetIsDisjoint(const IntBitSet * const x, const IntBitSet * const y) {
-  word_t *xword;
-  word_t *xend;
-  word_t *yword;
-
-  xword = x->bitset;
-  xend = x->bitset + intBitSetAdaptMin(x, y);
-  yword = y->bitset;
+static bool_t intBitSetRestIsConstant(register const word_t *base, register const word_t *const end, register const word_t trailing_bits) {
+    // Whether all the words in [base, end) equal trailing_bits.
+    for (; base < end; ++base)
+        if (*base != trailing_bits)
+            return 0;
+    return 1;
+}
 
-  for (; xword < xend; ++xword, ++yword) {
-    if ((*xword & *yword) != 0x0)
-      return 0;  // Not disjoint
-  }
+bool_t intBitSetIsDisjoint(IntBitSet *const x, IntBitSet *const y) {
+    IntBitSetOperand xoperand;
+    IntBitSetOperand yoperand;
+    register Py_ssize_t i;
+    register Py_ssize_t next;
+    register Py_ssize_t end;
+    const word_t *xwords;
+    const word_t *ywords;
+    word_t xvalue;
+    word_t yvalue;
+    if (x->trailing_bits & y->trailing_bits)
+        return 0;
+    intBitSetGetSize(x);
+    intBitSetGetSize(y);
+    intBitSetOperandInit(&xoperand, x);
+    intBitSetOperandInit(&yoperand, y);
+    end = (x->size > y->size) ? x->size : y->size;
+    // Where one operand is constant, the elements of the other one
+    // intersect it only if it is full. Before the offset of either, it is
+    // empty.
+    i = (x->offset > y->offset) ? x->offset : y->offset;
+    for (; i < end; i = next) {
+        next = intBitSetSegments(&xoperand, &yoperand, i, end, &xwords, &xvalue, &ywords, &yvalue);
+        if (xwords && ywords) {
+            if (intBitSetKernelIntersects(xwords, ywords, next - i))
+                return 0;  // Not disjoint
+        } else if (xwords) {
+            if (yvalue && !intBitSetRestIsConstant(xwords, xwords + (next - i), 0))
+                return 0;
+        } else if (ywords) {
+            if (xvalue && !intBitSetRestIsConstant(ywords, ywords + (next - i), 0))
+                return 0;
+        } else if (xvalue & yvalue) {
+            return 0;
+        }
+    }
+    return 1;
+}
 
-  return ((x->trailing_bits & y->trailing_bits) != 0) ? 0 : 1;
+static int intBitSetFindPrev(const IntBitSet *const x, register const int first, register const word_t mask) {
+    // Return the biggest element in the words of x up to first, whose bits
+    // are masked by mask, or -1 if there is none.
+    register word_t *base;
+    register word_t word;
+    // The words before the offset, such as the ones of an empty populated
+    // region, are empty.
+    if (first < x->offset)
+        return -1;
+    base = x->bitset + (first - x->offset);
+    word = *base & mask;
+    while (!word && base > x->bitset)
+        word = *(--base);
+    if (word)
+        return wordbitsize - 1 - intbitset_clz(word) + (int) (base - x->bitset + x->offset) * wordbitsize;
+    return -1;
 }
 
 int intBitSetGetLast(const IntBitSet *const x) {
-    register word_t *base = x->bitset;
-    register word_t *end = x->bitset + x->allocated;
-    register int i;
     if (x->trailing_bits) return -2;
-    while (base < end) {
-        if (*(--end))
-            for (i=wordbitsize-1; i>=0; --i)
-                if ((*end & ((word_t) 1 << (word_t) i)))
-                    return (int) i + (int) (end - x->bitset) * wordbitsize;
+    // Beyond the populated words, if they are known, there is nothing.
+    return intBitSetFindPrev(x, ((x->size >= 0) ? x->size : x->allocated) - 1, (word_t) ~0);
+}
+
+int intBitSetGetPrev(const IntBitSet *const x, register int last) {
+    register int first = --last / wordbitsize;
+    register const int end = (x->size >= 0) ? x->size : x->allocated;
+    if (last < 0 || first < x->offset)
+        return -1;
+    // The words from the populated (or else allocated) ones on are the
+    // trailing_bits.
+    if (first >= end) {
+        if (x->trailing_bits)
+            return last;
+        first = end - 1;
+        last = wordbitsize - 1;
     }
-    return -1;
+    return intBitSetFindPrev(x, first, (word_t) ~0 >> (word_t) (wordbitsize - 1 - last % wordbitsize));
 }
 
 int intBitSetGetNext(const IntBitSet *const x, register int last) {
-    register word_t *base = x->bitset + (++last / wordbitsize);
-    register int i = last % wordbitsize;
-    register word_t *end = x->bitset + x->allocated;
-    while(base < end) {
-        if (*base)
-            for (; i<wordbitsize; ++i)
-                if ((*base & ((word_t) 1 << (word_t) i)))
-                    return (int) i + (int) (base - x->bitset) * wordbitsize;
-        i = 0;
-        ++base;
+    register int first = ++last / wordbitsize;
+    register word_t mask = (word_t) ~0 << (word_t) (last % wordbitsize);
+    register word_t *base;
+    register word_t *end;
+    register word_t word;
+    // The words before the offset are empty.
+    if (first < x->offset) {
+        first = x->offset;
+        mask = (word_t) ~0;
+    }
+    base = x->bitset + (first - x->offset);
+    // Beyond the populated words of a finite bitset there is nothing left.
+    if (x->size >= 0 && !x->trailing_bits)
+        end = x->bitset + x->size - x->offset;
+    else
+        end = x->bitset + x->allocated - x->offset;
+    if (base < end) {
+        // Skip the bits up to last in its own word, then the empty words.
+        word = *base & mask;
+        while (!word && ++base < end)
+            word = *base;
+        if (word)
+            return intbitset_ctz(word) + (int) (base - x->bitset + x->offset) * wordbitsize;
     }
     return x->trailing_bits ? last : -2;
 }
 
+int intBitSetGetNextMany(const IntBitSet *const x, register int last, unsigned int *const out, register const int n) {
+    register int first = ++last / wordbitsize;
+    register word_t mask = (word_t) ~0 << (word_t) (last % wordbitsize);
+    register word_t *base;
+    register word_t *end = x->bitset + ((x->size >= 0) ? x->size : x->allocated) - x->offset;
+    register word_t word;
+    register int offset;
+    register int ret = 0;
+    if (first < x->offset) {
+        first = x->offset;
+        mask = (word_t) ~0;
+    }
+    base = x->bitset + (first - x->offset);
+    if (base >= end || n <= 0)
+        return 0;
+    word = *base & mask;
+    for (;;) {
+        offset = (int) (base - x->bitset + x->offset) * wordbitsize;
+        for (; word && ret < n; word &= word - 1)
+            out[ret++] = (unsigned int) (intbitset_ctz(word) + offset);
+        if (ret == n || ++base >= end)
+            return ret;
+        word = *base;
+    }
+}
+
+IntBitSet *intBitSetReplace(IntBitSet *const dst, IntBitSet *const src) {
+    // Move the content of src, which is destroyed, into dst: dst stays the
+    // same object as far as its users are concerned.
+    register unsigned long long version = dst->version;
+    intBitSetFreeWords(dst);
+    if (dst->ranks)
+        PyMem_Free(dst->ranks);
+    intBitSetAssign(dst, src);
+    intBitSetDelete(src);
+    dst->version = version;
+    intBitSetChanged(dst);
+    return dst;
+}
+
+Py_hash_t intBitSetHash(IntBitSet *const bitset) {
+    // Hash the populated words, from the first non empty one to the last
+    // one which is not trailing_bits, and trailing_bits, which equal
+    // bitsets have in common whatever their allocation and offset, mixing
+    // each word as xxHash64 does and finalizing as splitmix64 does.
+    register const word_t *const words = bitset->bitset;
+    register const int offset = bitset->offset;
+    register int first = offset;
+    register int last = intBitSetGetSize(bitset);
+    register word_t hash;
+    register int i;
+    for (; last > first && words[last - 1 - offset] == bitset->trailing_bits; --last);
+    // The words before the offset are 0 too.
+    if (last == offset && !bitset->trailing_bits)
+        first = last = 0;
+    for (; first < last && !words[first - offset]; ++first);
+    hash = ((word_t) first * INTBITSET_HASH_PRIME2) ^ ((word_t) last * INTBITSET_HASH_PRIME1) ^ bitset->trailing_bits;
+    for (i = first; i < last; ++i) {
+        hash ^= words[i - offset] * INTBITSET_HASH_PRIME2;
+        hash = ((hash << 31) | (hash >> 33)) * INTBITSET_HASH_PRIME1;
+    }
+    hash ^= hash >> 30;
+    hash *= 0xbf58476d1ce4e5b9ULL;
+    hash ^= hash >> 27;
+    hash *= 0x94d049bb133111ebULL;
+    hash ^= hash >> 31;
+    // -1 is an error for Python.
+    return ((Py_hash_t) hash == -1) ? -2 : (Py_hash_t) hash;
+}
+
 unsigned char intBitSetCmp(IntBitSet *const x, IntBitSet *const y) {
-    register word_t *xbase;
-    register word_t *xend;
-    register word_t *ybase;
-    register unsigned char ret = 0;
-    register int allocated = intBitSetAdaptMax(x, y);
-    xbase = x->bitset;
-    xend = x->bitset+allocated;
-    ybase = y->bitset;
-    for (; ret != 3 && xbase<xend; ++xbase, ++ybase)
-        ret |= (*ybase != (*xbase | *ybase)) * 2 + (*xbase != (*xbase | *ybase));
-    ret |= (y->trailing_bits != (x->trailing_bits | y->trailing_bits)) * 2 + (x->trailing_bits != (x->trailing_bits | y->trailing_bits));
+    register unsigned char ret;
+    IntBitSetOperand xoperand;
+    IntBitSetOperand yoperand;
+    register Py_ssize_t i;
+    register Py_ssize_t next;
+    register Py_ssize_t end;
+    const word_t *xwords;
+    const word_t *ywords;
+    word_t xvalue;
+    word_t yvalue;
+    intBitSetGetSize(x);
+    intBitSetGetSize(y);
+    intBitSetOperandInit(&xoperand, x);
+    intBitSetOperandInit(&yoperand, y);
+    end = (x->size > y->size) ? x->size : y->size;
+    ret = (y->trailing_bits != (x->trailing_bits | y->trailing_bits)) * 2 + (x->trailing_bits != (x->trailing_bits | y->trailing_bits));
+    // Where one operand is constant, i.e. empty before its offset and
+    // trailing_bits beyond its size, the other one differs from it by the
+    // elements only one has.
+    i = (x->offset < y->offset) ? x->offset : y->offset;
+    for (; i < end && ret != 3; i = next) {
+        next = intBitSetSegments(&xoperand, &yoperand, i, end, &xwords, &xvalue, &ywords, &yvalue);
+        if (xwords && ywords) {
+            ret |= intBitSetKernelCmp(xwords, ywords, next - i);
+        } else if (xwords) {
+            if (!intBitSetRestIsConstant(xwords, xwords + (next - i), yvalue))
+                ret |= yvalue ? 1 : 2;
+        } else if (ywords) {
+            if (!intBitSetRestIsConstant(ywords, ywords + (next - i), xvalue))
+                ret |= xvalue ? 2 : 1;
+        } else if (xvalue != yvalue) {
+            ret |= xvalue ? 2 : 1;
+        }
+    }
+    return ret;
+}
+
+static int intBitSetOpCount(IntBitSet *const x, IntBitSet *const y, const int op) {
+    IntBitSetJob job;
+    if (!intBitSetOpCountPrepare(x, y, op, &job))
+        return -1;
+    return (int) intBitSetJobRun(&job, 0, job.nwords);
+}
+
+int intBitSetIntersectionCount(IntBitSet *const x, IntBitSet *const y) {
+    return intBitSetOpCount(x, y, INTBITSET_OP_AND);
+}
+
+int intBitSetUnionCount(IntBitSet *const x, IntBitSet *const y) {
+    return intBitSetOpCount(x, y, INTBITSET_OP_OR);
+}
+
+int intBitSetSubCount(IntBitSet *const x, IntBitSet *const y) {
+    return intBitSetOpCount(x, y, INTBITSET_OP_ANDNOT);
+}
+
+int intBitSetXorCount(IntBitSet *const x, IntBitSet *const y) {
+    return intBitSetOpCount(x, y, INTBITSET_OP_XOR);
+}
+
+static int intBitSetCmpForIntersection(const void *x, const void *y) {
+    // Finite bitsets first, the smallest first: these are the ones that
+    // zero the running result the soonest.
+    const IntBitSet *const a = *(IntBitSet *const *) x;
+    const IntBitSet *const b = *(IntBitSet *const *) y;
+    if ((a->trailing_bits != 0) != (b->trailing_bits != 0))
+        return (a->trailing_bits != 0) - (b->trailing_bits != 0);
+    return (a->size > b->size) - (a->size < b->size);
+}
+
+IntBitSet *intBitSetManyPrepare(IntBitSet *const *const bitsets, const int n, const bool_t intersection, IntBitSetJob *const job) {
+    register IntBitSet *ret = intBitSetNew();
+    register int i;
+    int size = 0;
+    int offset = intersection ? 0 : maxelem;
+    word_t trailing_bits = intersection ? (word_t) ~0 : 0;
+    job->bitsets = PyMem_Malloc(n * sizeof (IntBitSet *));
+    for (i = 0; i < n; ++i) {
+        if (intBitSetGetSize(bitsets[i]) > size)
+            size = bitsets[i]->size;
+        // The result is empty before the offset of any bitset intersected,
+        // or of all the bitsets united.
+        if (intersection ? bitsets[i]->offset > offset : bitsets[i]->offset < offset)
+            offset = bitsets[i]->offset;
+        if (intersection)
+            trailing_bits &= bitsets[i]->trailing_bits;
+        else
+            trailing_bits |= bitsets[i]->trailing_bits;
+        job->bitsets[i] = bitsets[i];
+    }
+    if (intersection) {
+        qsort(job->bitsets, n, sizeof (IntBitSet *), intBitSetCmpForIntersection);
+        // Beyond the smallest finite bitset, or beyond the biggest one if
+        // they are all infinite, the result is made of trailing_bits.
+        size = trailing_bits ? job->bitsets[n - 1]->size : job->bitsets[0]->size;
+    }
+    if (offset > size)
+        offset = size;
+    ret->offset = offset;
+    ret->allocated = size + 1;
+    ret->bitset = intBitSetMalloc(wordbytesize * (size - offset + 1));
+    ret->bitset[size - offset] = trailing_bits;
+    ret->trailing_bits = trailing_bits;
+    ret->size = -1;
+    ret->tot = -1;
+    ret->version = 0;
+    ret->ranks = NULL;
+    ret->borrowed = 0;
+    ret->shares = NULL;
+    job->dst = ret->bitset;
+    job->offset = offset;
+    job->nwords = size - offset;
+    job->op = intersection ? INTBITSET_OP_AND : INTBITSET_OP_OR;
+    job->n = n;
+    job->program = NULL;
+    return ret;
+}
+
+static void intBitSetManyRun(const IntBitSetJob *const job, const Py_ssize_t first, const Py_ssize_t last) {
+    // The words are computed by blocks, each of them being combined with
+    // all the bitsets before moving to the next one. Along each segment of
+    // a block, a bitset is either made of its populated words or constant.
+    register word_t *dst;
+    register Py_ssize_t i;
+    register Py_ssize_t j;
+    register Py_ssize_t lo;
+    register Py_ssize_t hi;
+    register Py_ssize_t next;
+    IntBitSetOperand operand;
+    const word_t *words;
+    word_t value;
+    for (lo = job->offset + first; lo < job->offset + last; lo += INTBITSET_BLOCK) {
+        hi = (lo + INTBITSET_BLOCK < job->offset + last) ? lo + INTBITSET_BLOCK : job->offset + last;
+        dst = job->dst + (lo - job->offset);
+        for (j = 0; j < job->n; ++j) {
+            intBitSetOperandInit(&operand, job->bitsets[j]);
+            // Nothing left to intersect in this block.
+            if (j && job->op == INTBITSET_OP_AND && !intBitSetKernelIntersects(dst, dst, hi - lo))
+                break;
+            for (i = lo; i < hi; i = next) {
+                next = intBitSetSegment(&operand, i, &words, &value);
+                if (next > hi)
+                    next = hi;
+                if (!j) {
+                    // The first bitset is copied.
+                    if (words)
+                        memcpy(dst + (i - lo), words, (next - i) * wordbytesize);
+                    else
+                        intBitSetOpRest(dst + (i - lo), dst + (i - lo), next - i, value != 0, value != 0);
+                } else if (words) {
+                    if (job->op == INTBITSET_OP_OR)
+                        intBitSetKernelOr(dst + (i - lo), dst + (i - lo), words, next - i);
+                    else
+                        intBitSetKernelAnd(dst + (i - lo), dst + (i - lo), words, next - i);
+                } else if ((job->op == INTBITSET_OP_OR) == (value != 0)) {
+                    // Set by a union with ones, cleared by an intersection
+                    // with zeros.
+                    intBitSetOpRest(dst + (i - lo), dst + (i - lo), next - i, value != 0, value != 0);
+                }
+            }
+        }
+    }
+}
+
+void intBitSetJobDone(IntBitSetJob *const job) {
+    PyMem_Free(job->bitsets);
+    job->bitsets = NULL;
+}
+
+IntBitSet *intBitSetUnionMany(IntBitSet *const *const bitsets, const int n) {
+    IntBitSetJob job;
+    register IntBitSet *ret = intBitSetManyPrepare(bitsets, n, 0, &job);
+    intBitSetJobRun(&job, 0, job.nwords);
+    intBitSetJobDone(&job);
+    return ret;
+}
+
+IntBitSet *intBitSetIntersectionMany(IntBitSet *const *const bitsets, const int n) {
+    IntBitSetJob job;
+    register IntBitSet *ret = intBitSetManyPrepare(bitsets, n, 1, &job);
+    intBitSetJobRun(&job, 0, job.nwords);
+    intBitSetJobDone(&job);
+    return ret;
+}
+
+// Words of the stack of an expression job, on the C stack of each thread
+// running it: blocks of the result are computed in as many words as the
+// stack allows, up to INTBITSET_BLOCK, and at least a cache line.
+#define INTBITSET_EXPR_WORDS (INTBITSET_EXPR_DEPTH * 8)
+
+typedef struct {
+    // What is known of an entry of the stack of an expression: its words
+    // are all lead before first, and all trailing_bits from last.
+    Py_ssize_t first;
+    Py_ssize_t last;
+    word_t lead;
+    word_t trailing_bits;
+} IntBitSetExprShape;
+
+static word_t intBitSetExprInit(IntBitSet *const *const bitsets, const int n, const int *const program, const int length, IntBitSetJob *const job) {
+    // Set up job to evaluate program, from the first word of the result
+    // which might not be 0, up to the last one which might not be its
+    // trailing_bits, which are returned.
+    register IntBitSetExprShape *shapes = PyMem_Malloc((length + 1) * sizeof (IntBitSetExprShape));
+    register IntBitSetExprShape *x;
+    register IntBitSetExprShape *y;
+    register int pc;
+    register int top = 0;
+    register int table;
+    register Py_ssize_t first;
+    register Py_ssize_t last;
+    word_t trailing_bits;
+    job->bitsets = PyMem_Malloc(n * sizeof (IntBitSet *));
+    for (pc = 0; pc < n; ++pc) {
+        intBitSetGetSize(bitsets[pc]);
+        job->bitsets[pc] = bitsets[pc];
+    }
+    job->n = n;
+    job->program = program;
+    job->length = length;
+    job->depth = 0;
+    job->dst = NULL;
+    job->op = INTBITSET_OP_AND;
+    // A bitset combined right away with the top entry of the stack needs
+    // no entry of its own.
+    for (pc = 0; pc < length; ++pc) {
+        if (program[pc] >= 0 && top && pc + 1 < length && program[pc + 1] < 0 && program[pc + 1] != INTBITSET_EXPR_NOT)
+            ++pc;
+        else if (program[pc] >= 0 && ++top > job->depth)
+            job->depth = top;
+        else if (program[pc] < 0 && program[pc] != INTBITSET_EXPR_NOT)
+            --top;
+    }
+    top = 0;
+    for (pc = 0; pc < length; ++pc) {
+        if (program[pc] >= 0) {
+            x = shapes + top++;
+            x->first = bitsets[program[pc]]->offset;
+            x->last = bitsets[program[pc]]->size;
+            x->lead = 0;
+            x->trailing_bits = bitsets[program[pc]]->trailing_bits;
+        } else if (program[pc] == INTBITSET_EXPR_NOT) {
+            x = shapes + top - 1;
+            x->lead = ~x->lead;
+            x->trailing_bits = ~x->trailing_bits;
+        } else {
+            table = intbitset_tables[-1 - program[pc]];
+            x = shapes + top - 2;
+            y = shapes + --top;
+            // Both are constant before the first of the two firsts, and
+            // either may be enough to make the result constant up to its
+            // own first; likewise from the last of the two lasts.
+            first = (x->first < y->first) ? x->first : y->first;
+            if (INTBITSET_TABLE(table, x->lead, 0) == INTBITSET_TABLE(table, x->lead, 1) && x->first > first)
+                first = x->first;
+            if (INTBITSET_TABLE(table, 0, y->lead) == INTBITSET_TABLE(table, 1, y->lead) && y->first > first)
+                first = y->first;
+            last = (x->last > y->last) ? x->last : y->last;
+            if (INTBITSET_TABLE(table, x->trailing_bits, 0) == INTBITSET_TABLE(table, x->trailing_bits, 1) && x->last < last)
+                last = x->last;
+            if (INTBITSET_TABLE(table, 0, y->trailing_bits) == INTBITSET_TABLE(table, 1, y->trailing_bits) && y->last < last)
+                last = y->last;
+            x->first = first;
+            x->last = last;
+            x->lead = INTBITSET_TABLE(table, x->lead, y->lead) ? (word_t) ~0 : 0;
+            x->trailing_bits = INTBITSET_TABLE(table, x->trailing_bits, y->trailing_bits) ? (word_t) ~0 : 0;
+        }
+    }
+    // Only the words before the offset of a bitset can be left out.
+    job->offset = shapes[0].lead ? 0 : shapes[0].first;
+    if (job->offset > shapes[0].last)
+        job->offset = shapes[0].last;
+    job->nwords = shapes[0].last - job->offset;
+    trailing_bits = shapes[0].trailing_bits;
+    PyMem_Free(shapes);
+    return trailing_bits;
+}
+
+IntBitSet *intBitSetExprPrepare(IntBitSet *const *const bitsets, const int n, const int *const program, const int length, IntBitSetJob *const job) {
+    register IntBitSet *ret = intBitSetNew();
+    register word_t trailing_bits = intBitSetExprInit(bitsets, n, program, length, job);
+    ret->offset = (int) job->offset;
+    ret->allocated = (int) (job->offset + job->nwords + 1);
+    ret->bitset = intBitSetMalloc(wordbytesize * (job->nwords + 1));
+    ret->size = -1;
+    ret->tot = -1;
+    ret->version = 0;
+    ret->ranks = NULL;
+    ret->borrowed = 0;
+    ret->shares = NULL;
+    ret->bitset[job->nwords] = trailing_bits;
+    ret->trailing_bits = trailing_bits;
+    job->dst = ret->bitset;
+    return ret;
+}
+
+bool_t intBitSetExprCountPrepare(IntBitSet *const *const bitsets, const int n, const int *const program, const int length, IntBitSetJob *const job) {
+    return !intBitSetExprInit(bitsets, n, program, length, job);
+}
+
+static void intBitSetExprApply(word_t *const dst, const IntBitSetOperand *const operand, const Py_ssize_t lo, const Py_ssize_t hi, const int op) {
+    // Combine the words [lo, hi) of dst with the ones of operand by op, or
+    // copy the latter if op is -1.
+    register Py_ssize_t i;
+    register Py_ssize_t next;
+    register word_t *out;
+    const word_t *words;
+    word_t value;
+    for (i = lo; i < hi; i = next) {
+        next = intBitSetSegment(operand, i, &words, &value);
+        if (next > hi)
+            next = hi;
+        out = dst + (i - lo);
+        if (!words) {
+            if (op < 0)
+                intBitSetOpRest(out, out, next - i, value != 0, value != 0);
+            else
+                intBitSetOpRest(out, out, next - i, INTBITSET_TABLE(intbitset_tables[op], 0, value), INTBITSET_TABLE(intbitset_tables[op], 1, value));
+        } else switch (op) {
+            case INTBITSET_OP_AND: intBitSetKernelAnd(out, out, words, next - i); break;
+            case INTBITSET_OP_OR: intBitSetKernelOr(out, out, words, next - i); break;
+            case INTBITSET_OP_XOR: intBitSetKernelXor(out, out, words, next - i); break;
+            case INTBITSET_OP_ANDNOT: intBitSetKernelAndNot(out, out, words, next - i); break;
+            default: memcpy(out, words, (next - i) * wordbytesize);
+        }
+    }
+}
+
+static word_t *intBitSetExprBlock(const IntBitSetJob *const job, word_t *const stack, word_t *const dst, const Py_ssize_t lo, const Py_ssize_t hi, const Py_ssize_t block) {
+    // Evaluate the words [lo, hi) of the result, at most block, with
+    // entries of block words on stack, the first one being dst if it is
+    // not NULL, and return them.
+    register int pc;
+    register int top = 0;
+    register int code;
+    register word_t *x;
+    IntBitSetOperand operand;
+    for (pc = 0; pc < job->length; ++pc) {
+        code = job->program[pc];
+        if (code >= 0) {
+            intBitSetOperandInit(&operand, job->bitsets[code]);
+            if (top && pc + 1 < job->length && job->program[pc + 1] < 0 && job->program[pc + 1] != INTBITSET_EXPR_NOT) {
+                // Combined right away with the top entry.
+                x = (top == 1 && dst) ? dst : stack + (top - 1) * block;
+                intBitSetExprApply(x, &operand, lo, hi, -1 - job->program[++pc]);
+            } else {
+                x = (!top && dst) ? dst : stack + top * block;
+                intBitSetExprApply(x, &operand, lo, hi, -1);
+                ++top;
+            }
+        } else if (code == INTBITSET_EXPR_NOT) {
+            x = (top == 1 && dst) ? dst : stack + (top - 1) * block;
+            intBitSetOpRest(x, x, hi - lo, 1, 0);
+        } else {
+            --top;
+            x = (top == 1 && dst) ? dst : stack + (top - 1) * block;
+            switch (-1 - code) {
+                case INTBITSET_OP_AND: intBitSetKernelAnd(x, x, stack + top * block, hi - lo); break;
+                case INTBITSET_OP_OR: intBitSetKernelOr(x, x, stack + top * block, hi - lo); break;
+                case INTBITSET_OP_XOR: intBitSetKernelXor(x, x, stack + top * block, hi - lo); break;
+                default: intBitSetKernelAndNot(x, x, stack + top * block, hi - lo);
+            }
+        }
+    }
+    return dst ? dst : stack;
+}
+
+static Py_ssize_t intBitSetExprBlockSize(const IntBitSetJob *const job) {
+    // Words of the blocks evaluated at once, a multiple of a cache line.
+    register Py_ssize_t block = (INTBITSET_EXPR_WORDS / (job->depth ? job->depth : 1)) & ~7;
+    return (block > INTBITSET_BLOCK) ? INTBITSET_BLOCK : block;
+}
+
+static Py_ssize_t intBitSetExprRun(const IntBitSetJob *const job, const Py_ssize_t first, const Py_ssize_t last) {
+    // The words are computed by blocks, the whole program being run on
+    // each of them before moving to the next one, so that no intermediate
+    // result is ever allocated, and each word of the bitsets is read once.
+    word_t stack[INTBITSET_EXPR_WORDS];
+    register const Py_ssize_t block = intBitSetExprBlockSize(job);
+    register Py_ssize_t lo;
+    register Py_ssize_t hi;
+    register Py_ssize_t tot = 0;
+    register word_t *words;
+    for (lo = job->offset + first; lo < job->offset + last; lo += block) {
+        hi = (lo + block < job->offset + last) ? lo + block : job->offset + last;
+        words = intBitSetExprBlock(job, stack, job->dst ? job->dst + (lo - job->offset) : NULL, lo, hi, block);
+        if (!job->dst)
+            tot += intBitSetKernelPopCount(words, hi - lo);
+    }
+    return tot;
+}
+
+int intBitSetExprFirst(const IntBitSetJob *const job, unsigned int *const out, const int k, const int last) {
+    word_t stack[INTBITSET_EXPR_WORDS];
+    register const Py_ssize_t block = intBitSetExprBlockSize(job);
+    register Py_ssize_t lo = job->offset;
+    register Py_ssize_t hi;
+    register Py_ssize_t i;
+    register Py_ssize_t elem;
+    register word_t *words;
+    register word_t word;
+    register int ret = 0;
+    // Resume from the word holding the element following last, whose
+    // smaller bits are masked.
+    if ((Py_ssize_t) (last + 1) / wordbitsize > lo)
+        lo = (Py_ssize_t) (last + 1) / wordbitsize;
+    for (; lo < job->offset + job->nwords && ret < k; lo += block) {
+        hi = (lo + block < job->offset + job->nwords) ? lo + block : job->offset + job->nwords;
+        words = intBitSetExprBlock(job, stack, NULL, lo, hi, block);
+        for (i = 0; i < hi - lo && ret < k; ++i) {
+            word = words[i];
+            if ((lo + i) * wordbitsize <= last)
+                word &= (word_t) ~0 << (word_t) ((last + 1) % wordbitsize);
+            for (; word && ret < k; word &= word - 1)
+                out[ret++] = (unsigned int) (intbitset_ctz(word) + (lo + i) * wordbitsize);
+        }
+    }
+    // Beyond the words computed, the result is made of its trailing_bits,
+    // which are the ones an evaluation of the program on nothing gives.
+    if (ret < k && job->nwords >= 0) {
+        words = intBitSetExprBlock(job, stack, NULL, job->offset + job->nwords, job->offset + job->nwords + 1, block);
+        if (words[0])
+            for (elem = ((job->offset + job->nwords) * wordbitsize > last) ? (job->offset + job->nwords) * wordbitsize : last + 1; elem <= maxelem && ret < k; ++elem)
+                out[ret++] = (unsigned int) elem;
+    }
+    return ret;
+}
+
+// Number of words covered by each entry of the rank directory.
+#define INTBITSET_RANK_BLOCK 8
+
+static int *intBitSetGetRanks(IntBitSet *const bitset) {
+    // Build, unless already done since the last change, the rank
+    // directory: ranks[i] is the number of elements in the words before the
+    // i-th block, from the offset up to the populated size.
+    register int i;
+    register int size;
+    register int nblocks;
+    if (!bitset->ranks) {
+        size = intBitSetGetSize(bitset) - bitset->offset;
+        nblocks = (size + INTBITSET_RANK_BLOCK - 1) / INTBITSET_RANK_BLOCK;
+        bitset->ranks = PyMem_Malloc((nblocks + 1) * sizeof(int));
+        bitset->ranks[0] = 0;
+        for (i = 0; i < nblocks; ++i)
+            bitset->ranks[i + 1] = bitset->ranks[i] + (int) intBitSetKernelPopCount(
+                bitset->bitset + i * INTBITSET_RANK_BLOCK,
+                (i + 1 < nblocks) ? INTBITSET_RANK_BLOCK : size - i * INTBITSET_RANK_BLOCK);
+    }
+    return bitset->ranks;
+}
+
+Py_ssize_t intBitSetRank(IntBitSet *const x, register const int elem) {
+    register int *ranks;
+    register int size;
+    register int word = elem / wordbitsize - x->offset;
+    word_t last;
+    if (word < 0)
+        return 0;
+    ranks = intBitSetGetRanks(x);
+    size = x->size - x->offset;
+    if (word >= size)
+        return ranks[(size + INTBITSET_RANK_BLOCK - 1) / INTBITSET_RANK_BLOCK] +
+            (x->trailing_bits ? (Py_ssize_t) elem - (Py_ssize_t) x->size * wordbitsize + 1 : 0);
+    last = x->bitset[word] & ((word_t) ~0 >> (word_t) (wordbitsize - 1 - elem % wordbitsize));
+    return ranks[word / INTBITSET_RANK_BLOCK] +
+        intBitSetKernelPopCount(x->bitset + word - word % INTBITSET_RANK_BLOCK, word % INTBITSET_RANK_BLOCK) +
+        intBitSetKernelPopCount(&last, 1);
+}
+
+int intBitSetSelect(IntBitSet *const x, register Py_ssize_t k) {
+    register int *ranks;
+    register int size;
+    register int lo;
+    register int mid;
+    register int hi;
+    register Py_ssize_t count;
+    register word_t *base;
+    register word_t word;
+    if (k < 0)
+        return -1;
+    ranks = intBitSetGetRanks(x);
+    size = x->size - x->offset;
+    hi = (size + INTBITSET_RANK_BLOCK - 1) / INTBITSET_RANK_BLOCK;
+    if (k >= ranks[hi]) {
+        // Beyond the populated words.
+        if (!x->trailing_bits)
+            return -1;
+        k += (Py_ssize_t) x->size * wordbitsize - ranks[hi];
+        return (k <= maxelem) ? (int) k : -1;
+    }
+    // Last block starting with less than k + 1 elements...
+    lo = 0;
+    --hi;
+    while (lo < hi) {
+        mid = (lo + hi + 1) / 2;
+        if (ranks[mid] <= k)
+            lo = mid;
+        else
+            hi = mid - 1;
+    }
+    // ... then the word holding the element...
+    k -= ranks[lo];
+    base = x->bitset + lo * INTBITSET_RANK_BLOCK;
+    for (; k >= (count = intBitSetKernelPopCount(base, 1)); ++base)
+        k -= count;
+    // ... then the element itself.
+    for (word = *base; k > 0; --k)
+        word &= word - 1;
+    return intbitset_ctz(word) + (int) (base - x->bitset + x->offset) * wordbitsize;
+}
+
+IntBitSet *intBitSetGetRange(const IntBitSet *const x, register const int first, register const int last) {
+    register IntBitSet *ret = intBitSetNew();
+    register int lo = first / wordbitsize;
+    register int hi = last / wordbitsize;
+    register int i;
+    // The words before the one of first are not allocated.
+    ret->offset = lo;
+    ret->allocated = hi + 2;
+    ret->bitset = intBitSetMalloc(wordbytesize * (hi - lo + 2));
+    for (i = lo; i <= hi; ++i)
+        ret->bitset[i - lo] = (i < x->offset) ? 0 : (i < x->allocated) ? x->bitset[i - x->offset] : x->trailing_bits;
+    ret->bitset[0] &= (word_t) ~0 << (word_t) (first % wordbitsize);
+    ret->bitset[hi - lo] &= (word_t) ~0 >> (word_t) (wordbitsize - 1 - last % wordbitsize);
+    ret->bitset[hi - lo + 1] = 0;
+    ret->trailing_bits = 0;
+    ret->size = -1;
+    ret->tot = -1;
+    ret->version = 0;
+    ret->ranks = NULL;
+    ret->borrowed = 0;
+    ret->shares = NULL;
     return ret;
 }
+
+static void intBitSetRangeOp(IntBitSet *const bitset, register Py_ssize_t start, register Py_ssize_t stop, const int op) {
+    // Add, remove or flip the elements in [start, stop): the whole words
+    // between the first and the last one at once, which are masked.
+    register int lo;
+    register int hi;
+    register int i;
+    register word_t first;
+    register word_t last;
+    register word_t *words;
+    // Nothing to add beyond the populated words of an infinite bitset, nor
+    // to remove beyond the ones of a finite bitset or before its offset.
+    // The size is only looked for then, as finding it again after each
+    // change would make a sequence of ranges quadratic.
+    if (op != INTBITSET_OP_XOR && (op == INTBITSET_OP_OR) == (bitset->trailing_bits != 0) && stop > (Py_ssize_t) intBitSetGetSize(bitset) * wordbitsize)
+        stop = (Py_ssize_t) intBitSetGetSize(bitset) * wordbitsize;
+    if (op == INTBITSET_OP_ANDNOT && start < (Py_ssize_t) bitset->offset * wordbitsize)
+        start = (Py_ssize_t) bitset->offset * wordbitsize;
+    if (start >= stop)
+        return;
+    lo = (int) (start / wordbitsize);
+    hi = (int) ((stop - 1) / wordbitsize);
+    if (lo < bitset->offset || hi + 1 >= bitset->allocated)
+        intBitSetMakeRoom(bitset, lo, hi);
+    // From here on, words[i] is the word lo + i.
+    words = bitset->bitset + (lo - bitset->offset);
+    hi -= lo;
+    first = (word_t) ~0 << (word_t) (start % wordbitsize);
+    last = (word_t) ~0 >> (word_t) (wordbitsize - 1 - (stop - 1) % wordbitsize);
+    if (!hi)
+        first = last = first & last;
+    switch (op) {
+        case INTBITSET_OP_OR:
+            words[0] |= first;
+            if (hi > 1)
+                memset(words + 1, 0xff, (hi - 1) * wordbytesize);
+            words[hi] |= last;
+            break;
+        case INTBITSET_OP_ANDNOT:
+            words[0] &= ~first;
+            if (hi > 1)
+                memset(words + 1, 0, (hi - 1) * wordbytesize);
+            words[hi] &= ~last;
+            break;
+        default:
+            words[0] ^= first;
+            for (i = 1; i < hi; ++i)
+                words[i] = ~words[i];
+            if (hi)
+                words[hi] ^= last;
+    }
+    intBitSetChanged(bitset);
+}
+
+void intBitSetAddRange(IntBitSet *const bitset, const Py_ssize_t start, const Py_ssize_t stop) {
+    intBitSetRangeOp(bitset, start, stop, INTBITSET_OP_OR);
+}
+
+void intBitSetDelRange(IntBitSet *const bitset, const Py_ssize_t start, const Py_ssize_t stop) {
+    intBitSetRangeOp(bitset, start, stop, INTBITSET_OP_ANDNOT);
+}
+
+void intBitSetFlipRange(IntBitSet *const bitset, const Py_ssize_t start, const Py_ssize_t stop) {
+    intBitSetRangeOp(bitset, start, stop, INTBITSET_OP_XOR);
+}
+
+Py_ssize_t intBitSetCountRange(IntBitSet *const bitset, register Py_ssize_t start, register Py_ssize_t stop) {
+    register Py_ssize_t end = (Py_ssize_t) intBitSetGetSize(bitset) * wordbitsize;
+    register Py_ssize_t tot = 0;
+    register const word_t *words;
+    register int lo;
+    register int hi;
+    word_t first;
+    word_t last;
+    if (start >= stop)
+        return 0;
+    // Beyond the populated words, the elements are the trailing_bits, and
+    // there are none before the offset.
+    if (stop > end) {
+        if (bitset->trailing_bits)
+            tot = stop - ((start > end) ? start : end);
+        stop = end;
+    }
+    if (start < (Py_ssize_t) bitset->offset * wordbitsize)
+        start = (Py_ssize_t) bitset->offset * wordbitsize;
+    if (start >= stop)
+        return tot;
+    lo = (int) (start / wordbitsize);
+    hi = (int) ((stop - 1) / wordbitsize) - lo;
+    words = bitset->bitset + (lo - bitset->offset);
+    first = words[0] & ((word_t) ~0 << (word_t) (start % wordbitsize));
+    last = words[hi] & ((word_t) ~0 >> (word_t) (wordbitsize - 1 - (stop - 1) % wordbitsize));
+    if (!hi) {
+        first &= last;
+        return tot + intBitSetKernelPopCount(&first, 1);
+    }
+    return tot + intBitSetKernelPopCount(&first, 1) + intBitSetKernelPopCount(words + 1, hi - 1) + intBitSetKernelPopCount(&last, 1);
+}
+
+// Bulk update from an array of integers of a given type: all of them are
+// checked first, then, when adding to a finite bitset, they are written
+// directly in the words, a whole word at a time if they are sorted.
+#define INTBITSET_UPDATE_FROM_INDICES(name, type) \
+static int intBitSetUpdateFrom##name(IntBitSet *const bitset, const type *const indices, register const Py_ssize_t n, const bool_t remove) { \
+    register Py_ssize_t i; \
+    register uint64_t index; \
+    register uint64_t max = 0; \
+    register uint64_t min = (uint64_t) maxelem; \
+    register bool_t sorted = 1; \
+    register int last; \
+    register word_t word; \
+    for (i = 0; i < n; ++i) { \
+        if (indices[i] < 0) \
+            return -1; \
+        index = (uint64_t) indices[i]; \
+        if (index > (uint64_t) maxelem) \
+            return -2; \
+        if (index > max) \
+            max = index; \
+        else if (index < max) \
+            sorted = 0; \
+        if (index < min) \
+            min = index; \
+    } \
+    if (remove || bitset->trailing_bits) { \
+        for (i = 0; i < n; ++i) \
+            if (remove) \
+                intBitSetDelElem(bitset, (unsigned int) indices[i]); \
+            else \
+                intBitSetAddElem(bitset, (unsigned int) indices[i]); \
+        return 0; \
+    } \
+    if (!n) \
+        return 0; \
+    /* The words span the indices only. */ \
+    if (intBitSetEmpty(bitset) || (int) (min / wordbitsize) < bitset->offset) \
+        intBitSetMakeRoom(bitset, (int) (min / wordbitsize), (int) (max / wordbitsize)); \
+    intBitSetResize(bitset, (unsigned int) (max / wordbitsize + 2)); \
+    if (sorted) { \
+        last = (int) ((uint64_t) indices[0] / wordbitsize); \
+        word = 0; \
+        for (i = 0; i < n; ++i) { \
+            index = (uint64_t) indices[i]; \
+            if ((int) (index / wordbitsize) != last) { \
+                bitset->bitset[last - bitset->offset] |= word; \
+                last = (int) (index / wordbitsize); \
+                word = 0; \
+            } \
+            word |= (word_t) 1 << (index % wordbitsize); \
+        } \
+        bitset->bitset[last - bitset->offset] |= word; \
+    } else { \
+        for (i = 0; i < n; ++i) { \
+            index = (uint64_t) indices[i]; \
+            bitset->bitset[index / wordbitsize - bitset->offset] |= (word_t) 1 << (index % wordbitsize); \
+        } \
+    } \
+    intBitSetChanged(bitset); \
+    return 0; \
+}
+
+INTBITSET_UPDATE_FROM_INDICES(Int8, int8_t)
+INTBITSET_UPDATE_FROM_INDICES(UInt8, uint8_t)
+INTBITSET_UPDATE_FROM_INDICES(Int16, int16_t)
+INTBITSET_UPDATE_FROM_INDICES(UInt16, uint16_t)
+INTBITSET_UPDATE_FROM_INDICES(Int32, int32_t)
+INTBITSET_UPDATE_FROM_INDICES(UInt32, uint32_t)
+INTBITSET_UPDATE_FROM_INDICES(Int64, int64_t)
+INTBITSET_UPDATE_FROM_INDICES(UInt64, uint64_t)
+
+int intBitSetUpdateFromIndices(IntBitSet *const bitset, const void *const indices, const Py_ssize_t n, const int itemsize, const bool_t is_signed, const bool_t remove) {
+    switch (itemsize) {
+        case 1:
+            return is_signed ? intBitSetUpdateFromInt8(bitset, indices, n, remove) : intBitSetUpdateFromUInt8(bitset, indices, n, remove);
+        case 2:
+            return is_signed ? intBitSetUpdateFromInt16(bitset, indices, n, remove) : intBitSetUpdateFromUInt16(bitset, indices, n, remove);
+        case 4:
+            return is_signed ? intBitSetUpdateFromInt32(bitset, indices, n, remove) : intBitSetUpdateFromUInt32(bitset, indices, n, remove);
+        case 8:
+            return is_signed ? intBitSetUpdateFromInt64(bitset, indices, n, remove) : intBitSetUpdateFromUInt64(bitset, indices, n, remove);
+    }
+    return -3;
+}
+
+// Filtering of an array of integers of a given type, keeping the ones in
+// the bitset. Sorted values are intersected either by probing each of them,
+// or, when the bitset holds far fewer elements than them in their span, by
+// leaping from one element of the bitset to the next and galloping over the
+// values up to it.
+#define INTBITSET_GALLOP_RATIO 8
+
+static int intBitSetCmpUInt(const void *x, const void *y) {
+    const unsigned int a = *(const unsigned int *) x;
+    const unsigned int b = *(const unsigned int *) y;
+    return (a > b) - (a < b);
+}
+
+#define INTBITSET_FILTER_INDICES(name, type) \
+static Py_ssize_t intBitSetFilter##name(IntBitSet *const bitset, const type *const indices, const Py_ssize_t n, const bool_t sorted, unsigned int *const out) { \
+    register Py_ssize_t i; \
+    register Py_ssize_t k = 0; \
+    register Py_ssize_t first; \
+    register Py_ssize_t last; \
+    register Py_ssize_t step; \
+    Py_ssize_t lo; \
+    Py_ssize_t hi; \
+    int elem; \
+    for (i = 1; sorted && i < n && indices[i] >= indices[i - 1]; ++i); \
+    if (!sorted || i < n) { \
+        for (i = 0; i < n; ++i) \
+            if (indices[i] >= 0 && (uint64_t) indices[i] <= (uint64_t) maxelem && intBitSetIsInElem(bitset, (unsigned int) indices[i])) \
+                out[k++] = (unsigned int) indices[i]; \
+        if (!sorted || k < 2) \
+            return k; \
+        qsort(out, k, sizeof (unsigned int), intBitSetCmpUInt); \
+        for (last = k, i = k = 1; i < last; ++i) \
+            if (out[i] != out[k - 1]) \
+                out[k++] = out[i]; \
+        return k; \
+    } \
+    /* The values in [0, maxelem]. */ \
+    for (lo = 0; lo < n && indices[lo] < 0; ++lo); \
+    for (hi = n; hi > lo && (uint64_t) indices[hi - 1] > (uint64_t) maxelem; --hi); \
+    if (lo == hi) \
+        return 0; \
+    if (bitset->trailing_bits \
+            || (Py_ssize_t) ((uint64_t) indices[hi - 1] / wordbitsize - (uint64_t) indices[lo] / wordbitsize + 1) * INTBITSET_GALLOP_RATIO > hi - lo \
+            || intBitSetCountRange(bitset, (Py_ssize_t) indices[lo], (Py_ssize_t) indices[hi - 1] + 1) * INTBITSET_GALLOP_RATIO > hi - lo) { \
+        for (i = lo; i < hi; ++i) \
+            if ((i == lo || indices[i] != indices[i - 1]) && intBitSetIsInElem(bitset, (unsigned int) indices[i])) \
+                out[k++] = (unsigned int) indices[i]; \
+        return k; \
+    } \
+    i = lo; \
+    elem = intBitSetGetNext(bitset, (int) indices[lo] - 1); \
+    while (elem >= 0) { \
+        if ((uint64_t) indices[i] < (uint64_t) elem) { \
+            /* Gallop up to a value not smaller than elem, then look for */ \
+            /* the first one in between. */ \
+            for (step = 1; i + step < hi && (uint64_t) indices[i + step] < (uint64_t) elem; step <<= 1) \
+                i += step; \
+            first = i + 1; \
+            last = (i + step < hi) ? i + step : hi; \
+            while (first < last) { \
+                if ((uint64_t) indices[first + (last - first) / 2] < (uint64_t) elem) \
+                    first += (last - first) / 2 + 1; \
+                else \
+                    last = first + (last - first) / 2; \
+            } \
+            if ((i = first) == hi) \
+                break; \
+        } \
+        if ((uint64_t) indices[i] == (uint64_t) elem) { \
+            out[k++] = (unsigned int) elem; \
+            elem = intBitSetGetNext(bitset, elem); \
+        } else \
+            elem = intBitSetGetNext(bitset, (int) indices[i] - 1); \
+    } \
+    return k; \
+}
+
+INTBITSET_FILTER_INDICES(Int8, int8_t)
+INTBITSET_FILTER_INDICES(UInt8, uint8_t)
+INTBITSET_FILTER_INDICES(Int16, int16_t)
+INTBITSET_FILTER_INDICES(UInt16, uint16_t)
+INTBITSET_FILTER_INDICES(Int32, int32_t)
+INTBITSET_FILTER_INDICES(UInt32, uint32_t)
+INTBITSET_FILTER_INDICES(Int64, int64_t)
+INTBITSET_FILTER_INDICES(UInt64, uint64_t)
+
+Py_ssize_t intBitSetFilterIndices(IntBitSet *const bitset, const void *const indices, const Py_ssize_t n, const int itemsize, const bool_t is_signed, const bool_t sorted, unsigned int *const out) {
+    switch (itemsize) {
+        case 1:
+            return is_signed ? intBitSetFilterInt8(bitset, indices, n, sorted, out) : intBitSetFilterUInt8(bitset, indices, n, sorted, out);
+        case 2:
+            return is_signed ? intBitSetFilterInt16(bitset, indices, n, sorted, out) : intBitSetFilterUInt16(bitset, indices, n, sorted, out);
+        case 4:
+            return is_signed ? intBitSetFilterInt32(bitset, indices, n, sorted, out) : intBitSetFilterUInt32(bitset, indices, n, sorted, out);
+        case 8:
+            return is_signed ? intBitSetFilterInt64(bitset, indices, n, sorted, out) : intBitSetFilterUInt64(bitset, indices, n, sorted, out);
+    }
+    return -3;
+}
+
+// Membership of an array of integers of a given type, in a single loop.
+#define INTBITSET_CONTAINS_INDICES(name, type) \
+static Py_ssize_t intBitSetContains##name(const IntBitSet *const bitset, const type *const indices, register const Py_ssize_t n, unsigned char *const out) { \
+    register Py_ssize_t i; \
+    register Py_ssize_t k = 0; \
+    register bool_t found; \
+    for (i = 0; i < n; ++i) { \
+        found = indices[i] >= 0 && (uint64_t) indices[i] <= (uint64_t) maxelem && intBitSetIsInElem(bitset, (unsigned int) indices[i]); \
+        if (out) \
+            out[i] = found; \
+        k += found; \
+    } \
+    return k; \
+}
+
+INTBITSET_CONTAINS_INDICES(Int8, int8_t)
+INTBITSET_CONTAINS_INDICES(UInt8, uint8_t)
+INTBITSET_CONTAINS_INDICES(Int16, int16_t)
+INTBITSET_CONTAINS_INDICES(UInt16, uint16_t)
+INTBITSET_CONTAINS_INDICES(Int32, int32_t)
+INTBITSET_CONTAINS_INDICES(UInt32, uint32_t)
+INTBITSET_CONTAINS_INDICES(Int64, int64_t)
+INTBITSET_CONTAINS_INDICES(UInt64, uint64_t)
+
+Py_ssize_t intBitSetContainsIndices(const IntBitSet *const bitset, const void *const indices, const Py_ssize_t n, const int itemsize, const bool_t is_signed, unsigned char *const out) {
+    switch (itemsize) {
+        case 1:
+            return is_signed ? intBitSetContainsInt8(bitset, indices, n, out) : intBitSetContainsUInt8(bitset, indices, n, out);
+        case 2:
+            return is_signed ? intBitSetContainsInt16(bitset, indices, n, out) : intBitSetContainsUInt16(bitset, indices, n, out);
+        case 4:
+            return is_signed ? intBitSetContainsInt32(bitset, indices, n, out) : intBitSetContainsUInt32(bitset, indices, n, out);
+        case 8:
+            return is_signed ? intBitSetContainsInt64(bitset, indices, n, out) : intBitSetContainsUInt64(bitset, indices, n, out);
+    }
+    return -3;
+}
+
+// Run-length encoding of words: a sequence of runs, each made of a header,
+// the varint (LEB128) of (count << 2 | kind), followed, for the literal
+// runs only, by their count words as is. Runs of empty and full words, the
+// bulk of sparse and dense bitsets, only cost their header.
+#define INTBITSET_RLE_ZEROS 0
+#define INTBITSET_RLE_ONES 1
+#define INTBITSET_RLE_LITERAL 2
+
+static unsigned char *intBitSetRLEPutHeader(register unsigned char *out, register const int kind, register const Py_ssize_t count) {
+    register uint64_t value = ((uint64_t) count << 2) | (uint64_t) kind;
+    for (; value >= 0x80; value >>= 7)
+        *out++ = (unsigned char) (value | 0x80);
+    *out++ = (unsigned char) value;
+    return out;
+}
+
+Py_ssize_t intBitSetRLEBound(const Py_ssize_t nwords) {
+    // A literal run of a single word, between two other runs, is the worst.
+    return nwords * (wordbytesize + 10) + 10;
+}
+
+Py_ssize_t intBitSetRLEEncode(const word_t *const words, register const Py_ssize_t nwords, unsigned char *const out) {
+    register Py_ssize_t i = 0;
+    register Py_ssize_t j;
+    register unsigned char *end = out;
+    while (i < nwords) {
+        j = i + 1;
+        if (words[i] == 0 || words[i] == (word_t) ~0) {
+            for (; j < nwords && words[j] == words[i]; ++j);
+            end = intBitSetRLEPutHeader(end, words[i] ? INTBITSET_RLE_ONES : INTBITSET_RLE_ZEROS, j - i);
+        } else {
+            for (; j < nwords && words[j] != 0 && words[j] != (word_t) ~0; ++j);
+            end = intBitSetRLEPutHeader(end, INTBITSET_RLE_LITERAL, j - i);
+            memcpy(end, words + i, (j - i) * wordbytesize);
+            end += (j - i) * wordbytesize;
+        }
+        i = j;
+    }
+    return end - out;
+}
+
+Py_ssize_t intBitSetRLEDecode(register const unsigned char *in, const Py_ssize_t size, word_t *const out, const Py_ssize_t nwords) {
+    register const unsigned char *const end = in + size;
+    register Py_ssize_t i = 0;
+    register Py_ssize_t j;
+    register uint64_t value;
+    register int shift;
+    register Py_ssize_t count;
+    while (in < end) {
+        value = 0;
+        for (shift = 0; in < end && shift < 64; shift += 7) {
+            value |= (uint64_t) (*in & 0x7f) << shift;
+            if (!(*in++ & 0x80))
+                break;
+        }
+        count = (Py_ssize_t) (value >> 2);
+        if (count <= 0 || count > nwords - i)
+            return -1;
+        switch (value & 3) {
+            case INTBITSET_RLE_ZEROS:
+            case INTBITSET_RLE_ONES:
+                for (j = 0; j < count; ++j)
+                    out[i + j] = (value & 3) == INTBITSET_RLE_ONES ? (word_t) ~0 : 0;
+                break;
+            case INTBITSET_RLE_LITERAL:
+                if (end - in < count * wordbytesize)
+                    return -1;
+                memcpy(out + i, in, count * wordbytesize);
+                in += count * wordbytesize;
+                break;
+            default:
+                return -1;
+        }
+        i += count;
+    }
+    return i;
+}
+
+unsigned long long intBitSetNow(void) {
+#ifdef _WIN32
+    static LARGE_INTEGER frequency;
+    LARGE_INTEGER now;
+    if (!frequency.QuadPart)
+        QueryPerformanceFrequency(&frequency);
+    QueryPerformanceCounter(&now);
+    return (unsigned long long) ((double) now.QuadPart * 1e9 / (double) frequency.QuadPart);
+#else
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (unsigned long long) now.tv_sec * 1000000000ULL + (unsigned long long) now.tv_nsec;
+#endif
+}
+
+static int intBitSetProfileBucket(register const unsigned long long ns) {
+    register int exponent;
+    if (ns < (1ULL << INTBITSET_PROFILE_SUB_BITS))
+        return (int) ns;
+    exponent = 63 - intbitset_clz(ns);
+    return ((exponent - INTBITSET_PROFILE_SUB_BITS + 1) << INTBITSET_PROFILE_SUB_BITS)
+        | (int) ((ns >> (exponent - INTBITSET_PROFILE_SUB_BITS)) & ((1ULL << INTBITSET_PROFILE_SUB_BITS) - 1));
+}
+
+unsigned long long intBitSetProfileBucketStart(register const int bucket) {
+    register int exponent;
+    if (bucket < (1 << INTBITSET_PROFILE_SUB_BITS))
+        return (unsigned long long) bucket;
+    exponent = (bucket >> INTBITSET_PROFILE_SUB_BITS) + INTBITSET_PROFILE_SUB_BITS - 1;
+    return ((1ULL << INTBITSET_PROFILE_SUB_BITS) | (unsigned long long) (bucket & ((1 << INTBITSET_PROFILE_SUB_BITS) - 1)))
+        << (exponent - INTBITSET_PROFILE_SUB_BITS);
+}
+
+void intBitSetProfileRecord(IntBitSetProfile *const profile, const unsigned long long ns, const unsigned long long words) {
+    ++profile->calls;
+    profile->words += words;
+    profile->total_ns += ns;
+    if (ns > profile->max_ns)
+        profile->max_ns = ns;
+    ++profile->histogram[intBitSetProfileBucket(ns)];
+}
@@ -0,0 +1,566 @@
+// This file is part of intbitset.
+// Copyright (C) CERN and others
+//
+// SPDX-License-Identifier: LGPL-3.0-or-later
+//
+// intbitset is free software; you can redistribute it and/or
+// modify it under the terms of the GNU Lesser General Public License as
+// published by the Free Software Foundation; either version 3 of the
+// License, or (at your option) any later version.
+//
+// intbitset is distributed in the hope that it will be useful, but
+// WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+// Lesser General Public License for more details.
+//
+// You should have received a copy of the GNU Lesser General Public License
+// along with intbitset; if not, write to the Free Software Foundation, Inc.,
+// 51 Franklin Street, Fifth Floor, Boston MA 2110, USA.
+
+// Word array kernels used by intbitset_impl.c.
+//
+// Every kernel exists in a portable version. On x86 the SSE2, AVX2 and
+// AVX-512 versions are compiled too, whatever flags the extension is built
+// with, and intBitSetInitKernels() picks the best ones the running CPU (and
+// OS) supports, so that portable wheels still get the wide kernels.
+
+#include <string.h>
+
+#include "intbitset.h"
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define INTBITSET_X86 1
+#define INTBITSET_TARGET(isa) __attribute__((target(isa)))
+#include <cpuid.h>
+#include <immintrin.h>
+#elif defined(_MSC_VER) && defined(_M_X64)
+#define INTBITSET_X86 1
+#define INTBITSET_TARGET(isa)
+#include <intrin.h>
+#include <immintrin.h>
+#endif
+
+#ifdef __GNUC__
+#define intbitset_popcount(word) __builtin_popcountll(word)
+#else
+static int intbitset_popcount(register word_t word) {
+    // See: <https://en.wikipedia.org/wiki/Hamming_weight>
+    word -= (word >> 1) & 0x5555555555555555ULL;
+    word = (word & 0x3333333333333333ULL) + ((word >> 2) & 0x3333333333333333ULL);
+    word = (word + (word >> 4)) & 0x0f0f0f0f0f0f0f0fULL;
+    return (int) ((word * 0x0101010101010101ULL) >> 56);
+}
+#endif
+
+/* Portable kernels */
+
+static void intBitSetScalarAnd(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n) {
+    register Py_ssize_t i;
+    for (i = 0; i < n; ++i)
+        dst[i] = x[i] & y[i];
+}
+
+static void intBitSetScalarOr(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n) {
+    register Py_ssize_t i;
+    for (i = 0; i < n; ++i)
+        dst[i] = x[i] | y[i];
+}
+
+static void intBitSetScalarXor(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n) {
+    register Py_ssize_t i;
+    for (i = 0; i < n; ++i)
+        dst[i] = x[i] ^ y[i];
+}
+
+static void intBitSetScalarAndNot(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n) {
+    register Py_ssize_t i;
+    for (i = 0; i < n; ++i)
+        dst[i] = x[i] & ~y[i];
+}
+
+static bool_t intBitSetScalarIntersects(const word_t *x, const word_t *y, Py_ssize_t n) {
+    register Py_ssize_t i;
+    for (i = 0; i < n; ++i)
+        if (x[i] & y[i])
+            return 1;
+    return 0;
+}
+
+static unsigned char intBitSetScalarCmp(const word_t *x, const word_t *y, Py_ssize_t n) {
+    register Py_ssize_t i;
+    register unsigned char ret = 0;
+    for (i = 0; ret != 3 && i < n; ++i)
+        ret |= ((x[i] & ~y[i]) != 0) * 2 + ((y[i] & ~x[i]) != 0);
+    return ret;
+}
+
+static Py_ssize_t intBitSetScalarPopCount(const word_t *x, Py_ssize_t n) {
+    register Py_ssize_t i;
+    register Py_ssize_t tot = 0;
+    for (i = 0; i < n; ++i)
+        if (x[i])
+            tot += intbitset_popcount(x[i]);
+    return tot;
+}
+
+// Population count of a bitwise operation, without storing its result.
+#define INTBITSET_SCALAR_COUNT(name, OP) \
+static Py_ssize_t name(const word_t *x, const word_t *y, Py_ssize_t n) { \
+    register Py_ssize_t i; \
+    register Py_ssize_t tot = 0; \
+    for (i = 0; i < n; ++i) \
+        tot += intbitset_popcount(OP(x[i], y[i])); \
+    return tot; \
+}
+
+#define INTBITSET_AND(a, b) ((a) & (b))
+#define INTBITSET_OR(a, b) ((a) | (b))
+#define INTBITSET_XOR(a, b) ((a) ^ (b))
+#define INTBITSET_ANDNOT(a, b) ((a) & ~(b))
+
+INTBITSET_SCALAR_COUNT(intBitSetScalarAndCount, INTBITSET_AND)
+INTBITSET_SCALAR_COUNT(intBitSetScalarOrCount, INTBITSET_OR)
+INTBITSET_SCALAR_COUNT(intBitSetScalarXorCount, INTBITSET_XOR)
+INTBITSET_SCALAR_COUNT(intBitSetScalarAndNotCount, INTBITSET_ANDNOT)
+
+#ifdef INTBITSET_X86
+
+/* POPCNT: the portable popcount, with the hardware instruction */
+
+INTBITSET_TARGET("popcnt")
+static Py_ssize_t intBitSetPopcntPopCount(const word_t *x, Py_ssize_t n) {
+    register Py_ssize_t i;
+    register Py_ssize_t tot = 0;
+    for (i = 0; i < n; ++i)
+#ifdef __GNUC__
+        tot += __builtin_popcountll(x[i]);
+#else
+        tot += (Py_ssize_t) __popcnt64(x[i]);
+#endif
+    return tot;
+}
+
+#define INTBITSET_POPCNT_COUNT(name, OP) \
+INTBITSET_TARGET("popcnt") \
+INTBITSET_SCALAR_COUNT(name, OP)
+
+INTBITSET_POPCNT_COUNT(intBitSetPopcntAndCount, INTBITSET_AND)
+INTBITSET_POPCNT_COUNT(intBitSetPopcntOrCount, INTBITSET_OR)
+INTBITSET_POPCNT_COUNT(intBitSetPopcntXorCount, INTBITSET_XOR)
+INTBITSET_POPCNT_COUNT(intBitSetPopcntAndNotCount, INTBITSET_ANDNOT)
+
+/* SSE2: 2 words at a time */
+
+#define INTBITSET_SSE2_BINOP(name, SOP, expr) \
+INTBITSET_TARGET("sse2") \
+static void name(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n) { \
+    register Py_ssize_t i = 0; \
+    __m128i a, b; \
+    for (; i + 2 <= n; i += 2) { \
+        a = _mm_loadu_si128((const __m128i *) (x + i)); \
+        b = _mm_loadu_si128((const __m128i *) (y + i)); \
+        _mm_storeu_si128((__m128i *) (dst + i), expr); \
+    } \
+    for (; i < n; ++i) { \
+        dst[i] = SOP(x[i], y[i]); \
+    } \
+}
+
+INTBITSET_SSE2_BINOP(intBitSetSse2And, INTBITSET_AND, _mm_and_si128(a, b))
+INTBITSET_SSE2_BINOP(intBitSetSse2Or, INTBITSET_OR, _mm_or_si128(a, b))
+INTBITSET_SSE2_BINOP(intBitSetSse2Xor, INTBITSET_XOR, _mm_xor_si128(a, b))
+INTBITSET_SSE2_BINOP(intBitSetSse2AndNot, INTBITSET_ANDNOT, _mm_andnot_si128(b, a))
+
+INTBITSET_TARGET("sse2")
+static bool_t intBitSetSse2Intersects(const word_t *x, const word_t *y, Py_ssize_t n) {
+    register Py_ssize_t i = 0;
+    __m128i acc;
+    const __m128i zero = _mm_setzero_si128();
+    for (; i + 8 <= n; i += 8) {
+        acc = _mm_or_si128(
+            _mm_or_si128(
+                _mm_and_si128(_mm_loadu_si128((const __m128i *) (x + i)), _mm_loadu_si128((const __m128i *) (y + i))),
+                _mm_and_si128(_mm_loadu_si128((const __m128i *) (x + i + 2)), _mm_loadu_si128((const __m128i *) (y + i + 2)))),
+            _mm_or_si128(
+                _mm_and_si128(_mm_loadu_si128((const __m128i *) (x + i + 4)), _mm_loadu_si128((const __m128i *) (y + i + 4))),
+                _mm_and_si128(_mm_loadu_si128((const __m128i *) (x + i + 6)), _mm_loadu_si128((const __m128i *) (y + i + 6)))));
+        if (_mm_movemask_epi8(_mm_cmpeq_epi8(acc, zero)) != 0xffff)
+            return 1;
+    }
+    return intBitSetScalarIntersects(x + i, y + i, n - i);
+}
+
+/* AVX2: 4 words at a time, Harley-Seal popcount */
+
+#define INTBITSET_AVX2_BINOP(name, SOP, expr) \
+INTBITSET_TARGET("avx2") \
+static void name(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n) { \
+    register Py_ssize_t i = 0; \
+    __m256i a, b; \
+    for (; i + 4 <= n; i += 4) { \
+        a = _mm256_loadu_si256((const __m256i *) (x + i)); \
+        b = _mm256_loadu_si256((const __m256i *) (y + i)); \
+        _mm256_storeu_si256((__m256i *) (dst + i), expr); \
+    } \
+    for (; i < n; ++i) { \
+        dst[i] = SOP(x[i], y[i]); \
+    } \
+}
+
+INTBITSET_AVX2_BINOP(intBitSetAvx2And, INTBITSET_AND, _mm256_and_si256(a, b))
+INTBITSET_AVX2_BINOP(intBitSetAvx2Or, INTBITSET_OR, _mm256_or_si256(a, b))
+INTBITSET_AVX2_BINOP(intBitSetAvx2Xor, INTBITSET_XOR, _mm256_xor_si256(a, b))
+INTBITSET_AVX2_BINOP(intBitSetAvx2AndNot, INTBITSET_ANDNOT, _mm256_andnot_si256(b, a))
+
+INTBITSET_TARGET("avx2")
+static bool_t intBitSetAvx2Intersects(const word_t *x, const word_t *y, Py_ssize_t n) {
+    register Py_ssize_t i = 0;
+    __m256i acc;
+    for (; i + 8 <= n; i += 8) {
+        acc = _mm256_or_si256(
+            _mm256_and_si256(_mm256_loadu_si256((const __m256i *) (x + i)), _mm256_loadu_si256((const __m256i *) (y + i))),
+            _mm256_and_si256(_mm256_loadu_si256((const __m256i *) (x + i + 4)), _mm256_loadu_si256((const __m256i *) (y + i + 4))));
+        if (!_mm256_testz_si256(acc, acc))
+            return 1;
+    }
+    return intBitSetScalarIntersects(x + i, y + i, n - i);
+}
+
+INTBITSET_TARGET("avx2")
+static unsigned char intBitSetAvx2Cmp(const word_t *x, const word_t *y, Py_ssize_t n) {
+    register Py_ssize_t i = 0;
+    register unsigned char ret = 0;
+    __m256i a, b;
+    for (; ret != 3 && i + 4 <= n; i += 4) {
+        a = _mm256_loadu_si256((const __m256i *) (x + i));
+        b = _mm256_loadu_si256((const __m256i *) (y + i));
+        // testc(b, a) is set when a & ~b is zero, i.e. a is within b.
+        ret |= (!_mm256_testc_si256(b, a)) * 2 + !_mm256_testc_si256(a, b);
+    }
+    if (ret == 3)
+        return ret;
+    return ret | intBitSetScalarCmp(x + i, y + i, n - i);
+}
+
+INTBITSET_TARGET("avx2")
+static inline __m256i intBitSetAvx2PopCount256(const __m256i v) {
+    // Nibble lookup, see: <https://arxiv.org/abs/1611.07612>
+    const __m256i lookup = _mm256_setr_epi8(
+        0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+        0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+    const __m256i low_mask = _mm256_set1_epi8(0x0f);
+    const __m256i lo = _mm256_and_si256(v, low_mask);
+    const __m256i hi = _mm256_and_si256(_mm256_srli_epi16(v, 4), low_mask);
+    const __m256i cnt = _mm256_add_epi8(_mm256_shuffle_epi8(lookup, lo), _mm256_shuffle_epi8(lookup, hi));
+    return _mm256_sad_epu8(cnt, _mm256_setzero_si256());
+}
+
+// Carry-save adder: (h, l) = a + b + c
+#define INTBITSET_AVX2_CSA(h, l, a, b, c) do { \
+    const __m256i u_ = _mm256_xor_si256((a), (b)); \
+    h = _mm256_or_si256(_mm256_and_si256((a), (b)), _mm256_and_si256(u_, (c))); \
+    l = _mm256_xor_si256(u_, (c)); \
+} while (0)
+
+// Harley-Seal population count of the vectors LOAD(0), LOAD(1) ... LOAD(nv - 1)
+// See: <https://arxiv.org/abs/1611.07612>
+#define INTBITSET_AVX2_HARLEY_SEAL(LOAD, nv, result) do { \
+    __m256i total_ = _mm256_setzero_si256(); \
+    __m256i ones_ = _mm256_setzero_si256(); \
+    __m256i twos_ = _mm256_setzero_si256(); \
+    __m256i fours_ = _mm256_setzero_si256(); \
+    __m256i eights_ = _mm256_setzero_si256(); \
+    __m256i sixteens_, twosA_, twosB_, foursA_, foursB_, eightsA_, eightsB_; \
+    Py_ssize_t v_ = 0; \
+    for (; v_ + 16 <= (nv); v_ += 16) { \
+        INTBITSET_AVX2_CSA(twosA_, ones_, ones_, LOAD(v_ + 0), LOAD(v_ + 1)); \
+        INTBITSET_AVX2_CSA(twosB_, ones_, ones_, LOAD(v_ + 2), LOAD(v_ + 3)); \
+        INTBITSET_AVX2_CSA(foursA_, twos_, twos_, twosA_, twosB_); \
+        INTBITSET_AVX2_CSA(twosA_, ones_, ones_, LOAD(v_ + 4), LOAD(v_ + 5)); \
+        INTBITSET_AVX2_CSA(twosB_, ones_, ones_, LOAD(v_ + 6), LOAD(v_ + 7)); \
+        INTBITSET_AVX2_CSA(foursB_, twos_, twos_, twosA_, twosB_); \
+        INTBITSET_AVX2_CSA(eightsA_, fours_, fours_, foursA_, foursB_); \
+        INTBITSET_AVX2_CSA(twosA_, ones_, ones_, LOAD(v_ + 8), LOAD(v_ + 9)); \
+        INTBITSET_AVX2_CSA(twosB_, ones_, ones_, LOAD(v_ + 10), LOAD(v_ + 11)); \
+        INTBITSET_AVX2_CSA(foursA_, twos_, twos_, twosA_, twosB_); \
+        INTBITSET_AVX2_CSA(twosA_, ones_, ones_, LOAD(v_ + 12), LOAD(v_ + 13)); \
+        INTBITSET_AVX2_CSA(twosB_, ones_, ones_, LOAD(v_ + 14), LOAD(v_ + 15)); \
+        INTBITSET_AVX2_CSA(foursB_, twos_, twos_, twosA_, twosB_); \
+        INTBITSET_AVX2_CSA(eightsB_, fours_, fours_, foursA_, foursB_); \
+        INTBITSET_AVX2_CSA(sixteens_, eights_, eights_, eightsA_, eightsB_); \
+        total_ = _mm256_add_epi64(total_, intBitSetAvx2PopCount256(sixteens_)); \
+    } \
+    total_ = _mm256_slli_epi64(total_, 4); \
+    total_ = _mm256_add_epi64(total_, _mm256_slli_epi64(intBitSetAvx2PopCount256(eights_), 3)); \
+    total_ = _mm256_add_epi64(total_, _mm256_slli_epi64(intBitSetAvx2PopCount256(fours_), 2)); \
+    total_ = _mm256_add_epi64(total_, _mm256_slli_epi64(intBitSetAvx2PopCount256(twos_), 1)); \
+    total_ = _mm256_add_epi64(total_, intBitSetAvx2PopCount256(ones_)); \
+    for (; v_ < (nv); ++v_) \
+        total_ = _mm256_add_epi64(total_, intBitSetAvx2PopCount256(LOAD(v_))); \
+    result = (Py_ssize_t) ( \
+        (word_t) _mm256_extract_epi64(total_, 0) + (word_t) _mm256_extract_epi64(total_, 1) + \
+        (word_t) _mm256_extract_epi64(total_, 2) + (word_t) _mm256_extract_epi64(total_, 3)); \
+} while (0)
+
+INTBITSET_TARGET("avx2,popcnt")
+static Py_ssize_t intBitSetAvx2PopCount(const word_t *x, Py_ssize_t n) {
+    Py_ssize_t tot;
+    register Py_ssize_t i;
+#define LOAD(v) _mm256_loadu_si256((const __m256i *) (x + 4 * (v)))
+    INTBITSET_AVX2_HARLEY_SEAL(LOAD, n / 4, tot);
+#undef LOAD
+    for (i = n - n % 4; i < n; ++i)
+        tot += intbitset_popcount(x[i]);
+    return tot;
+}
+
+#define INTBITSET_AVX2_COUNT(name, SOP, VOP) \
+INTBITSET_TARGET("avx2,popcnt") \
+static Py_ssize_t name(const word_t *x, const word_t *y, Py_ssize_t n) { \
+    Py_ssize_t tot; \
+    register Py_ssize_t i; \
+    INTBITSET_AVX2_HARLEY_SEAL(VOP, n / 4, tot); \
+    for (i = n - n % 4; i < n; ++i) \
+        tot += intbitset_popcount(SOP(x[i], y[i])); \
+    return tot; \
+}
+
+#define INTBITSET_AVX2_LOAD_X(v) _mm256_loadu_si256((const __m256i *) (x + 4 * (v)))
+#define INTBITSET_AVX2_LOAD_Y(v) _mm256_loadu_si256((const __m256i *) (y + 4 * (v)))
+#define INTBITSET_AVX2_AND(v) _mm256_and_si256(INTBITSET_AVX2_LOAD_X(v), INTBITSET_AVX2_LOAD_Y(v))
+#define INTBITSET_AVX2_OR(v) _mm256_or_si256(INTBITSET_AVX2_LOAD_X(v), INTBITSET_AVX2_LOAD_Y(v))
+#define INTBITSET_AVX2_XOR(v) _mm256_xor_si256(INTBITSET_AVX2_LOAD_X(v), INTBITSET_AVX2_LOAD_Y(v))
+#define INTBITSET_AVX2_ANDNOT(v) _mm256_andnot_si256(INTBITSET_AVX2_LOAD_Y(v), INTBITSET_AVX2_LOAD_X(v))
+
+INTBITSET_AVX2_COUNT(intBitSetAvx2AndCount, INTBITSET_AND, INTBITSET_AVX2_AND)
+INTBITSET_AVX2_COUNT(intBitSetAvx2OrCount, INTBITSET_OR, INTBITSET_AVX2_OR)
+INTBITSET_AVX2_COUNT(intBitSetAvx2XorCount, INTBITSET_XOR, INTBITSET_AVX2_XOR)
+INTBITSET_AVX2_COUNT(intBitSetAvx2AndNotCount, INTBITSET_ANDNOT, INTBITSET_AVX2_ANDNOT)
+
+/* AVX-512: 8 words at a time, VPOPCNTDQ popcount */
+
+#define INTBITSET_AVX512_BINOP(name, SOP, expr) \
+INTBITSET_TARGET("avx512f") \
+static void name(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n) { \
+    register Py_ssize_t i = 0; \
+    __m512i a, b; \
+    for (; i + 8 <= n; i += 8) { \
+        a = _mm512_loadu_si512((const void *) (x + i)); \
+        b = _mm512_loadu_si512((const void *) (y + i)); \
+        _mm512_storeu_si512((void *) (dst + i), expr); \
+    } \
+    for (; i < n; ++i) { \
+        dst[i] = SOP(x[i], y[i]); \
+    } \
+}
+
+INTBITSET_AVX512_BINOP(intBitSetAvx512And, INTBITSET_AND, _mm512_and_si512(a, b))
+INTBITSET_AVX512_BINOP(intBitSetAvx512Or, INTBITSET_OR, _mm512_or_si512(a, b))
+INTBITSET_AVX512_BINOP(intBitSetAvx512Xor, INTBITSET_XOR, _mm512_xor_si512(a, b))
+INTBITSET_AVX512_BINOP(intBitSetAvx512AndNot, INTBITSET_ANDNOT, _mm512_andnot_si512(b, a))
+
+INTBITSET_TARGET("avx512f")
+static bool_t intBitSetAvx512Intersects(const word_t *x, const word_t *y, Py_ssize_t n) {
+    register Py_ssize_t i = 0;
+    for (; i + 8 <= n; i += 8)
+        if (_mm512_test_epi64_mask(
+                _mm512_loadu_si512((const void *) (x + i)),
+                _mm512_loadu_si512((const void *) (y + i))))
+            return 1;
+    return intBitSetScalarIntersects(x + i, y + i, n - i);
+}
+
+INTBITSET_TARGET("avx512f")
+static unsigned char intBitSetAvx512Cmp(const word_t *x, const word_t *y, Py_ssize_t n) {
+    register Py_ssize_t i = 0;
+    register unsigned char ret = 0;
+    __m512i a, b;
+    for (; ret != 3 && i + 8 <= n; i += 8) {
+        a = _mm512_loadu_si512((const void *) (x + i));
+        b = _mm512_loadu_si512((const void *) (y + i));
+        ret |= (_mm512_test_epi64_mask(_mm512_andnot_si512(b, a), _mm512_andnot_si512(b, a)) != 0) * 2
+            + (_mm512_test_epi64_mask(_mm512_andnot_si512(a, b), _mm512_andnot_si512(a, b)) != 0);
+    }
+    if (ret == 3)
+        return ret;
+    return ret | intBitSetScalarCmp(x + i, y + i, n - i);
+}
+
+INTBITSET_TARGET("avx512f,avx512vpopcntdq,popcnt")
+static Py_ssize_t intBitSetAvx512PopCount(const word_t *x, Py_ssize_t n) {
+    register Py_ssize_t i = 0;
+    __m512i total = _mm512_setzero_si512();
+    for (; i + 8 <= n; i += 8)
+        total = _mm512_add_epi64(total, _mm512_popcnt_epi64(_mm512_loadu_si512((const void *) (x + i))));
+    return (Py_ssize_t) _mm512_reduce_add_epi64(total) + intBitSetPopcntPopCount(x + i, n - i);
+}
+
+#define INTBITSET_AVX512_COUNT(name, SOP, VOP) \
+INTBITSET_TARGET("avx512f,avx512vpopcntdq,popcnt") \
+static Py_ssize_t name(const word_t *x, const word_t *y, Py_ssize_t n) { \
+    register Py_ssize_t i = 0; \
+    __m512i a, b; \
+    __m512i total = _mm512_setzero_si512(); \
+    for (; i + 8 <= n; i += 8) { \
+        a = _mm512_loadu_si512((const void *) (x + i)); \
+        b = _mm512_loadu_si512((const void *) (y + i)); \
+        total = _mm512_add_epi64(total, _mm512_popcnt_epi64(VOP)); \
+    } \
+    return (Py_ssize_t) _mm512_reduce_add_epi64(total) + intBitSetPopcnt##SOP##Count(x + i, y + i, n - i); \
+}
+
+INTBITSET_AVX512_COUNT(intBitSetAvx512AndCount, And, _mm512_and_si512(a, b))
+INTBITSET_AVX512_COUNT(intBitSetAvx512OrCount, Or, _mm512_or_si512(a, b))
+INTBITSET_AVX512_COUNT(intBitSetAvx512XorCount, Xor, _mm512_xor_si512(a, b))
+INTBITSET_AVX512_COUNT(intBitSetAvx512AndNotCount, AndNot, _mm512_andnot_si512(b, a))
+
+/* CPU detection */
+
+static void intBitSetCpuid(const unsigned int leaf, const unsigned int subleaf, unsigned int regs[4]) {
+#ifdef _MSC_VER
+    int tmp[4];
+    __cpuidex(tmp, (int) leaf, (int) subleaf);
+    regs[0] = tmp[0]; regs[1] = tmp[1]; regs[2] = tmp[2]; regs[3] = tmp[3];
+#else
+    regs[0] = regs[1] = regs[2] = regs[3] = 0;
+    __get_cpuid_count(leaf, subleaf, &regs[0], &regs[1], &regs[2], &regs[3]);
+#endif
+}
+
+static word_t intBitSetXgetbv(void) {
+#ifdef _MSC_VER
+    return (word_t) _xgetbv(0);
+#else
+    unsigned int eax, edx;
+    __asm__ __volatile__ ("xgetbv" : "=a" (eax), "=d" (edx) : "c" (0));
+    return ((word_t) edx << 32) | eax;
+#endif
+}
+
+#endif /* INTBITSET_X86 */
+
+/* Dispatch */
+
+void (*intBitSetKernelAnd)(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n) = intBitSetScalarAnd;
+void (*intBitSetKernelOr)(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n) = intBitSetScalarOr;
+void (*intBitSetKernelXor)(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n) = intBitSetScalarXor;
+void (*intBitSetKernelAndNot)(word_t *dst, const word_t *x, const word_t *y, Py_ssize_t n) = intBitSetScalarAndNot;
+bool_t (*intBitSetKernelIntersects)(const word_t *x, const word_t *y, Py_ssize_t n) = intBitSetScalarIntersects;
+unsigned char (*intBitSetKernelCmp)(const word_t *x, const word_t *y, Py_ssize_t n) = intBitSetScalarCmp;
+Py_ssize_t (*intBitSetKernelPopCount)(const word_t *x, Py_ssize_t n) = intBitSetScalarPopCount;
+Py_ssize_t (*intBitSetKernelAndCount)(const word_t *x, const word_t *y, Py_ssize_t n) = intBitSetScalarAndCount;
+Py_ssize_t (*intBitSetKernelOrCount)(const word_t *x, const word_t *y, Py_ssize_t n) = intBitSetScalarOrCount;
+Py_ssize_t (*intBitSetKernelXorCount)(const word_t *x, const word_t *y, Py_ssize_t n) = intBitSetScalarXorCount;
+Py_ssize_t (*intBitSetKernelAndNotCount)(const word_t *x, const word_t *y, Py_ssize_t n) = intBitSetScalarAndNotCount;
+
+// Levels, from the most portable to the widest.
+static const char *const intbitset_kernels_names[] = {"scalar", "sse2", "avx2", "avx512"};
+
+int intBitSetSupportedKernels(void) {
+#ifdef INTBITSET_X86
+    unsigned int regs1[4];
+    unsigned int regs7[4];
+    word_t xcr0 = 0;
+    int ret = 1; // SSE2 is part of x86-64, and of anything built with Python >= 3.
+    intBitSetCpuid(0, 0, regs1);
+    if (regs1[0] < 7)
+        return ret;
+    intBitSetCpuid(1, 0, regs1);
+    intBitSetCpuid(7, 0, regs7);
+    // OSXSAVE: the OS saves the extended registers, which has to be checked
+    // before trusting the AVX feature bits.
+    if (regs1[2] & (1 << 27))
+        xcr0 = intBitSetXgetbv();
+    if ((regs1[2] & (1 << 28)) && (regs1[2] & (1 << 23)) && (regs7[1] & (1 << 5)) && (xcr0 & 0x6) == 0x6)
+        ret = 2;
+    if (ret == 2 && (regs7[1] & (1 << 16)) && (xcr0 & 0xe6) == 0xe6)
+        ret = 3;
+    return ret;
+#else
+    return 0;
+#endif
+}
+
+static int intBitSetHasVpopcntdq(void) {
+#ifdef INTBITSET_X86
+    unsigned int regs[4];
+    intBitSetCpuid(7, 0, regs);
+    return (regs[2] & (1 << 14)) != 0;
+#else
+    return 0;
+#endif
+}
+
+static int intBitSetHasPopcnt(void) {
+#ifdef INTBITSET_X86
+    unsigned int regs[4];
+    intBitSetCpuid(1, 0, regs);
+    return (regs[2] & (1 << 23)) != 0;
+#else
+    return 0;
+#endif
+}
+
+const char *intBitSetInitKernels(int level) {
+    // Select the kernels of the given level, or of the widest level supported
+    // by the CPU when level is negative or not supported.
+    int supported = intBitSetSupportedKernels();
+    if (level < 0 || level > supported)
+        level = supported;
+    intBitSetKernelAnd = intBitSetScalarAnd;
+    intBitSetKernelOr = intBitSetScalarOr;
+    intBitSetKernelXor = intBitSetScalarXor;
+    intBitSetKernelAndNot = intBitSetScalarAndNot;
+    intBitSetKernelIntersects = intBitSetScalarIntersects;
+    intBitSetKernelCmp = intBitSetScalarCmp;
+    intBitSetKernelPopCount = intBitSetScalarPopCount;
+    intBitSetKernelAndCount = intBitSetScalarAndCount;
+    intBitSetKernelOrCount = intBitSetScalarOrCount;
+    intBitSetKernelXorCount = intBitSetScalarXorCount;
+    intBitSetKernelAndNotCount = intBitSetScalarAndNotCount;
+#ifdef INTBITSET_X86
+    if (level >= 1) {
+        intBitSetKernelAnd = intBitSetSse2And;
+        intBitSetKernelOr = intBitSetSse2Or;
+        intBitSetKernelXor = intBitSetSse2Xor;
+        intBitSetKernelAndNot = intBitSetSse2AndNot;
+        intBitSetKernelIntersects = intBitSetSse2Intersects;
+        if (intBitSetHasPopcnt()) {
+            intBitSetKernelPopCount = intBitSetPopcntPopCount;
+            intBitSetKernelAndCount = intBitSetPopcntAndCount;
+            intBitSetKernelOrCount = intBitSetPopcntOrCount;
+            intBitSetKernelXorCount = intBitSetPopcntXorCount;
+            intBitSetKernelAndNotCount = intBitSetPopcntAndNotCount;
+        }
+    }
+    if (level >= 2) {
+        intBitSetKernelAnd = intBitSetAvx2And;
+        intBitSetKernelOr = intBitSetAvx2Or;
+        intBitSetKernelXor = intBitSetAvx2Xor;
+        intBitSetKernelAndNot = intBitSetAvx2AndNot;
+        intBitSetKernelIntersects = intBitSetAvx2Intersects;
+        intBitSetKernelCmp = intBitSetAvx2Cmp;
+        intBitSetKernelPopCount = intBitSetAvx2PopCount;
+        intBitSetKernelAndCount = intBitSetAvx2AndCount;
+        intBitSetKernelOrCount = intBitSetAvx2OrCount;
+        intBitSetKernelXorCount = intBitSetAvx2XorCount;
+        intBitSetKernelAndNotCount = intBitSetAvx2AndNotCount;
+    }
+    if (level >= 3) {
+        intBitSetKernelAnd = intBitSetAvx512And;
+        intBitSetKernelOr = intBitSetAvx512Or;
+        intBitSetKernelXor = intBitSetAvx512Xor;
+        intBitSetKernelAndNot = intBitSetAvx512AndNot;
+        intBitSetKernelIntersects = intBitSetAvx512Intersects;
+        intBitSetKernelCmp = intBitSetAvx512Cmp;
+        if (intBitSetHasVpopcntdq()) {
+            intBitSetKernelPopCount = intBitSetAvx512PopCount;
+            intBitSetKernelAndCount = intBitSetAvx512AndCount;
+            intBitSetKernelOrCount = intBitSetAvx512OrCount;
+            intBitSetKernelXorCount = intBitSetAvx512XorCount;
+            intBitSetKernelAndNotCount = intBitSetAvx512AndNotCount;
+        }
+    }
+#endif
+    return intbitset_kernels_names[level];
+}
@@ -39,11 +39,11 @@ setup(
     long_description=open("README.rst").read(),
     long_description_content_type="text/x-rst",
     package_dir={"": "intbitset"},
-    py_modules=["intbitset_helper", "intbitset_version"],
+    py_modules=["intbitset_bench", "intbitset_cache", "intbitset_helper", "intbitset_version"],
     ext_modules=[
         Extension(
             "intbitset",
-            ["intbitset/intbitset.c", "intbitset/intbitset_impl.c"],
+            ["intbitset/intbitset.c", "intbitset/intbitset_impl.c", "intbitset/intbitset_kernels.c"],
             # extra_compile_args = []
             # For debug -> extra_compile_args=['-ftree-vectorizer-verbose=2']
         )
@@ -62,5 +62,5 @@ setup(
         "Topic :: Software Development :: Libraries :: Python Modules",
         "Programming Language :: Python :: 3",
     ],
-    extras_require={"tests": ["pytest", "pytest-xdist"]}
+    extras_require={"tests": ["pytest", "pytest-xdist"], "numpy": ["numpy"]}
 )
@@ -20,13 +20,24 @@
 # 51 Franklin Street, Fifth Floor, Boston MA 2110, USA.
 
 import copy
+import gc
+import json
+import operator
 import pickle
+import sys
+import tracemalloc
 import zlib
+from array import array
 from typing import NamedTuple
 
 import pytest
 
+import intbitset as intbitset_module
+from intbitset import frozenintbitset
 from intbitset import intbitset
+from intbitset_bench import SUITE
+from intbitset_bench import main as bench_main
+from intbitset_cache import ResultCache
 
 
 def b(s):
@@ -354,12 +365,8 @@ def test_infinite_empty_empty_set(function):
 @pytest.mark.parametrize(
     argnames="function",
     argvalues=[
-        SUB_FUNC,
-        AND_FUNC,
         IAND_FUNC,
-        OR_FUNC,
         IOR_FUNC,
-        XOR_FUNC,
         IXOR_FUNC,
     ],
 )
@@ -369,6 +376,23 @@ def test_no_segmentation_fault_intbitset_set(function):
         function.intbitset_function(intbitset([1, 2, 3]), set([1, 2, 3]))
 
 
+@pytest.mark.parametrize(
+    argnames="function, operator_function",
+    argvalues=[
+        (SUB_FUNC, operator.sub),
+        (AND_FUNC, operator.and_),
+        (OR_FUNC, operator.or_),
+        (XOR_FUNC, operator.xor),
+    ],
+)
+def test_no_segmentation_fault_intbitset_set_binary(function, operator_function):
+    """intbitset - test no segmentation fault with foreign data types"""
+    # As for set, the other operand is given a chance to handle it.
+    assert function.intbitset_function(intbitset([1, 2, 3]), set([1, 2, 3])) is NotImplemented
+    with pytest.raises(TypeError):  # NOQA
+        operator_function(intbitset([1, 2, 3]), set([1, 2, 3]))
+
+
 def test_no_segmentation_fault_intbitset_set_isub():
     """intbitset - test no segmentation fault with foreign data types"""
     ISUB_FUNC.intbitset_function(intbitset([1, 2, 3]), set([1, 2, 3]))
@@ -776,3 +800,1449 @@ def test_empty_generator():
 def test_do_not_allow_removal_of_none():
     with pytest.raises(TypeError):  # NOQA
         intbitset([1, 2, 3]) - None
+
+
+@pytest.mark.parametrize(
+    argnames="function",
+    argvalues=FUNCTIONS,
+)
+def test_set_ops_are_bounded_by_size(function):
+    # a big preallocation with a small content must not drive the size of
+    # the result nor of the other operand
+    intbitset1 = intbitset(1000000)
+    intbitset1.add(3)
+    intbitset2 = intbitset([1, 2, 100])
+    allocated2 = intbitset2.get_allocated()
+    if function.inplace:
+        function.intbitset_function(intbitset2, intbitset1)
+        result = intbitset2
+    else:
+        result = function.intbitset_function(intbitset2, intbitset1)
+        assert intbitset2.get_allocated() == allocated2
+    check_bitset(result)
+    assert result.get_allocated() <= allocated2
+
+
+@pytest.fixture(params=intbitset_module._supported_kernels())
+def kernels(request):
+    yield intbitset_module._select_kernels(request.param)
+    intbitset_module._select_kernels()
+
+
+@pytest.mark.parametrize(
+    argnames="function",
+    argvalues=FUNCTIONS,
+)
+def test_set_ops_kernels(kernels, function):
+    # big enough for the vector loops, with an odd number of words for the
+    # scalar tails
+    set1 = list(range(0, 20000, 3)) + list(range(20000, 25000))
+    set2 = list(range(0, 30011, 7))
+    for trailing_bits1, trailing_bits2 in ((0, 0), (0, 1), (1, 0)):
+        check_functions_work(
+            function,
+            intbitset(set1, trailing_bits=trailing_bits1),
+            intbitset(set2, trailing_bits=trailing_bits2),
+        )
+
+
+def test_set_len_and_cmp_kernels(kernels):
+    set1 = list(range(0, 70000, 3))
+    intbitset1 = intbitset(set1)
+    intbitset2 = intbitset(set1[:-1])
+    assert len(intbitset1) == len(set1)
+    assert len(intbitset1 | intbitset([70001])) == len(set1) + 1
+    assert intbitset2 < intbitset1
+    assert intbitset1 > intbitset2
+    assert not intbitset1 <= intbitset2
+    assert intbitset1 == intbitset(set1)
+    assert not intbitset1.isdisjoint(intbitset([69999]))
+    assert intbitset1.isdisjoint(intbitset([69998]))
+
+
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[]],
+)
+@pytest.mark.parametrize(
+    argnames="set2",
+    argvalues=TEST_SETS + [[]],
+)
+@pytest.mark.parametrize(
+    argnames=["count_op", "intbitset_op"],
+    argvalues=[
+        (intbitset.intersection_count, intbitset.__and__),  # NOQA
+        (intbitset.union_count, intbitset.__or__),  # NOQA
+        (intbitset.difference_count, intbitset.__sub__),  # NOQA
+        (intbitset.symmetric_difference_count, intbitset.__xor__),  # NOQA
+    ],
+)
+def test_set_count_ops(set1, set2, count_op, intbitset_op):
+    for trailing_bits1 in (False, True):
+        for trailing_bits2 in (False, True):
+            intbitset1 = intbitset(set1, trailing_bits=trailing_bits1)
+            intbitset2 = intbitset(set2, trailing_bits=trailing_bits2)
+            expected = intbitset_op(intbitset1, intbitset2)
+            if expected.is_infinite():
+                with pytest.raises(OverflowError):  # NOQA
+                    count_op(intbitset1, intbitset2)
+            else:
+                assert count_op(intbitset1, intbitset2) == len(expected)
+
+
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[]],
+)
+@pytest.mark.parametrize(
+    argnames="set2",
+    argvalues=TEST_SETS + [[]],
+)
+def test_set_jaccard(set1, set2):
+    intbitset1 = intbitset(set1)
+    intbitset2 = intbitset(set2)
+    union = set(set1) | set(set2)
+    if union:
+        expected = len(set(set1) & set(set2)) / len(union)
+    else:
+        expected = 1.0
+    assert intbitset1.jaccard(intbitset2) == expected
+    assert intbitset1.jaccard(intbitset(set2, trailing_bits=True)) == 0.0
+    with pytest.raises(OverflowError):  # NOQA
+        intbitset(set1, trailing_bits=True).jaccard(intbitset(set2, trailing_bits=True))
+
+
+@pytest.mark.parametrize(
+    argnames="trailing_bits",
+    argvalues=[(0, 0, 0), (1, 0, 0), (0, 1, 1), (1, 1, 1)],
+)
+def test_set_union_intersection_many(trailing_bits):
+    sets = [
+        list(range(0, 70000, 3)),
+        list(range(0, 70000, 5)) + [100000],
+        list(range(35000, 40000)),
+    ]
+    intbitsets = [
+        intbitset(set1, trailing_bits=trailing_bits1)
+        for set1, trailing_bits1 in zip(sets, trailing_bits)
+    ]
+    expected_union = intbitsets[0] | intbitsets[1] | intbitsets[2]
+    expected_intersection = intbitsets[0] & intbitsets[1] & intbitsets[2]
+    union = intbitsets[0].union(*intbitsets[1:])
+    intersection = intbitsets[0].intersection(*intbitsets[1:])
+    check_bitset(union)
+    check_bitset(intersection)
+    assert union == expected_union
+    assert intersection == expected_intersection
+    # the operands are left untouched
+    assert intbitsets == [
+        intbitset(set1, trailing_bits=trailing_bits1)
+        for set1, trailing_bits1 in zip(sets, trailing_bits)
+    ]
+    intbitset1 = intbitset(intbitsets[0])
+    intbitset1.update(*intbitsets[1:])
+    assert intbitset1 == expected_union
+    intbitset1 = intbitset(intbitsets[0])
+    intbitset1.intersection_update(*intbitsets[1:])
+    assert intbitset1 == expected_intersection
+
+
+def test_set_union_intersection_many_with_iterables():
+    intbitset1 = intbitset([1, 2, 3, 1000])
+    assert intbitset1.union([4], (5, 6), intbitset([7])) == intbitset([1, 2, 3, 4, 5, 6, 7, 1000])
+    assert intbitset1.intersection([1, 2, 1000], (2, 1000), intbitset([2, 1000])) == intbitset([2, 1000])
+    assert intbitset1.union() == intbitset1
+    assert intbitset1.intersection() == intbitset1
+    assert intbitset1.intersection([]) == intbitset()
+
+
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[]],
+)
+@pytest.mark.parametrize(argnames="n", argvalues=[1, 3, 64, 1000])
+def test_set_iter_chunks(set1, n):
+    intbitset1 = intbitset(set1)
+    chunks = list(intbitset1.iter_chunks(n))
+    for chunk in chunks:
+        assert isinstance(chunk, array)
+        assert chunk.typecode == "I"
+        assert 0 < len(chunk) <= n
+    assert all(len(chunk) == n for chunk in chunks[:-1])
+    assert [elem for chunk in chunks for elem in chunk] == set1
+    check_bitset(intbitset1)
+
+
+def test_set_iter_chunks_errors():
+    with pytest.raises(ValueError):
+        list(intbitset([1, 2]).iter_chunks(0))
+    with pytest.raises(OverflowError):
+        list(intbitset([1, 2], trailing_bits=True).iter_chunks(10))
+    intbitset1 = intbitset([1, 2, 3])
+    chunks = intbitset1.iter_chunks(1)
+    next(chunks)
+    intbitset1.add(1000)
+    with pytest.raises(RuntimeError):
+        next(chunks)
+
+
+@pytest.mark.parametrize(
+    argnames="mutate",
+    argvalues=[
+        lambda s: s.add(1000),
+        lambda s: s.discard(1),
+        lambda s: s.clear(),
+        lambda s: s.update([7], [8]),
+        lambda s: s.intersection_update([1], [1, 2]),
+        lambda s: s.__ior__(intbitset([2000])),
+        lambda s: s.__isub__(intbitset([2])),
+        lambda s: s.fastload(intbitset([5]).fastdump()),
+    ],
+)
+def test_set_iterator_changed(mutate):
+    intbitset1 = intbitset([1, 2, 3])
+    iterator = iter(intbitset1)
+    assert next(iterator) == 1
+    mutate(intbitset1)
+    with pytest.raises(RuntimeError):
+        next(iterator)
+    with pytest.raises(StopIteration):
+        next(iterator)
+
+
+def test_set_iterator_unchanged():
+    intbitset1 = intbitset([1, 2, 3])
+    iterator = iter(intbitset1)
+    assert next(iterator) == 1
+    intbitset1.add(2)
+    intbitset1.discard(1000)
+    assert list(iterator) == [2, 3]
+
+
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[]],
+)
+def test_set_rank_select(set1):
+    intbitset1 = intbitset(set1)
+    for k, elem in enumerate(set1):
+        assert intbitset1.select(k) == elem
+        assert intbitset1.rank(elem) == k + 1
+        if elem > 0:
+            assert intbitset1.rank(elem - 1) == k
+    assert intbitset1.rank(intbitset_module.__maxelem__) == len(set1)
+    with pytest.raises(IndexError):
+        intbitset1.select(len(set1))
+    with pytest.raises(IndexError):
+        intbitset1.select(-1)
+    check_bitset(intbitset1)
+
+
+def test_set_rank_select_infinite():
+    intbitset1 = intbitset([1, 5, 1000], trailing_bits=True)
+    assert intbitset1.select(0) == 1
+    assert intbitset1.select(1) == 5
+    assert intbitset1.select(2) == 1000
+    assert intbitset1.select(3) == 1001
+    assert intbitset1.select(100) == 1098
+    assert intbitset1.rank(0) == 0
+    assert intbitset1.rank(1000) == 3
+    assert intbitset1.rank(1098) == 101
+    assert intbitset1.rank(intbitset_module.__maxelem__) == intbitset_module.__maxelem__ - 997
+
+
+def test_set_rank_select_changed():
+    intbitset1 = intbitset([1, 5, 1000])
+    assert intbitset1.select(2) == 1000
+    assert intbitset1.rank(1000) == 3
+    intbitset1.discard(5)
+    assert intbitset1.select(1) == 1000
+    assert intbitset1.rank(1000) == 2
+    intbitset1 |= intbitset([2, 3])
+    assert intbitset1[1] == 2
+    assert intbitset1[1:3] == intbitset([2, 3])
+    assert intbitset1.rank(1000) == 4
+
+
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[]],
+)
+def test_set_buffer(set1):
+    intbitset1 = intbitset(set1)
+    with memoryview(intbitset1) as view:
+        assert view.readonly
+        assert view.format == "Q"
+        assert view.itemsize == intbitset1.get_wordbytsize()
+        assert len(view) == intbitset1.get_size() + 1
+        words = view.tolist()
+    assert [
+        i * 64 + j for i, word in enumerate(words) for j in range(64) if word >> j & 1
+    ] == set1
+
+
+@pytest.mark.parametrize(
+    argnames="mutate",
+    argvalues=[
+        lambda s: s.add(1000),
+        lambda s: s.discard(1),
+        lambda s: s.clear(),
+        lambda s: s.update([7]),
+        lambda s: s.__ior__(intbitset([2000])),
+        lambda s: s.__iand__(intbitset([2000])),
+        lambda s: s.fastload(intbitset([5]).fastdump()),
+    ],
+)
+def test_set_buffer_prevents_changes(mutate):
+    intbitset1 = intbitset([1, 2, 3])
+    view = memoryview(intbitset1)
+    with pytest.raises(BufferError):
+        mutate(intbitset1)
+    assert intbitset1 == intbitset([1, 2, 3])
+    # Operations reading it are fine.
+    assert intbitset1 | intbitset([100000]) == intbitset([1, 2, 3, 100000])
+    assert intbitset1 != intbitset([100000])
+    view.release()
+    mutate(intbitset1)
+
+
+def test_set_ops_preserve_operands():
+    small = intbitset([1, 2, 3])
+    big = intbitset(range(0, 100000, 7))
+    allocated = small.get_allocated()
+    small | big
+    small ^ big
+    big - small
+    small == big
+    small.isdisjoint(big)
+    big |= small
+    big &= small
+    assert small.get_allocated() == allocated
+
+
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[]],
+)
+@pytest.mark.parametrize(argnames="typecode", argvalues=["i", "I", "l", "L", "q", "Q"])
+def test_set_to_array_from_indices(set1, typecode):
+    intbitset1 = intbitset(set1)
+    assert intbitset1.to_array() == array("I", set1)
+    assert intbitset.from_indices(array(typecode, set1)) == intbitset1
+    assert intbitset.from_indices(array(typecode, reversed(set1))) == intbitset1
+
+
+def test_set_from_indices_errors():
+    with pytest.raises(ValueError):
+        intbitset.from_indices(array("q", [1, -1]))
+    with pytest.raises(OverflowError):
+        intbitset.from_indices(array("Q", [1, 2 ** 40]))
+    with pytest.raises(TypeError):
+        intbitset.from_indices(array("d", [1.0]))
+    with pytest.raises(TypeError):
+        intbitset.from_indices([1, 2])
+    with pytest.raises(OverflowError):
+        intbitset([1], trailing_bits=True).to_array()
+
+
+def test_set_to_numpy():
+    numpy = pytest.importorskip("numpy")
+    intbitset1 = intbitset([1, 5, 1000])
+    assert intbitset1.to_numpy().dtype == numpy.uint32
+    assert intbitset1.to_numpy().tolist() == [1, 5, 1000]
+    assert intbitset.from_indices(numpy.array([1000, 5, 1], dtype=numpy.int64)) == intbitset1
+    assert numpy.frombuffer(intbitset1, dtype=numpy.uint64)[0] == 34
+
+
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[]],
+)
+@pytest.mark.parametrize(argnames="typecode", argvalues=["i", "I", "l", "L", "q", "Q"])
+def test_set_buffer_constructor_and_updates(set1, typecode):
+    sorted_array = array(typecode, set1)
+    unsorted_array = array(typecode, reversed(set1))
+    intbitset1 = intbitset(sorted_array)
+    assert list(intbitset1) == set1
+    check_bitset(intbitset1)
+    assert intbitset(unsorted_array) == intbitset1
+    intbitset2 = intbitset([1, 10000])
+    intbitset2.update(unsorted_array)
+    assert intbitset2 == intbitset1 | intbitset([1, 10000])
+    intbitset2 = intbitset([1, 10000])
+    intbitset2 += sorted_array
+    assert intbitset2 == intbitset1 | intbitset([1, 10000])
+    intbitset2 -= unsorted_array
+    assert intbitset2 == intbitset([1, 10000]) - intbitset1
+    intbitset2 = intbitset([1, 10000], trailing_bits=True)
+    intbitset2.difference_update(sorted_array)
+    assert intbitset2 == intbitset([1, 10000], trailing_bits=True) - intbitset1
+
+
+def test_set_buffer_constructor_errors():
+    with pytest.raises(ValueError):
+        intbitset(array("i", [1, -1]))
+    with pytest.raises(ValueError):
+        intbitset(array("Q", [1, 2 ** 40]))
+    intbitset1 = intbitset([1, 2])
+    with pytest.raises(ValueError):
+        intbitset1.update(array("q", [3, -1]))
+    # Nothing is added when an element is wrong.
+    assert intbitset1 == intbitset([1, 2])
+    # Arrays of bytes still hold dumps.
+    assert intbitset(array("B", intbitset([1, 2]).fastdump())) == intbitset1
+
+
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[]],
+)
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[0, 1])
+def test_set_raw_dump(set1, trailing_bits):
+    intbitset1 = intbitset(set1, trailing_bits=trailing_bits)
+    dump = intbitset1.fastdump("raw")
+    assert intbitset(dump) == intbitset1
+    intbitset2 = intbitset()
+    intbitset2.fastload(dump)
+    assert intbitset2 == intbitset1
+    intbitset3 = intbitset.from_buffer(dump)
+    assert intbitset3 == intbitset1
+    check_bitset(intbitset3)
+    assert intbitset.from_buffer(dump, readonly=False) == intbitset1
+
+
+def test_set_raw_dump_errors():
+    dump = intbitset([1, 2, 3]).fastdump("raw")
+    with pytest.raises(ValueError):
+        intbitset(dump[:-1])
+    with pytest.raises(ValueError):
+        intbitset(dump[:4] + b"\x07" + dump[5:])
+    with pytest.raises(ValueError):
+        intbitset([1]).fastdump("unknown")
+
+
+@pytest.mark.parametrize(
+    argnames="mutate",
+    argvalues=[
+        lambda s: s.add(1000),
+        lambda s: s.discard(1),
+        lambda s: s.clear(),
+        lambda s: s.update([7], [8]),
+        lambda s: s.intersection_update([1], [1, 2]),
+        lambda s: s.__ior__(intbitset([2000])),
+        lambda s: s.__isub__(intbitset([2])),
+        lambda s: s.fastload(intbitset([5]).fastdump()),
+    ],
+)
+def test_set_from_buffer_copy_on_write(mutate):
+    intbitset1 = intbitset([1, 2, 3])
+    buf = bytearray(intbitset1.fastdump("raw"))
+    intbitset2 = intbitset.from_buffer(buf)
+    # The words are read in place, so buf cannot be resized...
+    with pytest.raises(BufferError):
+        buf.append(0)
+    assert intbitset2 | intbitset([4]) == intbitset([1, 2, 3, 4])
+    # ... until they are copied by the first change.
+    mutate(intbitset2)
+    mutate(intbitset1)
+    assert intbitset2 == intbitset1
+    buf.append(0)
+
+
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[], range(0, 100000, 3), range(1000, 5000)],
+)
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[0, 1])
+@pytest.mark.parametrize(argnames="codec", argvalues=["zlib", "rle"])
+def test_set_compressed_dump(set1, trailing_bits, codec):
+    intbitset1 = intbitset(set1, trailing_bits=trailing_bits)
+    dump = intbitset1.fastdump(codec)
+    assert intbitset(dump) == intbitset1
+    intbitset2 = intbitset()
+    intbitset2.fastload(dump)
+    assert intbitset2 == intbitset1
+
+
+def test_set_compressed_dump_size():
+    intbitset1 = intbitset(range(1000, 100000))
+    assert len(intbitset1.fastdump("rle")) < 64
+    assert len(intbitset1.fastdump("zlib", 9)) <= len(intbitset1.fastdump("zlib", 1))
+    assert intbitset(intbitset1.fastdump("zlib", 0)) == intbitset1
+
+
+def test_set_compressed_dump_errors():
+    dump = intbitset(range(0, 10000, 3)).fastdump("rle")
+    for corrupted in (dump[:-1], dump + b"\x00", dump[:40]):
+        with pytest.raises(ValueError):
+            intbitset(corrupted)
+    with pytest.raises(ValueError):
+        intbitset([1]).fastdump("zlib", 10)
+
+
+def test_set_mmap(tmp_path):
+    intbitset1 = intbitset(range(0, 100000, 3))
+    path = tmp_path / "intbitset.dump"
+    path.write_bytes(intbitset1.fastdump("raw"))
+    intbitset2 = intbitset.mmap(str(path))
+    assert intbitset2 == intbitset1
+    assert len(intbitset2) == len(intbitset1)
+    assert 99999 in intbitset2
+    assert list(intbitset2 & intbitset([3, 4, 6])) == [3, 6]
+    intbitset2.add(1)
+    assert intbitset2 == intbitset1 | intbitset([1])
+    assert intbitset.mmap(str(path)) == intbitset1
+
+
+@pytest.fixture(params=[1, 3])
+def threads(request):
+    # tiny thresholds, so that small sets are split across threads too
+    thresholds = intbitset_module._set_thresholds(0, 8)
+    previous = intbitset_module.set_num_threads(request.param)
+    yield request.param
+    intbitset_module.set_num_threads(previous)
+    intbitset_module._set_thresholds(*thresholds)
+
+
+@pytest.mark.parametrize(
+    argnames="function",
+    argvalues=FUNCTIONS,
+)
+def test_set_ops_threads(threads, function):
+    set1 = list(range(0, 20000, 3)) + list(range(20000, 25000))
+    set2 = list(range(0, 30011, 7))
+    for trailing_bits1, trailing_bits2 in ((0, 0), (0, 1), (1, 0), (1, 1)):
+        check_functions_work(
+            function,
+            intbitset(set1, trailing_bits=trailing_bits1),
+            intbitset(set2, trailing_bits=trailing_bits2),
+        )
+
+
+def test_set_count_ops_threads(threads):
+    set1 = set(range(0, 30000, 3))
+    set2 = set(range(0, 50011, 7))
+    intbitset1 = intbitset(set1)
+    intbitset2 = intbitset(set2)
+    assert len(intbitset(set1)) == len(set1)
+    assert intbitset1.intersection_count(intbitset2) == len(set1 & set2)
+    assert intbitset2.union_count(intbitset1) == len(set1 | set2)
+    assert intbitset2.difference_count(intbitset1) == len(set2 - set1)
+    assert intbitset1.symmetric_difference_count(intbitset2) == len(set1 ^ set2)
+    # the operands can be changed afterwards
+    intbitset1.add(1)
+    intbitset2 &= intbitset1
+    assert intbitset2 == intbitset(set1 & set2)
+
+
+def test_set_num_threads():
+    previous = intbitset_module.set_num_threads(2)
+    try:
+        assert intbitset_module.get_num_threads() == 2
+        assert intbitset_module.set_num_threads(4) == 2
+        with pytest.raises(ValueError):
+            intbitset_module.set_num_threads(0)
+        assert intbitset_module.get_num_threads() == 4
+    finally:
+        intbitset_module.set_num_threads(previous)
+
+
+def test_set_num_threads_during_operation():
+    # The operations running meanwhile keep on using their workers.
+    import threading
+    import time
+    thresholds = intbitset_module._set_thresholds(0, 8)
+    previous = intbitset_module.set_num_threads(8)
+    intbitset1 = intbitset(range(0, 64 * 20000, 3))
+    intbitset2 = intbitset(range(0, 64 * 20000, 5))
+    expected = intbitset1.intersection_count(intbitset2)
+    counts = []
+    errors = []
+    done = threading.Event()
+
+    def operate():
+        while not done.is_set():
+            try:
+                counts.append(intbitset1.intersection_count(intbitset2))
+            except Exception as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=operate)
+    thread.start()
+    try:
+        n = 0
+        while len(counts) + len(errors) < 200:
+            intbitset_module.set_num_threads(8 + n % 3)
+            n += 1
+            time.sleep(0)
+    finally:
+        done.set()
+        thread.join()
+        intbitset_module.set_num_threads(previous)
+        intbitset_module._set_thresholds(*thresholds)
+    assert errors == []
+    assert set(counts) == {expected}
+
+
+@pytest.mark.parametrize(argnames="n", argvalues=[1, 2, 255, 256, 257, 600])
+def test_set_union_all_intersection_all(threads, n):
+    sets = [set(range(i % 7, 3000 + i * 5, 1 + i % 5)) for i in range(n)]
+    intbitsets = [intbitset(set1) for set1 in sets]
+    intbitsets[-1] = intbitset(sorted(sets[-1]), trailing_bits=True)
+    sets[-1] |= set(range(max(sets[-1]), 10001))
+    copies = [intbitset(intbitset1) for intbitset1 in intbitsets]
+    union = intbitset_module.union_all(iter(intbitsets))
+    intersection = intbitset_module.intersection_all(s for s in intbitsets)
+    assert union.is_infinite()
+    assert set(union.extract_finite_list(10000)) == set.union(*sets)
+    assert set(intersection.extract_finite_list(10000)) == set.intersection(*sets)
+    assert intersection.is_infinite() == (n == 1)
+    # the arguments are left untouched, and the result is always new
+    assert intbitsets == copies
+    assert union is not intbitsets[0] and intersection is not intbitsets[0]
+    assert intbitset_module.union_all(sorted(s) for s in sets[:-1]) == intbitset(set().union(*sets[:-1]))
+
+
+def test_set_union_all_intersection_all_empty():
+    assert intbitset_module.union_all([]) == intbitset()
+    with pytest.raises(ValueError):
+        intbitset_module.intersection_all([])
+
+
+def test_set_intersection_all_stops_when_empty():
+    def generate():
+        yield intbitset([1, 2])
+        for _ in range(1000):
+            yield intbitset([3])
+        raise AssertionError("consumed after the intersection became empty")
+
+    assert intbitset_module.intersection_all(generate()) == intbitset()
+
+
+def test_set_hash_covers_all_words():
+    assert hash(intbitset([1, 1000])) != hash(intbitset([1, 2000]))
+    assert hash(intbitset([1, 2])) == hash(intbitset([1, 2], preallocate=100000))
+    assert hash(intbitset(trailing_bits=True)) != hash(intbitset())
+
+
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[]],
+)
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[0, 1])
+def test_frozenintbitset(set1, trailing_bits):
+    intbitset1 = intbitset(set1, trailing_bits=trailing_bits)
+    frozenintbitset1 = frozenintbitset(intbitset1)
+    assert frozenintbitset1 == intbitset1
+    assert hash(frozenintbitset1) == hash(intbitset1)
+    assert frozenintbitset1 == frozenintbitset(set1, trailing_bits=trailing_bits)
+    assert {frozenintbitset1: 1}[frozenintbitset(intbitset1)] == 1
+    # the shared words are copied by the first change of the intbitset
+    intbitset1.add(5)
+    intbitset1.discard(1)
+    assert frozenintbitset1 == intbitset(set1, trailing_bits=trailing_bits)
+    check_bitset(frozenintbitset1)
+    assert copy.copy(frozenintbitset1) is frozenintbitset1
+    assert frozenintbitset1.copy() is frozenintbitset1
+    unpickled = pickle.loads(pickle.dumps(frozenintbitset1, -1))
+    assert type(unpickled) is frozenintbitset and unpickled == frozenintbitset1
+
+
+@pytest.mark.parametrize(
+    argnames="mutate",
+    argvalues=[
+        lambda s: s.add(1000),
+        lambda s: s.discard(1),
+        lambda s: s.remove(1),
+        lambda s: s.pop(),
+        lambda s: s.clear(),
+        lambda s: s.update([7]),
+        lambda s: s.intersection_update([1], [1, 2]),
+        lambda s: s.difference_update([1]),
+        lambda s: s.update_with_signs({1: -1}),
+        lambda s: s.fastload(intbitset([5]).fastdump()),
+        lambda s: s.__delitem__(1),
+    ],
+)
+def test_frozenintbitset_is_immutable(mutate):
+    frozenintbitset1 = frozenintbitset([1, 2, 3])
+    with pytest.raises(TypeError):
+        mutate(frozenintbitset1)
+    assert frozenintbitset1 == intbitset([1, 2, 3])
+
+
+def test_frozenintbitset_ops():
+    frozenintbitset1 = frozenintbitset([1, 2, 3])
+    intbitset1 = intbitset([3, 4])
+    for result in (
+        frozenintbitset1 | intbitset1,
+        frozenintbitset1 & intbitset1,
+        frozenintbitset1 ^ intbitset1,
+        frozenintbitset1 - intbitset1,
+        frozenintbitset1.union(intbitset1),
+        frozenintbitset1.intersection(intbitset1),
+        frozenintbitset1.difference(intbitset1),
+    ):
+        assert type(result) is frozenintbitset
+    assert type(intbitset1 | frozenintbitset1) is intbitset
+    assert intbitset1 | frozenintbitset1 == frozenintbitset1 | intbitset1 == intbitset([1, 2, 3, 4])
+    assert frozenintbitset1 <= frozenintbitset([1, 2, 3, 4])
+    # in-place operators return new frozenintbitsets
+    frozenintbitset2 = frozenintbitset1
+    frozenintbitset2 |= intbitset1
+    frozenintbitset2 -= [1]
+    frozenintbitset2 += 7
+    assert type(frozenintbitset2) is frozenintbitset
+    assert frozenintbitset2 == intbitset([2, 3, 4, 7])
+    assert frozenintbitset1 == intbitset([1, 2, 3])
+    assert repr(frozenintbitset1) == "frozenintbitset([1, 2, 3])"
+
+
+@pytest.mark.parametrize(
+    argnames="mutate",
+    argvalues=[
+        lambda s: s.add(1000),
+        lambda s: s.discard(1),
+        lambda s: s.pop(),
+        lambda s: s.clear(),
+        lambda s: s.update([7], [8]),
+        lambda s: s.update(array("I", [7])),
+        lambda s: s.intersection_update([1], [1, 2]),
+        lambda s: s.difference_update([1]),
+        lambda s: s.update_with_signs({1: -1, 70: 1}),
+        lambda s: s.__iadd__(9),
+        lambda s: s.__isub__([2]),
+        lambda s: s.__iand__(intbitset([2, 3])),
+        lambda s: s.__ior__(intbitset([2000])),
+        lambda s: s.__ixor__(intbitset([1, 2000])),
+        lambda s: s.__delitem__(3),
+        lambda s: s.fastload(intbitset([5]).fastdump()),
+    ],
+)
+def test_set_clones_copy_on_write(mutate):
+    intbitset1 = intbitset([1, 2, 3, 100])
+    clones = [
+        intbitset(intbitset1),
+        intbitset1.copy(),
+        copy.copy(intbitset1),
+        copy.deepcopy(intbitset1),
+        intbitset1.difference(),
+        frozenintbitset(intbitset1),
+    ]
+    # the clones share the words until one of them is modified
+    mutate(clones[0])
+    expected = intbitset([1, 2, 3, 100])
+    mutate(expected)
+    assert clones[0] == expected
+    mutate(intbitset1)
+    assert intbitset1 == expected
+    for clone in clones[1:]:
+        assert clone == intbitset([1, 2, 3, 100])
+        check_bitset(clone)
+    mutate(clones[1])
+    assert clones[1] == expected
+    assert clones[2] == intbitset([1, 2, 3, 100])
+
+
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[0, 1])
+def test_set_compact(trailing_bits):
+    intbitset1 = intbitset(list(range(10)) + [100000], trailing_bits=trailing_bits, preallocate=200000)
+    intbitset1.discard(100000)
+    expected = intbitset(intbitset1.fastdump())
+    allocated = intbitset1.get_allocated()
+    intbitset1.compact()
+    assert intbitset1.get_allocated() == intbitset1.get_size() + 1 < allocated
+    assert intbitset1 == expected
+    check_bitset(intbitset1)
+    intbitset1.add(300000)
+    assert 300000 in intbitset1
+    # shared and exported words are left alone
+    intbitset2 = intbitset(range(0, 100000, 7), preallocate=500000)
+    allocated = intbitset2.get_allocated()
+    clone = intbitset(intbitset2)
+    clone.compact()
+    assert clone.get_allocated() == allocated
+    with memoryview(intbitset2):
+        with pytest.raises(BufferError):
+            intbitset2.compact()
+    frozenintbitset(range(10)).compact()
+
+
+def test_set_memory_is_given_back():
+    intbitset1 = intbitset(range(0, 1000000, 3))
+    intbitset1.clear()
+    assert intbitset1.get_allocated() == 1
+    intbitset1 = intbitset(range(0, 1000000, 3))
+    intbitset1 &= intbitset([1, 3, 6])
+    assert intbitset1 == intbitset([3, 6])
+    assert intbitset1.get_allocated() == intbitset1.get_size() + 1
+
+
+@pytest.mark.parametrize(argnames="function", argvalues=FUNCTIONS)
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[0, 1])
+def test_set_ops_offset(function, trailing_bits):
+    # only the words from the smallest element on are allocated, and the
+    # operands do not have to start at the same word
+    high = intbitset(range(4000000, 4010000, 7), trailing_bits=trailing_bits)
+    band = intbitset(range(4005000, 4020000, 3))
+    low = intbitset(range(0, 4008000, 1000))
+    for intbitset1, intbitset2 in [(high, band), (band, high), (high, low), (low, high)]:
+        check_functions_work(function, intbitset(intbitset1), intbitset(intbitset2))
+
+
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[0, 1])
+def test_set_offset(trailing_bits):
+    intbitset1 = intbitset(range(40000000, 40100000, 7), trailing_bits=trailing_bits)
+    assert len(intbitset1.fastdump("raw")) < 20000
+    assert len(intbitset1.fastdump("rle")) < 20000
+    for codec in ("raw", "zlib", "rle"):
+        assert intbitset(intbitset1.fastdump(codec)) == intbitset1
+        assert intbitset.from_buffer(intbitset1.fastdump(codec)) == intbitset1
+    assert intbitset(intbitset1.fastdump()) == intbitset1
+    assert pickle.loads(pickle.dumps(intbitset1)) == intbitset1
+    # equal whatever their first word
+    intbitset2 = intbitset(intbitset1)
+    intbitset2.add(5)
+    intbitset2.discard(5)
+    intbitset2.compact()
+    assert intbitset2 == intbitset1
+    assert hash(intbitset2) == hash(intbitset1)
+    # the words are allocated further down when needed
+    intbitset2.add(40)
+    assert 40 in intbitset2 and 41 not in intbitset2
+    assert intbitset2 == intbitset1 | intbitset([40])
+    assert intbitset2.rank(40000000) == 2
+    assert intbitset2.select(1) == 40000000
+    assert intbitset1.intersection_count(intbitset([40000007, 5])) == 1
+    # the buffer starts at word 0
+    intbitset3 = intbitset([40000000])
+    with memoryview(intbitset3) as view:
+        assert len(view) == 40000000 // 64 + 2
+        assert view[-2] == 1 << (40000000 % 64)
+
+
+def test_set_empty_hash():
+    intbitset1 = intbitset(range(40000000, 40000100))
+    intbitset1 -= intbitset(range(40000000, 40000100))
+    assert hash(intbitset1) == hash(intbitset()) == hash(intbitset([]))
+
+
+def test_set_offset_dump_version():
+    # dumps starting at word 0 can still be read by older versions
+    assert intbitset([1, 2, 3]).fastdump("raw")[4] == 1
+    assert intbitset([10000, 20000]).fastdump("raw")[4] == 2
+
+
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[0, 1])
+@pytest.mark.parametrize(
+    argnames="start, stop",
+    argvalues=[(0, 0), (5, 3), (0, 1), (0, 64), (63, 65), (1, 128), (60, 1000), (4000000, 4000300), (90, 4000100)],
+)
+def test_set_range_ops(trailing_bits, start, stop):
+    intbitset1 = intbitset(range(50, 4000200, 13), trailing_bits=trailing_bits)
+    limit = 4000500
+    expected = set(intbitset1.extract_finite_list(limit))
+    span = set(range(start, stop))
+    assert intbitset1.count_range(start, stop) == len(expected & span)
+    for method, operation in [("add_range", set.__or__), ("discard_range", set.__sub__), ("flip_range", set.__xor__)]:
+        intbitset2 = intbitset(intbitset1)
+        getattr(intbitset2, method)(start, stop)
+        assert set(intbitset2.extract_finite_list(limit)) == operation(expected, span)
+        assert intbitset2.is_infinite() == bool(trailing_bits)
+        assert intbitset1 == intbitset(range(50, 4000200, 13), trailing_bits=trailing_bits)
+        check_bitset(intbitset2)
+    assert intbitset.from_range(start, stop) == intbitset(range(start, stop))
+    assert type(frozenintbitset.from_range(start, stop)) is frozenintbitset
+
+
+def test_set_range_infinite():
+    intbitset1 = intbitset([10], trailing_bits=True)
+    assert intbitset1.count_range(0, 1000) == 990
+    intbitset1.discard_range(20, 1000)
+    assert intbitset1.extract_finite_list(1100) == list(range(10, 20)) + list(range(1000, 1101))
+    intbitset1.discard_range(500, 100000)
+    assert intbitset1.count_range(0, 100000) == 10
+    assert 99999 not in intbitset1
+    assert 100000 in intbitset1
+
+
+def test_set_range_errors():
+    with pytest.raises(ValueError):
+        intbitset().add_range(-1, 5)
+    with pytest.raises(ValueError):
+        intbitset().count_range(0, -5)
+    with pytest.raises(OverflowError):
+        intbitset().flip_range(0, intbitset_module.__maxelem__ + 2)
+    with pytest.raises(OverflowError):
+        intbitset.from_range(0, intbitset_module.__maxelem__ + 2)
+    with pytest.raises(TypeError):
+        frozenintbitset([1]).discard_range(0, 5)
+
+
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[0, 1])
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[], [0], list(range(4000000, 4000300, 7))],
+)
+def test_set_navigation(set1, trailing_bits):
+    intbitset1 = intbitset(set1, trailing_bits=trailing_bits)
+    up_to = max(set1 + [0]) + 200
+    expected = intbitset1.extract_finite_list(up_to)
+    if expected:
+        assert intbitset1.min() == expected[0]
+    else:
+        with pytest.raises(ValueError):
+            intbitset1.min()
+    if trailing_bits:
+        with pytest.raises(OverflowError):
+            intbitset1.max()
+        with pytest.raises(OverflowError):
+            reversed(intbitset1)
+    else:
+        assert list(reversed(intbitset1)) == expected[::-1]
+        if expected:
+            assert intbitset1.max() == expected[-1]
+        else:
+            with pytest.raises(ValueError):
+                intbitset1.max()
+    for elem in sorted(set(range(0, 200)) | set(x + d for x in set1 for d in (-65, -1, 0, 1, 64))):
+        if elem < 0 or elem >= up_to:
+            continue
+        above = [x for x in expected if x > elem]
+        below = [x for x in expected if x < elem]
+        assert intbitset1.next_above(elem) == (above[0] if above else None)
+        assert intbitset1.prev_below(elem) == (below[-1] if below else None)
+
+
+def test_set_navigation_bounds():
+    intbitset1 = intbitset([0, intbitset_module.__maxelem__])
+    assert intbitset1.next_above(0) == intbitset_module.__maxelem__
+    assert intbitset1.next_above(intbitset_module.__maxelem__) is None
+    assert intbitset1.prev_below(intbitset_module.__maxelem__) == 0
+    assert intbitset1.prev_below(0) is None
+    assert intbitset1.max() == intbitset1.pop() == intbitset_module.__maxelem__
+    with pytest.raises(OverflowError):
+        intbitset1.prev_below(intbitset_module.__maxelem__ + 1)
+    intbitset2 = intbitset([1, 2, 3])
+    iterator = reversed(intbitset2)
+    assert next(iterator) == 3
+    intbitset2.add(4)
+    with pytest.raises(RuntimeError):
+        next(iterator)
+
+
+@pytest.mark.parametrize(
+    argnames="set1",
+    argvalues=TEST_SETS + [[]],
+)
+def test_set_getitem_negative_steps(set1):
+    intbitset1 = intbitset(set1)
+    pythonlist1 = list(set1)
+    for start in [None, -len(set1) - 1, -1, 0, 1, len(set1)]:
+        for stop in [None, -len(set1) - 1, -1, 0, 1, len(set1)]:
+            for step in range(-3, 0):
+                assert list(intbitset1[start:stop:step]) == sorted(pythonlist1[start:stop:step])
+
+
+EXPRESSIONS = [
+    (lambda a, b, c: a.expr() | b | c, lambda a, b, c: a | b | c),
+    (lambda a, b, c: (a.expr() | b) & c.expr() - a, lambda a, b, c: (a | b) & (c - a)),
+    (lambda a, b, c: a.expr() ^ (b.expr() & ~c.expr()), lambda a, b, c: a ^ (b - c)),
+    (lambda a, b, c: ~(a.expr() | b) & c, lambda a, b, c: c - (a | b)),
+    (lambda a, b, c: a.expr() - (b.expr() - (c.expr() ^ a)), lambda a, b, c: a - (b - (c ^ a))),
+    (lambda a, b, c: (a.expr() & a) | (b.expr() ^ b), lambda a, b, c: intbitset(a)),
+]
+
+
+@pytest.mark.parametrize(argnames="expression", argvalues=EXPRESSIONS)
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[(0, 0, 0), (1, 0, 0), (0, 1, 1), (1, 1, 1)])
+def test_expr(expression, trailing_bits):
+    lazy, eager = expression
+    a = intbitset(range(4000000, 4010000, 7), trailing_bits=trailing_bits[0])
+    b = intbitset(range(3000, 4005000, 1001), trailing_bits=trailing_bits[1])
+    c = intbitset(range(4002000, 4050000, 3), trailing_bits=trailing_bits[2])
+    expected = eager(a, b, c)
+    expr = lazy(a, b, c)
+    result = expr.evaluate()
+    assert result == expected
+    check_bitset(result)
+    if expected.is_infinite():
+        with pytest.raises(OverflowError):
+            expr.count()
+    else:
+        assert expr.count() == len(expected)
+    assert expr.first(20) == expected.extract_finite_list(4060000)[:20]
+    assert expr.first(0) == []
+    # Looked for by growing chunks, across the words and the trailing bits.
+    assert expr.first(3000) == expected.extract_finite_list(4060000)[:3000]
+    if not expected.is_infinite():
+        assert expr.first(10 ** 9) == list(expected)
+
+
+@pytest.mark.parametrize(
+    argnames="function",
+    argvalues=[operator.and_, operator.or_, operator.xor, operator.sub],
+)
+def test_expr_reflected(function):
+    a = intbitset([1, 2, 3, 10000])
+    b = intbitset([3, 4, 10000, 20000])
+    expr = function(a, b.expr())
+    assert isinstance(expr, intbitset_module.intbitset_expr)
+    assert expr.evaluate() == function(a, b)
+    with pytest.raises(TypeError):
+        function(a, [3, 4])
+
+
+def test_expr_simplify():
+    a = intbitset([1, 2, 3])
+    empty = intbitset()
+    full = intbitset(trailing_bits=True)
+    assert (a.expr() & empty).evaluate() == empty
+    assert (a.expr() | full).evaluate() == full
+    assert (a.expr() ^ full).evaluate() == full - a
+    with pytest.raises(OverflowError):
+        (full.expr() - a).count()
+    assert (~(~a.expr())).evaluate() == a
+    assert (a.expr() - a).count() == 0
+    assert (~full.expr()).first(5) == []
+    assert (~a.expr()).first(5) == [0, 4, 5, 6, 7]
+    assert intbitset.expr(a).evaluate() == a
+
+
+def test_expr_first_big_k():
+    # A big k does not allocate more than the elements found.
+    a = intbitset(range(0, 100000, 3))
+    b = intbitset(range(0, 100000, 5))
+    tracemalloc.start()
+    try:
+        assert (a.expr() & b).first(10 ** 9) == list(range(0, 100000, 15))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 10 ** 6
+
+
+def test_expr_lazy():
+    a = intbitset([1, 2, 3])
+    b = intbitset([3, 4])
+    expr = a.expr() | b
+    a.add(10)
+    assert expr.evaluate() == intbitset([1, 2, 3, 4, 10])
+    assert "|" in repr(expr)
+    with pytest.raises(TypeError):
+        a.expr() | [1, 2]
+    expr = a.expr()
+    for i in range(600):
+        expr = intbitset([i]).expr() - expr
+    with pytest.raises(ValueError):
+        expr.evaluate()
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda x: x.add(100),
+        lambda x: x.discard(1),
+        lambda x: x.clear(),
+        lambda x: x.__ior__(intbitset([200])),
+        lambda x: x.__iand__(intbitset([1])),
+        lambda x: x.__ixor__(intbitset([1])),
+        lambda x: x.__isub__(intbitset([1])),
+        lambda x: x.__iadd__([300]),
+        lambda x: x.update([400]),
+        lambda x: x.intersection_update([1]),
+        lambda x: x.add_range(5, 500),
+        lambda x: x.flip_range(0, 64),
+        lambda x: x.pop(),
+        lambda x: x.fastload(intbitset([7]).fastdump()),
+    ],
+)
+def test_get_version(change):
+    x = intbitset([1, 2, 3])
+    clone = intbitset(x)
+    version = x.get_version()
+    clone_version = clone.get_version()
+    change(x)
+    assert x.get_version() > version
+    assert clone.get_version() == clone_version
+    version = x.get_version()
+    x.compact()
+    list(x)
+    assert x.get_version() == version
+
+
+def test_result_cache():
+    cache = ResultCache()
+    a = intbitset([1, 2, 3])
+    b = intbitset([2, 3, 4])
+    c = intbitset([3, 10])
+    result = cache.intersection(a, b)
+    assert result == intbitset([2, 3])
+    assert isinstance(result, frozenintbitset)
+    assert cache.intersection(b, a) is result
+    assert cache.union(a, b, c) == intbitset([1, 2, 3, 4, 10])
+    assert cache.difference(a, b) == intbitset([1])
+    assert cache.difference(b, a) == intbitset([4])
+    assert cache.symmetric_difference(a, b, c) == intbitset([1, 3, 4, 10])
+    query = lambda x, y, z: ((x.expr() | y) - z).evaluate()
+    assert cache.compute(query, a, b, c) == intbitset([1, 2, 4])
+    assert cache.compute(query, a, b, c) == intbitset([1, 2, 4])
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 6
+    assert len(cache) == 6
+    a.add(4)
+    assert cache.intersection(a, b) == intbitset([2, 3, 4])
+    assert cache.stats()["misses"] == 7
+    assert len(cache) == 1
+    cache.union(a, c)
+    assert len(cache) == 2
+    del b
+    cache.union(a, c)
+    assert len(cache) == 1
+    assert cache.stats()["hits"] == 3
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.stats()["size"] == 0
+    with pytest.raises(TypeError):
+        cache.union(a, [1, 2])
+    with pytest.raises(KeyError):
+        cache.compute("nand", a, c)
+
+
+def test_result_cache_stale():
+    # The results of the previous versions of an operand are dropped by the
+    # next lookup with it, even if nothing is inserted.
+    cache = ResultCache()
+    a = intbitset(range(0, 64 * 100, 3))
+    b = intbitset(range(0, 64 * 100, 5))
+    c = intbitset(range(64 * 50, 64 * 150, 7))
+    cache.union(a, b)
+    cache.intersection(a, c)
+    stale_size = cache.stats()["size"]
+    cache.union(b, c)
+    size = cache.stats()["size"]
+    a.add(64 * 200)
+    assert cache.stats()["entries"] == 3
+    with pytest.raises(ZeroDivisionError):
+        cache.compute(lambda x: 1 // 0, a)
+    stats = cache.stats()
+    assert stats["entries"] == len(cache) == 1
+    assert stats["size"] == size - stale_size
+    assert cache.union(b, c) == b | c
+    assert cache.stats()["hits"] == 1
+
+
+def test_result_cache_eviction():
+    sets = [intbitset([i, i + 64 * 100]) for i in range(10)]
+    cache = ResultCache(max_bytes=0)
+    cache.union(sets[0], sets[1])
+    assert len(cache) == 0
+    cache = ResultCache(max_bytes=3 * 1000)
+    for i in range(9):
+        cache.union(sets[i], sets[i + 1])
+        assert cache.stats()["size"] <= 3000
+    stats = cache.stats()
+    assert stats["evictions"] == 9 - len(cache) > 0
+    cache.union(sets[7], sets[8])
+    assert cache.stats()["hits"] == 1
+    cache.union(sets[0], sets[1])
+    assert cache.stats()["hits"] == 1
+
+
+def test_bench_suite(tmp_path):
+    path = tmp_path / "results.json"
+    bench_main([
+        "--suite", "--sizes", "1000", "--densities", "0.01", "--repeat", "1",
+        "--case", "and", "--case", "iterate", "--case", "fastload", "--json", str(path),
+    ])
+    document = json.loads(path.read_text())
+    assert document["benchmark"] == "suite"
+    assert document["environment"]["intbitset"] == intbitset_module.__version__
+    results = {(result["case"], result["trailing_bits"]): result for result in document["results"]}
+    assert sorted(results) == [("and", False), ("and", True), ("fastload", False), ("fastload", True), ("iterate", False)]
+    assert all(result["intbitset"] > 0 for result in results.values())
+    assert results["and", False]["set"] > 0
+    assert results["and", True]["set"] is None
+    assert set(SUITE) >= {"init_list", "init_tuple", "init_array", "ior", "len", "contains", "slice", "pickle_loads"}
+
+
+def test_sizeof():
+    empty = intbitset()
+    big = intbitset(range(0, 100000, 3))
+    assert sys.getsizeof(big) - sys.getsizeof(empty) >= (big.get_allocated() - 1) * big.get_wordbytsize()
+    high = intbitset([10 ** 6])
+    assert sys.getsizeof(high) - sys.getsizeof(empty) < 100
+    assert sys.getsizeof(intbitset(big)) == sys.getsizeof(big)
+
+
+def test_memory_stats():
+    gc.collect()
+    before = intbitset_module.memory_stats()
+    x = intbitset(100000)
+    x.add(5)
+    stats = intbitset_module.memory_stats()
+    assert stats["live_sets"] == before["live_sets"] + 1
+    assert stats["live_bytes"] == before["live_bytes"] + sys.getsizeof(x) - sys.getsizeof(intbitset(no_allocate=1))
+    assert stats["peak_bytes"] >= stats["live_bytes"]
+    assert stats["wasted_bytes"] - before["wasted_bytes"] == (x.get_allocated() - x.get_size() - 1) * 8 > 0
+    x.compact()
+    assert intbitset_module.memory_stats()["wasted_bytes"] == before["wasted_bytes"]
+    x.add(10 ** 6)
+    stats = intbitset_module.memory_stats()
+    assert stats["resizes"] > before["resizes"]
+    assert stats["reallocs"] > before["reallocs"]
+    del x
+    assert intbitset_module.memory_stats()["live_bytes"] == before["live_bytes"]
+    assert intbitset_module.memory_stats()["live_sets"] == before["live_sets"]
+
+
+def test_memory_tracemalloc():
+    tracemalloc.start()
+    try:
+        x = intbitset(range(0, 100000, 3))
+        y = x | intbitset([10 ** 6])
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    traced = snapshot.filter_traces([tracemalloc.DomainFilter(True, intbitset_module.TRACEMALLOC_DOMAIN)])
+    size = sum(stat.size for stat in traced.statistics("filename"))
+    expected = sys.getsizeof(x) + sys.getsizeof(y) - 2 * sys.getsizeof(intbitset(no_allocate=1))
+    assert size == expected
+    others = snapshot.filter_traces([tracemalloc.DomainFilter(False, intbitset_module.TRACEMALLOC_DOMAIN)])
+    assert sum(stat.size for stat in others.statistics("filename")) < size
+
+
+def test_profiling():
+    x = intbitset(range(0, 10000, 3))
+    y = intbitset(range(0, 10000, 5))
+    outliers = []
+    intbitset_module.reset_profile()
+    intbitset_module.enable_profiling(lambda *args: outliers.append(args), threshold=0)
+    try:
+        x & y
+        x | y
+        x.intersection_count(y)
+        x.intersection(y, x)
+        (x.expr() - y).evaluate()
+        (x.expr() - y).count()
+        (x.expr() - y).first(3)
+        intbitset(x.fastdump())
+        intbitset().fastload(y.fastdump())
+        list(intbitset([1, 2, 3]))
+        list(x.iter_chunks(1000))
+    finally:
+        intbitset_module.disable_profiling()
+    x ^ y
+    profile = intbitset_module.get_profile()
+    assert sorted(profile) == sorted([
+        'intersection', 'union', 'intersection_count', 'intersection_many', 'expr', 'expr_count',
+        'expr_first', 'fastdump', 'fastload', 'iterate', 'iter_chunks', 'len',
+    ])
+    assert profile['intersection']['calls'] == 1
+    assert profile['intersection']['words'] == 2 * (10000 // 64 + 1)
+    assert profile['iterate']['calls'] == 4
+    assert profile['iter_chunks']['calls'] == 4
+    for stats in profile.values():
+        assert sum(stats['histogram'].values()) == stats['calls']
+        assert 0 <= stats['max'] <= stats['total']
+        assert stats['percentiles'][50] <= stats['percentiles'][99.9] <= stats['max']
+    assert len(outliers) == sum(stats['calls'] for stats in profile.values())
+    assert outliers[0][0] == 'intersection'
+    intbitset_module.reset_profile()
+    assert intbitset_module.get_profile() == {}
+    with pytest.raises(ValueError):
+        intbitset_module.enable_profiling(threshold=-1)
+
+
+def test_profiling_callback_error():
+    x = intbitset(range(0, 10000, 3))
+    y = intbitset(range(0, 10000, 5))
+
+    def callback(name, latency, words):
+        raise KeyError(name)
+
+    intbitset_module.reset_profile()
+    intbitset_module.enable_profiling(callback, threshold=0)
+    try:
+        with pytest.raises(KeyError, match="intersection"):
+            x & y
+        with pytest.raises(KeyError, match="len"):
+            len(x)
+        with pytest.raises(KeyError, match="fastdump"):
+            x.fastdump()
+        with pytest.raises(KeyError, match="iterate"):
+            next(iter(x))
+    finally:
+        intbitset_module.disable_profiling()
+    assert intbitset_module.get_profile()['intersection']['calls'] == 1
+    assert len(x) == 3334
+    intbitset_module.reset_profile()
+
+
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[False, True])
+@pytest.mark.parametrize(argnames="typecode", argvalues=["b", "B", "h", "H", "i", "I", "q", "Q"])
+def test_filter(typecode, trailing_bits):
+    intbitset1 = intbitset([1, 5, 100, 120, 127] + list(range(10000, 20000, 7)), trailing_bits=trailing_bits)
+    limit = 2 ** (8 * array(typecode).itemsize - (typecode.islower())) - 1
+    values = [v for v in [127, 5, 3, 5, 1, 120, 0, 126, 10003, 10010, 30000, 10010] if v <= limit]
+    if typecode.islower():
+        values += [-1, -120]
+    expected = [v for v in values if v >= 0 and v in intbitset1]
+    assert intbitset1.filter(array(typecode, values)).tolist() == expected
+    assert intbitset1.filter(values).tolist() == expected
+    assert intbitset1.filter(array(typecode, values), keep_order=False).tolist() == sorted(set(expected))
+    assert intbitset1.intersect_sorted(array(typecode, sorted(values))).tolist() == sorted(set(expected))
+    assert intbitset1.intersect_sorted(values).tolist() == sorted(set(expected))
+    assert intbitset1.filter(array(typecode)).tolist() == []
+
+
+@pytest.mark.parametrize(argnames="step", argvalues=[1, 3, 64, 1000])
+def test_intersect_sorted_gallop(step):
+    # Few elements against many values, galloped over, and the other way
+    # round, probed one by one.
+    values = array("I", [v // 2 for v in range(0, 200000, step)]) + array("I", [intbitset_module.__maxelem__])
+    for intbitset1 in (intbitset([0, 5, 63, 64, 5001, 77777, 99998, 99999, 100000]), intbitset(range(0, 150000, 11))):
+        expected = sorted(set(values) & set(intbitset1))
+        assert intbitset1.intersect_sorted(values).tolist() == expected
+        assert intbitset1.filter(values).tolist() == [v for v in values if v in intbitset1]
+    assert intbitset().intersect_sorted(values).tolist() == []
+    assert intbitset(trailing_bits=True).intersect_sorted(values).tolist() == sorted(set(values))
+
+
+def test_filter_errors():
+    intbitset1 = intbitset([1, 2])
+    with pytest.raises(TypeError):
+        intbitset1.filter(array("d", [1.0]))
+    with pytest.raises(TypeError):
+        intbitset1.filter(None)
+    with pytest.raises(OverflowError):
+        intbitset1.filter([2 ** 70])
+    assert intbitset1.filter([2 ** 40, 2, -3]).tolist() == [2]
+
+
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[False, True])
+@pytest.mark.parametrize(argnames="typecode", argvalues=["b", "B", "h", "H", "i", "I", "q", "Q"])
+def test_contains_many(typecode, trailing_bits):
+    intbitset1 = intbitset([0, 1, 5, 100, 127] + list(range(10000, 20000, 7)), trailing_bits=trailing_bits)
+    limit = 2 ** (8 * array(typecode).itemsize - (typecode.islower())) - 1
+    values = [v for v in [127, 5, 3, 5, 0, 126, 10003, 10010, 30000, 2 ** 31 - 1] if v <= limit]
+    if typecode.islower():
+        values += [-1, -120]
+    expected = bytes(bytearray(int(v >= 0 and v <= intbitset_module.__maxelem__ and v in intbitset1) for v in values))
+    assert intbitset1.contains_many(array(typecode, values)) == expected
+    assert intbitset1.contains_many(values) == expected
+    assert intbitset1.count_contained(array(typecode, values)) == sum(bytearray(expected))
+    assert intbitset1.count_contained(values) == sum(bytearray(expected))
+    assert intbitset1.contains_many(array(typecode)) == b""
+    assert intbitset1.count_contained([]) == 0
+
+
+def test_contains_many_numpy():
+    numpy = pytest.importorskip("numpy")
+    intbitset1 = intbitset([1, 5, 1000])
+    mask = numpy.frombuffer(intbitset1.contains_many(numpy.array([5, 6, 1000], dtype=numpy.int64)), dtype=bool)
+    assert mask.tolist() == [True, False, True]
+    with pytest.raises(TypeError):
+        intbitset1.contains_many(numpy.array([5.0]))
+
+
+def test_empty_populated_region():
+    cleared = intbitset([5, 1000, 100000])
+    cleared.clear()
+    offset = intbitset([745, 1144, 1595], trailing_bits=True) & intbitset([294])
+    for intbitset1 in (intbitset(), cleared, offset):
+        assert len(intbitset1) == 0
+        with pytest.raises(ValueError):
+            intbitset1.max()
+        assert list(reversed(intbitset1)) == []
+        assert intbitset1.prev_below(10000) is None
+        assert intbitset1.prev_below(0) is None
+        with pytest.raises(KeyError):
+            intbitset1.pop()
+
+
+def test_getbuffer_during_operation():
+    # Exporting a set with leading empty words moves its words, which a
+    # big operation may be reading meanwhile in another thread.
+    import threading
+    intbitset2 = intbitset(range(64 * 1000, 64 * 200000, 5))
+    expected = len(intbitset(range(64 * 1000, 64 * 200000, 15)))
+    done = []
+
+    def operate():
+        for _ in range(20):
+            done.append(len(intbitset1 & intbitset2) == expected)
+
+    for _ in range(5):
+        intbitset1 = intbitset(range(64 * 1000, 64 * 200000, 3))
+        thread = threading.Thread(target=operate)
+        thread.start()
+        while thread.is_alive():
+            try:
+                memoryview(intbitset1).release()
+            except BufferError:
+                pass
+            else:
+                intbitset1 = intbitset(range(64 * 1000, 64 * 200000, 3))
+        thread.join()
+    assert done == [True] * 100
+
+
+@pytest.mark.parametrize(argnames="n", argvalues=[1, 3])
+def test_write_during_operation(n):
+    # Writers wait for the big operations reading a set in other threads,
+    # which never see it half written by a big in-place operation.
+    import threading
+    previous = intbitset_module.set_num_threads(n)
+    intbitset1 = intbitset(range(0, 64 * 200000, 3))
+    intbitset2 = intbitset(range(0, 64 * 200000, 5))
+    expected = {len(intbitset1), len(intbitset1 ^ intbitset2)}
+    lengths = []
+    errors = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            lengths.append(len(intbitset1))
+            intbitset1 & intbitset2
+
+    def write():
+        nonlocal intbitset1
+        try:
+            for _ in range(20):
+                intbitset1 ^= intbitset2
+                intbitset1.add(1)
+                intbitset1.discard(1)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            done.set()
+
+    try:
+        threads = [threading.Thread(target=read), threading.Thread(target=write)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        intbitset_module.set_num_threads(previous)
+    assert errors == []
+    assert set(lengths) <= expected
+    assert len(intbitset1) == len(intbitset(intbitset1.tolist())) == min(expected)
+
+
+@pytest.mark.parametrize(argnames="trailing_bits", argvalues=[False, True])
+def test_constructor_unsorted_window(trailing_bits):
+    # The words are allocated from the first element on, and extended down
+    # to the smaller ones.
+    elements = list(range(64 * 1000, 64 * 3000, 7))
+    expected = intbitset(elements, trailing_bits=trailing_bits)
+    if not trailing_bits:
+        assert expected.__sizeof__() < intbitset(elements + [0]).__sizeof__()
+        for rhs in (elements[::-1], elements[1::2] + elements[::2], set(elements), tuple(elements[::-1])):
+            assert intbitset(rhs) == expected
+            assert intbitset(rhs).min() == 64 * 1000
+            check_bitset(intbitset(rhs))
+    else:
+        assert intbitset(tuple(elements), trailing_bits=True) == expected
+        assert intbitset(tuple(elements), trailing_bits=True).min() == 64 * 1000